@@ -0,0 +1,108 @@
+import pandas as pd
+
+
+# Tablas de agregados (rollups) calculadas de forma incremental mientras se
+# expande el dataset: cada lote se agrupa por las dimensiones configuradas y los
+# parciales se van fusionando, así que la memoria depende del número de grupos
+# (fechas x canales x ...) y no del número de filas.
+
+# Métricas de cada rollup: nombre -> columna del CSV expandido que se suma
+METRICAS_ROLLUP = {
+    "sesiones": "totals_visits",
+    "pageviews": "totals_pageviews",
+    "transacciones": "totals_transactions",
+    "ingresos": "totals_totalTransactionRevenue",
+}
+
+# Métricas que GA exporta multiplicadas por 10^6 y se devuelven en unidades
+METRICAS_EN_MILLONESIMAS = {"ingresos"}
+
+# Valor de las dimensiones ausentes o nulas
+VALOR_SIN_DATO = "(sin dato)"
+
+
+class AgregadorRollups:
+    """
+    Mantiene agregados incrementales por varios conjuntos de dimensiones.
+
+    Args:
+        dimensiones_rollup: {nombre_rollup: [columnas de agrupación]}
+        metricas: {nombre_métrica: columna a sumar}; por defecto METRICAS_ROLLUP
+        max_parciales: parciales acumulados antes de compactarlos en uno
+    """
+
+    def __init__(self, dimensiones_rollup, metricas=None, max_parciales=20):
+        self.dimensiones_rollup = dimensiones_rollup
+        self.metricas = metricas or METRICAS_ROLLUP
+        self.max_parciales = max_parciales
+        self.parciales = {nombre: [] for nombre in dimensiones_rollup}
+
+    def _agrupar(self, df, dimensiones):
+        datos = pd.DataFrame(index=df.index)
+        for columna in dimensiones:
+            if columna in df.columns:
+                datos[columna] = df[columna].astype(object).where(df[columna].notna(), VALOR_SIN_DATO).astype(str)
+            else:
+                datos[columna] = VALOR_SIN_DATO
+        datos["filas"] = 1
+        for metrica, columna in self.metricas.items():
+            if columna in df.columns:
+                datos[metrica] = pd.to_numeric(df[columna], errors="coerce").fillna(0)
+            else:
+                datos[metrica] = 0
+        return datos.groupby(dimensiones, sort=False).sum()
+
+    def _compactar(self, nombre):
+        parciales = self.parciales[nombre]
+        if len(parciales) > 1:
+            combinado = pd.concat(parciales)
+            self.parciales[nombre] = [combinado.groupby(level=list(range(combinado.index.nlevels)), sort=False).sum()]
+        return self.parciales[nombre][0] if self.parciales[nombre] else None
+
+    def actualizar(self, df):
+        """Agrega un lote de filas expandidas a todos los rollups"""
+        if df is None or df.empty:
+            return
+        for nombre, dimensiones in self.dimensiones_rollup.items():
+            self.parciales[nombre].append(self._agrupar(df, dimensiones))
+            if len(self.parciales[nombre]) >= self.max_parciales:
+                self._compactar(nombre)
+
+    def resultado(self, nombre):
+        """DataFrame final de un rollup, ordenado por sus dimensiones"""
+        agregado = self._compactar(nombre)
+        if agregado is None:
+            return pd.DataFrame(columns=self.dimensiones_rollup[nombre] + ["filas"] + list(self.metricas))
+        agregado = agregado.sort_index().reset_index()
+        for metrica in METRICAS_EN_MILLONESIMAS & set(agregado.columns):
+            agregado[metrica] = agregado[metrica] / 1_000_000
+        return agregado
+
+    def escribir(self, prefijo="rollup_", encoding="utf-8"):
+        """Escribe cada rollup como {prefijo}{nombre}.csv y devuelve {nombre: ruta}"""
+        archivos = {}
+        for nombre in self.dimensiones_rollup:
+            ruta = f"{prefijo}{nombre}.csv"
+            self.resultado(nombre).to_csv(ruta, index=False, encoding=encoding)
+            archivos[nombre] = ruta
+        return archivos
+
+
+def fusionar_archivos_rollup(rutas, ruta_salida, metricas=None, encoding="utf-8"):
+    """
+    Suma varios CSV del mismo rollup (p. ej. de fragmentos del mismo dataset) y
+    escribe el resultado ordenado por sus dimensiones. Devuelve el número de grupos.
+    """
+    metricas = ["filas"] + list(metricas or METRICAS_ROLLUP)
+    partes = [pd.read_csv(ruta, dtype=str, keep_default_na=False, encoding=encoding) for ruta in rutas]
+    combinado = pd.concat(partes, ignore_index=True)
+    dimensiones = [columna for columna in combinado.columns if columna not in metricas]
+    for metrica in metricas:
+        if metrica in combinado.columns:
+            combinado[metrica] = pd.to_numeric(combinado[metrica], errors="coerce").fillna(0)
+    if dimensiones:
+        combinado = combinado.groupby(dimensiones, sort=True).sum().reset_index()
+    else:
+        combinado = combinado.sum().to_frame().T
+    combinado.to_csv(ruta_salida, index=False, encoding=encoding)
+    return len(combinado)
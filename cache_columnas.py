@@ -0,0 +1,97 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import pandas as pd
+
+
+# Caché direccionada por contenido de las columnas limpias de la etapa 2. Cada
+# columna limpia de un bloque se guarda bajo una clave que combina el hash de los
+# bytes del bloque (con su cabecera y el esquema de lectura), el nombre de la
+# columna y la huella de las reglas de limpieza que la afectan. Al cambiar una
+# regla solo cambian las claves de sus columnas: una nueva ejecución recalcula
+# esas columnas y lee el resto de la caché.
+
+TAMANO_HUELLA = 16  # Bytes de los hashes blake2b (32 caracteres hexadecimales)
+
+
+def huella_codigo(*partes):
+    """
+    Huella estable de un conjunto de reglas: el código fuente de las funciones y el
+    repr de las constantes. Cambia si se edita cualquiera de ellas.
+    """
+    h = hashlib.blake2b(digest_size=TAMANO_HUELLA)
+    for parte in partes:
+        if callable(parte):
+            try:
+                texto = inspect.getsource(parte)
+            except (OSError, TypeError):
+                codigo = parte.__code__
+                texto = repr((codigo.co_code, codigo.co_consts))
+        else:
+            texto = repr(parte)
+        h.update(texto.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def calcular_huella_bloque(cabecera, datos, esquema=None):
+    """Hash de los bytes de un bloque junto con su cabecera y el esquema con que se lee"""
+    h = hashlib.blake2b(cabecera, digest_size=TAMANO_HUELLA)
+    h.update(datos)
+    if esquema is not None:
+        h.update(json.dumps(esquema, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class CacheColumnas:
+    """
+    Caché en disco de columnas limpias, una entrada por (bloque, columna, reglas).
+
+    Args:
+        directorio: directorio de la caché (se crea si no existe)
+        huellas_reglas: {nombre de regla: huella} de las reglas de limpieza por columna
+    """
+
+    def __init__(self, directorio, huellas_reglas):
+        self.directorio = directorio
+        # La versión de pandas cambia los tipos y la serialización de las columnas
+        self.huellas_reglas = dict(huellas_reglas, pandas=pd.__version__)
+        os.makedirs(directorio, exist_ok=True)
+
+    def clave(self, huella_bloque, columna, reglas):
+        """Clave de una columna limpia: bloque, nombre de la columna y huellas de sus reglas"""
+        h = hashlib.blake2b(huella_bloque.encode("ascii"), digest_size=TAMANO_HUELLA)
+        h.update(str(columna).encode("utf-8"))
+        for regla in sorted(reglas) + ["pandas"]:
+            h.update(b"\0" + regla.encode("utf-8") + b"=" + self.huellas_reglas[regla].encode("utf-8"))
+        return h.hexdigest()
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, clave[:2], clave + ".pkl")
+
+    def cargar(self, clave, indice):
+        """
+        Devuelve (columna limpia con el índice dado, cambios registrados al limpiarla)
+        o None si no está en la caché (o no corresponde al número de filas).
+        """
+        try:
+            with open(self._ruta(clave), "rb") as f:
+                serie, cambios = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        if len(serie) != len(indice):
+            return None
+        serie.index = indice
+        return serie, cambios
+
+    def guardar(self, clave, serie, cambios):
+        """Guarda una columna limpia (escritura atómica: varios procesos pueden compartir la caché)"""
+        ruta = self._ruta(clave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "wb") as f:
+            pickle.dump((serie.reset_index(drop=True), cambios), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, ruta)
@@ -0,0 +1,146 @@
+import csv
+import os
+import re
+
+from registros_csv import formatear_cabecera
+
+
+# Columnas fijas para el CSV expandido. Cada lote de la etapa 1 tiene las columnas
+# de sus propias visitas (hits_1_* ... hits_N_* según el N del lote), pero todos
+# se añaden al mismo archivo: sin una lista común, las filas de un lote con más
+# hits o con otros campos quedarían desalineadas con la cabecera. El ancho de hits
+# se fija de antemano con el máximo del preescaneo y cada lote se reordena a esa
+# lista; una columna que aparece tarde se añade al final y el archivo se realinea
+# una sola vez al cerrar. Un flujo (stdout) no puede realinearse: una columna
+# tardía es un error, salvo que se dé una lista fija de columnas.
+
+CELDAS_POR_ESCRITURA = 2_000_000  # Acota el DataFrame reordenado que se serializa de una vez
+
+
+def planificar_columnas_hits(columnas, max_hits, desplazamiento=1, columna_hits="hits"):
+    """
+    Repite los campos de hit vistos en `columnas` para todas las posiciones de hit
+    hasta max_hits. Las demás columnas conservan su orden y los hits van donde
+    aparece el primero.
+    """
+    patron = re.compile(rf"^{re.escape(columna_hits)}_(\d+)_(.+)$")
+    plan = []
+    sufijos = {}  # Dict en lugar de set: orden de aparición estable
+    posicion_hits = None
+    for columna in columnas:
+        coincidencia = patron.match(columna)
+        if coincidencia is None:
+            plan.append(columna)
+            continue
+        if posicion_hits is None:
+            posicion_hits = len(plan)
+        sufijos.setdefault(coincidencia.group(2), None)
+    if posicion_hits is None:
+        return plan
+    columnas_hits = [f"{columna_hits}_{n}_{sufijo}"
+                     for n in range(desplazamiento, max_hits + desplazamiento) for sufijo in sufijos]
+    # Posiciones por encima de max_hits (no deberían llegar a esta salida): al final, sin perderlas
+    planificadas = set(columnas_hits)
+    columnas_hits += [col for col in columnas if patron.match(col) and col not in planificadas]
+    return plan[:posicion_hits] + columnas_hits + plan[posicion_hits:]
+
+
+def realinear_csv(archivo_csv, columnas, encoding="utf-8"):
+    """
+    Reescribe un CSV con una cabecera más larga (columnas añadidas al final): las
+    filas escritas antes se completan con campos vacíos. Devuelve las filas escritas.
+    """
+    temporal = archivo_csv + ".alineado.tmp"
+    filas = 0
+    with open(archivo_csv, "r", encoding=encoding, newline="") as entrada, \
+            open(temporal, "w", encoding=encoding, newline="") as salida:
+        lector = csv.reader(entrada)
+        escritor = csv.writer(salida, lineterminator="\n")
+        next(lector, None)
+        escritor.writerow(columnas)
+        for fila in lector:
+            escritor.writerow(fila + [""] * (len(columnas) - len(fila)))
+            filas += 1
+    os.replace(temporal, archivo_csv)
+    return filas
+
+
+class EscritorCSVAlineado:
+    """
+    Añade lotes con columnas distintas a un único CSV con las mismas columnas en
+    todas las filas.
+
+    Args:
+        salida: ruta del CSV o flujo ya abierto (p. ej. stdout)
+        encoding: codificación del CSV
+        max_hits: si se indica, los campos de hit se planifican para todas las
+                  posiciones hasta este máximo (ver planificar_columnas_hits)
+        desplazamiento: índice del primer hit (1 o 0)
+        columnas: lista fija de columnas de la salida; las demás se descartan (en
+                  omitidas). Sin ella, una columna que aparece después de escribir
+                  la cabecera de un flujo lanza ValueError
+    """
+
+    def __init__(self, salida, encoding="utf-8", max_hits=None, desplazamiento=1, columnas=None):
+        self.salida = salida
+        self.encoding = encoding
+        self.max_hits = max_hits
+        self.desplazamiento = desplazamiento
+        self.columnas_fijas = columnas is not None
+        self.columnas = list(columnas) if columnas is not None else []
+        self.columnas_cabecera = 0  # Columnas de la cabecera ya escrita
+        self.omitidas = []  # Columnas descartadas por no estar en la lista fija
+        self.filas = 0
+        self._conocidas = set(self.columnas)
+
+    @property
+    def es_flujo(self):
+        return hasattr(self.salida, "write")
+
+    def _ampliar(self, columnas):
+        nuevas = [col for col in columnas if col not in self._conocidas]
+        if not nuevas:
+            return
+        if self.columnas_fijas:
+            self.omitidas.extend(nuevas)
+            self._conocidas.update(nuevas)
+            return
+        if self.max_hits:
+            nuevas = [col for col in planificar_columnas_hits(nuevas, self.max_hits, self.desplazamiento)
+                      if col not in self._conocidas]
+        if self.columnas_cabecera and self.es_flujo:
+            # La cabecera de un flujo ya salió: escribir sin estas columnas perdería sus valores
+            raise ValueError(f"{len(nuevas)} columnas aparecieron después de la cabecera del flujo: "
+                             f"{', '.join(nuevas[:10])}; indica una lista fija de columnas para la salida")
+        self.columnas.extend(nuevas)
+        self._conocidas.update(nuevas)
+
+    def escribir(self, df):
+        """Añade un lote, reordenado a las columnas de la salida"""
+        self._ampliar(df.columns)
+        primer_lote = not self.columnas_cabecera
+        if primer_lote:
+            self.columnas_cabecera = len(self.columnas)
+        columnas = self.columnas
+        filas_por_escritura = max(1, CELDAS_POR_ESCRITURA // max(1, len(columnas)))
+        if self.es_flujo:
+            archivo = self.salida
+        else:
+            archivo = open(self.salida, "w" if primer_lote else "a", encoding=self.encoding, newline="")
+        try:
+            if primer_lote:
+                archivo.write(formatear_cabecera(columnas))
+            for inicio in range(0, len(df), filas_por_escritura):
+                parte = df.iloc[inicio:inicio + filas_por_escritura].reindex(columns=columnas)
+                parte.to_csv(archivo, header=False, index=False, lineterminator="\n")
+        finally:
+            if not self.es_flujo:
+                archivo.close()
+        self.filas += len(df)
+
+    def cerrar(self):
+        """Si aparecieron columnas después de la cabecera, realinea el archivo. Devuelve las columnas"""
+        if not self.es_flujo and self.columnas_cabecera and len(self.columnas) > self.columnas_cabecera:
+            realinear_csv(self.salida, self.columnas, self.encoding)
+            self.columnas_cabecera = len(self.columnas)
+        return self.columnas
@@ -0,0 +1,261 @@
+import math
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+# Deduplicación de visitas en streaming. Un filtro de Bloom en memoria descarta
+# sin tocar disco las claves que seguro son nuevas; solo las que el filtro "cree"
+# haber visto se comprueban contra un almacén exacto en SQLite. El filtro empieza
+# pequeño y crece por etapas, así que su memoria sigue al número real de claves.
+
+# Semillas (16 bytes) de los dos hashes independientes del doble hashing
+_SEMILLA_HASH_1 = "0123456789123456"
+_SEMILLA_HASH_2 = "6543210987654321"
+
+# Máximo de parámetros por consulta IN (límite por defecto de SQLite antiguo)
+_PARAMETROS_POR_CONSULTA = 900
+
+
+class FiltroBloom:
+    """Filtro de Bloom sobre un array de bits de numpy, con operaciones vectorizadas"""
+
+    def __init__(self, capacidad, tasa_falsos_positivos=0.01):
+        capacidad = max(int(capacidad), 1)
+        bits = -capacidad * math.log(tasa_falsos_positivos) / (math.log(2) ** 2)
+        self.num_bits = max(8, int(math.ceil(bits / 8)) * 8)
+        self.num_hashes = max(1, int(round(self.num_bits / capacidad * math.log(2))))
+        self.bits = np.zeros(self.num_bits // 8, dtype=np.uint8)
+
+    @staticmethod
+    def _hashes(claves):
+        valores = np.asarray(claves, dtype=object)
+        h1 = pd.util.hash_array(valores, hash_key=_SEMILLA_HASH_1)
+        h2 = pd.util.hash_array(valores, hash_key=_SEMILLA_HASH_2) | np.uint64(1)
+        return h1, h2
+
+    def _posiciones(self, claves):
+        """Matriz (num_hashes, len(claves)) de posiciones de bit (doble hashing)"""
+        h1, h2 = self._hashes(claves)
+        i = np.arange(self.num_hashes, dtype=np.uint64)[:, None]
+        return (h1[None, :] + i * h2[None, :]) % np.uint64(self.num_bits)
+
+    def contiene(self, claves):
+        """Máscara booleana: True si la clave puede estar en el filtro, False si seguro que no"""
+        if len(claves) == 0:
+            return np.zeros(0, dtype=bool)
+        posiciones = self._posiciones(claves)
+        bytes_ = self.bits[(posiciones >> np.uint64(3)).astype(np.int64)]
+        bits = (bytes_ >> (posiciones & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=0)
+
+    def agregar(self, claves):
+        if len(claves) == 0:
+            return
+        posiciones = self._posiciones(claves).ravel()
+        # ufunc.at: varias posiciones pueden caer en el mismo byte
+        np.bitwise_or.at(self.bits, (posiciones >> np.uint64(3)).astype(np.int64),
+                         (np.uint8(1) << (posiciones & np.uint64(7)).astype(np.uint8)))
+
+    def memoria_mb(self):
+        return self.bits.nbytes / (1024 ** 2)
+
+
+class FiltroBloomEscalable:
+    """
+    Filtro de Bloom que crece por etapas: cuando la última etapa llega a su
+    capacidad se añade otra del doble de tamaño con la mitad de tasa de falsos
+    positivos, de modo que la tasa total no supera la pedida.
+    """
+
+    def __init__(self, capacidad_inicial=1_000_000, tasa_falsos_positivos=0.01):
+        self.capacidad_inicial = max(int(capacidad_inicial), 1)
+        self.tasa_falsos_positivos = tasa_falsos_positivos
+        self.etapas = []
+        self.num_claves = 0
+        self._ocupacion = 0  # Claves en la última etapa
+        self._nueva_etapa()
+
+    def _nueva_etapa(self):
+        k = len(self.etapas)
+        # Tasas r/2, r/4, r/8...: su suma no pasa de r
+        self.etapas.append(FiltroBloom(self.capacidad_inicial * 2 ** k, self.tasa_falsos_positivos / 2 ** (k + 1)))
+        self._ocupacion = 0
+
+    def contiene(self, claves):
+        """Máscara booleana: True si la clave puede estar en el filtro, False si seguro que no"""
+        resultado = np.zeros(len(claves), dtype=bool)
+        for etapa in self.etapas:
+            resultado |= etapa.contiene(claves)
+        return resultado
+
+    def agregar(self, claves):
+        inicio = 0
+        while inicio < len(claves):
+            libres = self.capacidad_inicial * 2 ** (len(self.etapas) - 1) - self._ocupacion
+            if libres <= 0:
+                self._nueva_etapa()
+                continue
+            parte = claves[inicio:inicio + libres]
+            self.etapas[-1].agregar(parte)
+            self._ocupacion += len(parte)
+            self.num_claves += len(parte)
+            inicio += len(parte)
+
+    def memoria_mb(self):
+        return sum(etapa.memoria_mb() for etapa in self.etapas)
+
+    def guardar(self, ruta):
+        """Guarda las etapas y el número de claves (escritura atómica)"""
+        parametros = np.array([self.capacidad_inicial, self.tasa_falsos_positivos, self.num_claves, self._ocupacion])
+        temporal = ruta + ".tmp"
+        with open(temporal, "wb") as f:
+            np.savez(f, parametros=parametros, **{f"etapa_{k}": etapa.bits for k, etapa in enumerate(self.etapas)})
+        os.replace(temporal, ruta)
+
+    @classmethod
+    def cargar(cls, ruta, capacidad_inicial, tasa_falsos_positivos):
+        """Filtro guardado con guardar(), o None si no existe o sus parámetros no coinciden"""
+        if not os.path.exists(ruta):
+            return None
+        try:
+            with np.load(ruta) as datos:
+                capacidad, tasa, num_claves, ocupacion = datos["parametros"]
+                if int(capacidad) != max(int(capacidad_inicial), 1) or tasa != tasa_falsos_positivos:
+                    return None
+                filtro = cls(capacidad_inicial, tasa_falsos_positivos)
+                for k in range(len(datos.files) - 1):
+                    if k:
+                        filtro._nueva_etapa()
+                    bits = datos[f"etapa_{k}"]
+                    if bits.shape != filtro.etapas[k].bits.shape:
+                        return None
+                    filtro.etapas[k].bits = bits
+        except (OSError, ValueError, KeyError):
+            return None
+        filtro.num_claves, filtro._ocupacion = int(num_claves), int(ocupacion)
+        return filtro
+
+
+class AlmacenClavesVisitas:
+    """
+    Conjunto de claves de visita (fullVisitorId|visitId) con filtro de Bloom en
+    memoria y almacén exacto en SQLite. El almacén (y una copia del filtro) se
+    conservan en disco, así que lotes procesados en ejecuciones distintas se
+    deduplican entre sí si no se reinicia. El filtro empieza con capacidad_inicial
+    claves y crece con ellas.
+    """
+
+    def __init__(self, ruta, capacidad_inicial=1_000_000, tasa_falsos_positivos=0.01, reiniciar=True):
+        self.ruta = ruta
+        self.ruta_filtro = ruta + ".bloom.npz"
+        self.capacidad_inicial = capacidad_inicial
+        self.tasa_falsos_positivos = tasa_falsos_positivos
+        if reiniciar:
+            for archivo in (ruta, self.ruta_filtro):
+                if os.path.exists(archivo):
+                    os.remove(archivo)
+
+        self.conexion = sqlite3.connect(ruta)
+        # Escritura rápida: el almacén es reconstruible, no necesita durabilidad
+        self.conexion.execute("PRAGMA journal_mode=OFF")
+        self.conexion.execute("PRAGMA synchronous=OFF")
+        self.conexion.execute("PRAGMA cache_size=-65536")  # 64 MB de caché como máximo
+        self.conexion.execute("PRAGMA temp_store=MEMORY")
+        self.conexion.execute("CREATE TABLE IF NOT EXISTS claves (clave TEXT PRIMARY KEY) WITHOUT ROWID")
+
+        self.filtro = FiltroBloomEscalable(capacidad_inicial, tasa_falsos_positivos)
+        self.claves_almacenadas = self.conexion.execute("SELECT COUNT(*) FROM claves").fetchone()[0]
+        if self.claves_almacenadas:
+            self._cargar_filtro()
+
+        self.duplicados = 0
+        self.consultas_disco = 0
+        self.falsos_positivos = 0
+        self.claves_desincronizadas = 0  # Ya almacenadas pero ausentes del filtro (no se descartaron)
+
+    def _cargar_filtro(self):
+        """
+        Recupera el filtro guardado o, si no coincide con el almacén (p. ej. el
+        proceso terminó antes de cerrar y el filtro es de una ejecución anterior),
+        lo reconstruye desde las claves almacenadas
+        """
+        filtro = FiltroBloomEscalable.cargar(self.ruta_filtro, self.capacidad_inicial, self.tasa_falsos_positivos)
+        if filtro is not None and filtro.num_claves == self.claves_almacenadas:
+            self.filtro = filtro
+            return
+        self._reconstruir_filtro()
+
+    def _reconstruir_filtro(self):
+        self.filtro = FiltroBloomEscalable(self.capacidad_inicial, self.tasa_falsos_positivos)
+        cursor = self.conexion.execute("SELECT clave FROM claves")
+        while True:
+            filas = cursor.fetchmany(100_000)
+            if not filas:
+                break
+            self.filtro.agregar([fila[0] for fila in filas])
+
+    def _existentes(self, claves):
+        """Subconjunto de claves que ya están en el almacén"""
+        existentes = set()
+        for i in range(0, len(claves), _PARAMETROS_POR_CONSULTA):
+            parte = claves[i:i + _PARAMETROS_POR_CONSULTA]
+            marcadores = ",".join("?" * len(parte))
+            cursor = self.conexion.execute(f"SELECT clave FROM claves WHERE clave IN ({marcadores})", parte)
+            existentes.update(fila[0] for fila in cursor)
+        return existentes
+
+    def filtrar_nuevas(self, claves):
+        """
+        Registra las claves de un lote y devuelve una máscara con True en la primera
+        aparición de cada clave nueva y False en las duplicadas (dentro del lote o
+        vistas en lotes anteriores)
+        """
+        claves = pd.Series(claves, dtype=object).reset_index(drop=True)
+        nuevas = ~claves.duplicated().to_numpy()
+        candidatas = claves[nuevas]
+
+        # Solo las claves que el filtro cree conocer se buscan en disco
+        posibles = self.filtro.contiene(candidatas.to_numpy())
+        if posibles.any():
+            a_consultar = candidatas[posibles].tolist()
+            existentes = self._existentes(a_consultar)
+            self.consultas_disco += len(a_consultar)
+            self.falsos_positivos += len(a_consultar) - len(existentes)
+            if existentes:
+                nuevas &= ~claves.isin(existentes).to_numpy()
+
+        claves_nuevas = claves[nuevas].tolist()
+        if claves_nuevas:
+            cambios_previos = self.conexion.total_changes
+            self.conexion.executemany("INSERT OR IGNORE INTO claves (clave) VALUES (?)",
+                                      ((c,) for c in claves_nuevas))
+            self.conexion.commit()
+            insertadas = self.conexion.total_changes - cambios_previos
+            self.claves_almacenadas += insertadas
+            if insertadas == len(claves_nuevas):
+                self.filtro.agregar(claves_nuevas)
+            else:
+                # El filtro no conocía claves ya almacenadas: se rehace para no volver a fallar
+                self.claves_desincronizadas += len(claves_nuevas) - insertadas
+                self._reconstruir_filtro()
+
+        self.duplicados += len(claves) - int(nuevas.sum())
+        return nuevas
+
+    def cerrar(self):
+        """Guarda el filtro junto al almacén y cierra la conexión"""
+        self.filtro.guardar(self.ruta_filtro)
+        self.conexion.close()
+
+    def resumen(self):
+        return {
+            "claves_almacenadas": self.claves_almacenadas,
+            "duplicados_descartados": self.duplicados,
+            "consultas_disco": self.consultas_disco,
+            "falsos_positivos_bloom": self.falsos_positivos,
+            "claves_desincronizadas": self.claves_desincronizadas,
+            "memoria_filtro_mb": round(self.filtro.memoria_mb(), 1),
+        }
@@ -0,0 +1,391 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+
+# Sketch de cuantiles fusionable para datos en streaming
+class SketchCuantiles:
+    """
+    Sketch de cuantiles con error de rango acotado (esquema KLL).
+
+    Los valores se guardan en niveles; un elemento del nivel h representa 2**h
+    valores originales. Cuando un nivel supera su capacidad se ordena y se
+    conserva uno de cada dos elementos en el nivel siguiente, así que la memoria
+    crece solo de forma logarítmica con el número de valores. Dos sketches se
+    fusionan concatenando sus niveles, por lo que se pueden actualizar lote a lote
+    (o en procesos distintos) y combinar al final.
+
+    Args:
+        k: precisión del sketch; el error de rango es del orden de 1/k
+        semilla: semilla del generador aleatorio (resultados reproducibles)
+    """
+
+    def __init__(self, k=200, semilla=0):
+        self.k = k
+        self.niveles = [np.empty(0)]  # niveles[h] contiene elementos de peso 2**h
+        self.total = 0
+        self.minimo = math.inf
+        self.maximo = -math.inf
+        self._rng = np.random.default_rng(semilla)
+
+    def _capacidad(self, nivel):
+        profundidad = len(self.niveles) - nivel - 1
+        return max(2, int(math.ceil(self.k * (2 / 3) ** profundidad)))
+
+    def _insertar(self, nivel, valores):
+        while len(self.niveles) <= nivel:
+            self.niveles.append(np.empty(0))
+        self.niveles[nivel] = np.concatenate([self.niveles[nivel], valores])
+
+    def _compactar(self):
+        nivel = 0
+        while nivel < len(self.niveles):
+            if len(self.niveles[nivel]) > self._capacidad(nivel):
+                elementos = np.sort(self.niveles[nivel])
+                resto = elementos[len(elementos) - len(elementos) % 2:]
+                elementos = elementos[:len(elementos) - len(resto)]
+                self._insertar(nivel + 1, elementos[self._rng.integers(2)::2])
+                self.niveles[nivel] = resto
+            nivel += 1
+
+    def actualizar(self, valores):
+        """Agrega un conjunto de valores (se ignoran nulos e infinitos)"""
+        valores = np.asarray(valores, dtype=float)
+        valores = valores[np.isfinite(valores)]
+        if valores.size == 0:
+            return
+
+        self.total += int(valores.size)
+        self.minimo = min(self.minimo, float(valores.min()))
+        self.maximo = max(self.maximo, float(valores.max()))
+
+        # Un lote grande se inserta directamente en el nivel adecuado: ordenar una vez
+        # y tomar uno de cada 2**nivel valores equivale a compactarlo `nivel` veces
+        nivel = 0
+        if valores.size > self.k:
+            nivel = int(math.log2(valores.size / self.k))
+            valores = np.sort(valores)
+            if nivel:
+                paso = 2 ** nivel
+                valores = valores[self._rng.integers(paso)::paso]
+        self._insertar(nivel, valores)
+        self._compactar()
+
+    def fusionar(self, otro):
+        """Incorpora los valores resumidos en otro sketch"""
+        for nivel, valores in enumerate(otro.niveles):
+            if len(valores):
+                self._insertar(nivel, valores)
+        self.total += otro.total
+        self.minimo = min(self.minimo, otro.minimo)
+        self.maximo = max(self.maximo, otro.maximo)
+        self._compactar()
+        return self
+
+    def _vista_ordenada(self):
+        """Devuelve (valores ordenados, pesos acumulados) de todos los niveles"""
+        valores = np.concatenate(self.niveles)
+        pesos = np.concatenate([np.full(len(v), 2 ** h, dtype=np.int64) for h, v in enumerate(self.niveles)])
+        orden = np.argsort(valores, kind='stable')
+        return valores[orden], np.cumsum(pesos[orden])
+
+    def cuantil(self, q):
+        """Estima el cuantil q (0 <= q <= 1); devuelve None si el sketch está vacío"""
+        if self.total == 0:
+            return None
+        valores, acumulado = self._vista_ordenada()
+        posicion = int(np.searchsorted(acumulado, q * acumulado[-1], side='left'))
+        valor = float(valores[min(posicion, len(valores) - 1)])
+        return min(max(valor, self.minimo), self.maximo)
+
+    def contar_fuera_de(self, limite_inferior, limite_superior):
+        """Estima cuántos valores quedan por debajo o por encima de los límites"""
+        if self.total == 0:
+            return 0
+        valores, acumulado = self._vista_ordenada()
+        pesos = np.diff(acumulado, prepend=0)
+        fuera = pesos[(valores < limite_inferior) | (valores > limite_superior)].sum()
+        return int(round(fuera * self.total / acumulado[-1]))
+
+    def limites_iqr(self, factor=3.0):
+        """
+        Calcula Q1, Q3, el rango intercuartílico y los límites de outliers
+        (Q1 - factor*IQR, Q3 + factor*IQR) sobre todos los valores vistos.
+        """
+        if self.total == 0:
+            return None
+        q1 = self.cuantil(0.25)
+        q3 = self.cuantil(0.75)
+        iqr = q3 - q1
+        limite_inferior = q1 - factor * iqr
+        limite_superior = q3 + factor * iqr
+        return {
+            "q1": q1,
+            "q3": q3,
+            "iqr": iqr,
+            "limite_inferior": limite_inferior,
+            "limite_superior": limite_superior,
+            "outliers_estimados": self.contar_fuera_de(limite_inferior, limite_superior),
+            "valores": self.total,
+        }
+
+
+# Conteo aproximado de valores distintos
+class HyperLogLog:
+    """
+    Estimador HyperLogLog del número de valores distintos.
+
+    Usa 2**precision registros de un byte (4 KB con la precisión por defecto),
+    con un error estándar aproximado de 1.04 / sqrt(2**precision). Se actualiza
+    con hashes de 64 bits ya calculados, y dos estimadores con la misma precisión
+    se fusionan tomando el máximo de cada registro.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registros = np.zeros(self.m, dtype=np.uint8)
+
+    def actualizar_hashes(self, hashes):
+        """Agrega un array de hashes uint64"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if hashes.size == 0:
+            return
+        p = np.uint64(self.precision)
+        indices = (hashes >> (np.uint64(64) - p)).astype(np.intp)
+        # El bit centinela garantiza un resto distinto de cero (rango máximo 64 - p + 1)
+        resto = (hashes << p) | (np.uint64(1) << (p - np.uint64(1)))
+
+        # Contar ceros a la izquierda por búsqueda binaria vectorizada
+        ceros = np.zeros(hashes.size, dtype=np.uint8)
+        for desplazamiento in (32, 16, 8, 4, 2, 1):
+            sin_bits_altos = resto < (np.uint64(1) << np.uint64(64 - desplazamiento))
+            ceros[sin_bits_altos] += desplazamiento
+            resto[sin_bits_altos] <<= np.uint64(desplazamiento)
+
+        np.maximum.at(self.registros, indices, ceros + 1)
+
+    def fusionar(self, otro):
+        """Incorpora los registros de otro estimador con la misma precisión"""
+        if otro.precision != self.precision:
+            raise ValueError("Solo se pueden fusionar estimadores con la misma precisión")
+        np.maximum(self.registros, otro.registros, out=self.registros)
+        return self
+
+    def estimar(self):
+        """Devuelve el número estimado de valores distintos"""
+        alfa = 0.7213 / (1 + 1.079 / self.m)
+        estimacion = alfa * self.m ** 2 / np.sum(np.ldexp(1.0, -self.registros.astype(np.int64)))
+        registros_vacios = int(np.count_nonzero(self.registros == 0))
+        # Corrección para cardinalidades pequeñas (conteo lineal)
+        if estimacion <= 2.5 * self.m and registros_vacios > 0:
+            estimacion = self.m * math.log(self.m / registros_vacios)
+        return int(round(estimacion))
+
+
+# Valores más frecuentes en memoria acotada
+class TopKFrecuentes:
+    """
+    Resumen Misra-Gries de los valores más frecuentes.
+
+    Mantiene como máximo `capacidad` contadores. Los conteos son cotas inferiores
+    con un error máximo de N / (capacidad + 1), y dos resúmenes se fusionan
+    sumando contadores y recortando de nuevo a la capacidad.
+    """
+
+    def __init__(self, capacidad=50):
+        self.capacidad = capacidad
+        self.contadores = {}
+
+    def _recortar(self):
+        if len(self.contadores) <= self.capacidad:
+            return
+        umbral = sorted(self.contadores.values(), reverse=True)[self.capacidad]
+        self.contadores = {valor: cantidad - umbral
+                           for valor, cantidad in self.contadores.items() if cantidad > umbral}
+
+    def actualizar_serie(self, serie):
+        """Agrega los valores no nulos de una serie de pandas"""
+        conteos = serie.value_counts(sort=False)
+        if len(conteos) > self.capacidad:
+            # Resumen Misra-Gries del lote antes de fusionarlo
+            umbral = conteos.nlargest(self.capacidad + 1).iloc[-1]
+            conteos = conteos[conteos > umbral] - umbral
+        self.actualizar_conteos(conteos.items())
+
+    def actualizar_conteos(self, conteos):
+        """Agrega pares (valor, cantidad)"""
+        for valor, cantidad in conteos:
+            self.contadores[valor] = self.contadores.get(valor, 0) + int(cantidad)
+        self._recortar()
+
+    def fusionar(self, otro):
+        """Incorpora los contadores de otro resumen"""
+        self.actualizar_conteos(otro.contadores.items())
+        return self
+
+    def mas_frecuentes(self, n=5):
+        """Devuelve los n valores con mayor conteo como lista de (valor, cantidad)"""
+        return sorted(self.contadores.items(), key=lambda x: x[1], reverse=True)[:n]
+
+
+# Muestra uniforme de tamaño fijo de un flujo de elementos
+class MuestraReservorio:
+    """
+    Muestreo de reservorio (algoritmo R): conserva `capacidad` elementos elegidos
+    al azar entre todos los vistos, con memoria fija. Los lotes se procesan de una
+    vez (el elemento t-ésimo entra con probabilidad capacidad/t) y dos muestras se
+    fusionan tomando de cada una un número de elementos proporcional a lo que vio.
+    """
+
+    def __init__(self, capacidad=100, semilla=0):
+        self.capacidad = capacidad
+        self.vistos = 0
+        self.elementos = []
+        self._rng = np.random.default_rng(semilla)
+
+    def actualizar(self, elementos):
+        """Agrega una secuencia de elementos (lista o similar, con acceso por posición)"""
+        total = len(elementos)
+        libres = min(total, self.capacidad - len(self.elementos))
+        self.elementos.extend(elementos[:libres])
+        if total > libres:
+            posiciones = np.arange(self.vistos + libres + 1, self.vistos + total + 1)
+            aceptados = np.flatnonzero(self._rng.random(total - libres) < self.capacidad / posiciones) + libres
+            ranuras = self._rng.integers(0, self.capacidad, size=len(aceptados))
+            for posicion, ranura in zip(aceptados, ranuras):
+                self.elementos[ranura] = elementos[posicion]
+        self.vistos += total
+
+    def fusionar(self, otra):
+        """Incorpora la muestra de otro flujo disjunto"""
+        vistos = self.vistos + otra.vistos
+        tamano = min(self.capacidad, len(self.elementos) + len(otra.elementos))
+        if otra.vistos and tamano:
+            # Elementos de esta muestra en la fusión: hipergeométrica sobre lo visto por cada una
+            propios = int(self._rng.hypergeometric(self.vistos, otra.vistos, tamano)) if self.vistos else 0
+            propios = max(min(propios, len(self.elementos)), tamano - len(otra.elementos))
+            elegidos = [self.elementos[i] for i in self._rng.permutation(len(self.elementos))[:propios]]
+            elegidos += [otra.elementos[i] for i in self._rng.permutation(len(otra.elementos))[:tamano - propios]]
+            self.elementos = elegidos
+        self.vistos = vistos
+        return self
+
+
+# Perfil completo de una columna acumulado lote a lote
+class PerfilColumna:
+    """
+    Acumula las estadísticas de una columna sobre todos los lotes en memoria
+    acotada: nulos, ceros/vacíos, mínimo, máximo, media y varianza (fusión de
+    Chan), valores distintos (HyperLogLog), valores más frecuentes (Misra-Gries)
+    y longitud promedio de los textos.
+    """
+
+    def __init__(self, capacidad_top=50, precision_hll=12):
+        self.filas = 0
+        self.nulos = 0
+        self.ceros = 0
+        self.vacios = 0
+        self.lotes_numericos = 0
+        self.lotes_texto = 0
+        # Momentos de los valores numéricos
+        self.conteo_numerico = 0
+        self.media = 0.0
+        self.m2 = 0.0
+        self.minimo = math.inf
+        self.maximo = -math.inf
+        # Textos
+        self.suma_longitudes = 0
+        self.conteo_textos = 0
+        self.distintos = HyperLogLog(precision_hll)
+        self.frecuentes = TopKFrecuentes(capacidad_top)
+
+    @property
+    def tipo(self):
+        return "numérica" if self.lotes_numericos and not self.lotes_texto else "texto/categórica"
+
+    def _agregar_momentos(self, conteo, media, m2):
+        """Combina media y suma de cuadrados (algoritmo paralelo de Chan)"""
+        if conteo == 0:
+            return
+        total = self.conteo_numerico + conteo
+        delta = media - self.media
+        self.media += delta * conteo / total
+        self.m2 += m2 + delta ** 2 * self.conteo_numerico * conteo / total
+        self.conteo_numerico = total
+
+    def actualizar(self, serie):
+        """Agrega los valores de una serie de pandas (un lote de la columna)"""
+        self.filas += len(serie)
+        presentes = serie.dropna()
+        self.nulos += len(serie) - len(presentes)
+        if len(presentes) == 0:
+            return
+
+        self.distintos.actualizar_hashes(pd.util.hash_pandas_object(presentes, index=False).to_numpy())
+
+        if pd.api.types.is_numeric_dtype(presentes) and not pd.api.types.is_bool_dtype(presentes):
+            self.lotes_numericos += 1
+            valores = presentes.to_numpy(dtype=float)
+            valores = valores[np.isfinite(valores)]
+            if valores.size:
+                self.ceros += int(np.count_nonzero(valores == 0))
+                self.minimo = min(self.minimo, float(valores.min()))
+                self.maximo = max(self.maximo, float(valores.max()))
+                media = float(valores.mean())
+                self._agregar_momentos(int(valores.size), media, float(((valores - media) ** 2).sum()))
+        else:
+            self.lotes_texto += 1
+            self.frecuentes.actualizar_serie(presentes)
+            if presentes.dtype == 'object' or pd.api.types.is_string_dtype(presentes):
+                textos = presentes.astype(str)
+                self.vacios += int((textos == "").sum())
+                self.suma_longitudes += int(textos.str.len().sum())
+                self.conteo_textos += len(textos)
+
+    def fusionar(self, otro):
+        """Incorpora el perfil de la misma columna calculado en otro proceso o lote"""
+        self.filas += otro.filas
+        self.nulos += otro.nulos
+        self.ceros += otro.ceros
+        self.vacios += otro.vacios
+        self.lotes_numericos += otro.lotes_numericos
+        self.lotes_texto += otro.lotes_texto
+        self._agregar_momentos(otro.conteo_numerico, otro.media, otro.m2)
+        self.minimo = min(self.minimo, otro.minimo)
+        self.maximo = max(self.maximo, otro.maximo)
+        self.suma_longitudes += otro.suma_longitudes
+        self.conteo_textos += otro.conteo_textos
+        self.distintos.fusionar(otro.distintos)
+        self.frecuentes.fusionar(otro.frecuentes)
+        return self
+
+    def resumen(self, sketch_cuantiles=None, top_n=5):
+        """
+        Devuelve las estadísticas de la columna en el formato del reporte de limpieza.
+
+        Args:
+            sketch_cuantiles: SketchCuantiles de la columna, usado para la mediana
+            top_n: cantidad de valores frecuentes a incluir
+        """
+        stats = {"tipo": self.tipo, "filas": self.filas}
+        if self.tipo == "numérica":
+            hay_valores = self.conteo_numerico > 0
+            mediana = sketch_cuantiles.cuantil(0.5) if sketch_cuantiles is not None else None
+            stats["media"] = self.media if hay_valores else 0
+            stats["mediana"] = float(mediana) if mediana is not None else 0
+            stats["desviacion_estandar"] = (math.sqrt(self.m2 / (self.conteo_numerico - 1))
+                                            if self.conteo_numerico > 1 else 0)
+            stats["min"] = self.minimo if hay_valores else 0
+            stats["max"] = self.maximo if hay_valores else 0
+            stats["nulos"] = self.nulos
+            stats["ceros"] = self.ceros
+        else:
+            stats["valores_frecuentes"] = {str(k): int(v) for k, v in self.frecuentes.mas_frecuentes(top_n)}
+            stats["nulos"] = self.nulos
+            stats["vacios"] = self.vacios
+            if self.conteo_textos:
+                stats["longitud_promedio"] = self.suma_longitudes / self.conteo_textos
+        stats["distintos_aprox"] = self.distintos.estimar()
+        return stats
@@ -0,0 +1,126 @@
+import re
+
+import pandas as pd
+
+
+# Filtros de filas evaluados sobre el lote crudo, antes de expandir el JSON: las
+# visitas descartadas nunca pagan la interpretación de sus hits. Solo se filtra por
+# columnas escalares (date, channelGrouping, visitNumber...) y por campos de primer
+# nivel de las columnas JSON pequeñas (totals_bounces, device_deviceCategory,
+# trafficSource_medium...), que se extraen del texto con una expresión regular en
+# lugar de interpretar el objeto completo. Cada filtro es un diccionario:
+#   - "en" / "no_en": el valor está (o no) en "valores"
+#   - "rango": el valor numérico está entre "min" y/o "max" (incluidos; date como YYYYMMDD)
+#   - "nulo" / "no_nulo": el valor falta (p. ej. totals_bounces nulo = sesiones sin rebote)
+# Ejemplo: [{"columna": "date", "tipo": "rango", "min": 20170801, "max": 20170807},
+#           {"columna": "channelGrouping", "tipo": "en", "valores": ["Organic Search", "Direct"]}]
+
+TIPOS_FILTRO = ("en", "no_en", "rango", "nulo", "no_nulo")
+COLUMNAS_JSON_NO_FILTRABLES = ("hits", "customDimensions")  # Listas: no tienen campos de primer nivel
+NULOS_SIN_COMILLAS = ("null", "None")  # null de JSON y None de Python: la expansión los deja vacíos
+
+
+def compilar_filtros(filtros):
+    """Valida la lista de filtros y la devuelve normalizada (valores de "rango" como números)"""
+    compilados = []
+    for filtro in filtros or []:
+        columna, tipo = filtro.get("columna"), filtro.get("tipo")
+        if not columna or tipo not in TIPOS_FILTRO:
+            raise ValueError(f"Filtro de filas no válido: {filtro} (tipos: {', '.join(TIPOS_FILTRO)})")
+        filtro = dict(filtro)
+        if tipo in ("en", "no_en"):
+            filtro["valores"] = list(filtro.get("valores", []))
+        elif tipo == "rango":
+            if filtro.get("min") is None and filtro.get("max") is None:
+                raise ValueError(f"El filtro de rango sobre '{columna}' necesita 'min' y/o 'max'")
+            for limite in ("min", "max"):
+                if filtro.get(limite) is not None:
+                    filtro[limite] = float(filtro[limite])
+        compilados.append(filtro)
+    return compilados
+
+
+def _origen_columna(columna, columnas_lote):
+    """(columna JSON, campo) de la que sale una columna filtrada, o (columna, None) si es escalar"""
+    if columna in columnas_lote:
+        return columna, None
+    padre, _, campo = columna.partition("_")
+    if campo and padre in columnas_lote and padre not in COLUMNAS_JSON_NO_FILTRABLES and "_" not in campo:
+        return padre, campo
+    return None, None
+
+
+def verificar_columnas(filtros, columnas_lote):
+    """Falla si algún filtro se refiere a una columna que no existe ni sale de una columna JSON"""
+    for filtro in filtros:
+        if _origen_columna(filtro["columna"], columnas_lote)[0] is None:
+            raise ValueError(f"Filtro de filas sobre una columna inexistente: '{filtro['columna']}'")
+
+
+def _patron_campo(campo):
+    # "campo": "valor" (JSON) o 'campo': 'valor' (repr de Python); también valores sin comillas
+    clave = re.escape(campo)
+    return rf"""["']{clave}["']\s*:\s*(?:"([^"]*)"|'([^']*)'|([^,}}\]\s]+))"""
+
+
+def extraer_campo(serie, campo):
+    """
+    Valor de un campo de primer nivel del texto JSON de cada fila, sin interpretar
+    el objeto. Un null o None sin comillas es un valor que falta, como al expandir.
+    """
+    grupos = serie.astype("string").str.extract(_patron_campo(campo))
+    sin_comillas = grupos[2].mask(grupos[2].isin(NULOS_SIN_COMILLAS))
+    return grupos[0].fillna(grupos[1]).fillna(sin_comillas)
+
+
+def tabla_filtros(lote, filtros, es_ndjson=False):
+    """
+    DataFrame con solo las columnas que usan los filtros, alineado con el lote: el
+    lote crudo del lector CSV o, con es_ndjson, la lista de pares (índice, visita).
+    """
+    columnas = dict.fromkeys(filtro["columna"] for filtro in filtros)
+    if es_ndjson:
+        datos = {}
+        for columna in columnas:
+            valores = []
+            for _, visita in lote:
+                padre, campo = _origen_columna(columna, visita)
+                valor = visita.get(padre) if padre is not None else None
+                if campo is not None:
+                    valor = valor.get(campo) if isinstance(valor, dict) else None
+                valores.append(valor)
+            datos[columna] = valores
+        return pd.DataFrame(datos, index=[indice for indice, _ in lote])
+    datos = {}
+    for columna in columnas:
+        padre, campo = _origen_columna(columna, lote.columns)
+        datos[columna] = lote[padre] if campo is None else extraer_campo(lote[padre], campo)
+    return pd.DataFrame(datos, index=lote.index)
+
+
+def mascara_filtros(tabla, filtros):
+    """Serie booleana con True en las filas que cumplen todos los filtros (vectorizada)"""
+    mascara = pd.Series(True, index=tabla.index)
+    for filtro in filtros:
+        serie = tabla[filtro["columna"]]
+        tipo = filtro["tipo"]
+        if tipo == "nulo":
+            mascara &= serie.isna()
+        elif tipo == "no_nulo":
+            mascara &= serie.notna()
+        elif tipo == "rango":
+            valores = pd.to_numeric(serie, errors="coerce")
+            cumple = valores.notna()
+            if filtro.get("min") is not None:
+                cumple &= valores >= filtro["min"]
+            if filtro.get("max") is not None:
+                cumple &= valores <= filtro["max"]
+            mascara &= cumple.fillna(False).astype(bool)
+        else:
+            if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+                # Columnas leídas como números: 2 y "2" deben coincidir
+                esta = serie.isin(pd.to_numeric(pd.Series(filtro["valores"], dtype=object), errors="coerce"))
+            else:
+                esta = serie.notna() & serie.astype(str).isin([str(valor) for valor in filtro["valores"]])
+            mascara &= esta if tipo == "en" else ~esta
+    return mascara
@@ -1,7 +1,10 @@
+import argparse
+import itertools
 import pandas as pd
 import json
 import os
 import re
+import sys
 from datetime import datetime
 import ast
 from tqdm import tqdm  # Para barras de progreso
@@ -11,6 +14,15 @@ import numpy as np
 from IPython.display import HTML
 import base64
 from io import BytesIO
+from agregados import AgregadorRollups
+from columnas_salida import EscritorCSVAlineado
+from deduplicacion import AlmacenClavesVisitas
+from filtros_filas import compilar_filtros, mascara_filtros, tabla_filtros, verificar_columnas
+from muestreo import escribir_muestra, leer_muestra, ruta_muestra
+from particionado import EscritorParticionado
+from poda_columnas import SeguimientoColumnas, ruta_columnas
+from preescaneo_hits import preescanear_hits
+from telemetria import MuestreadorRecursos
 
 # ==========================================
 # CONFIGURACIÓN - MODIFICA ESTOS PARÁMETROS
@@ -19,6 +31,11 @@ from io import BytesIO
 # Ruta del archivo CSV de entrada
 file_path = 'drive/MyDrive/DataSet/Visitas_lote_02.csv'
 
+# Formato de la entrada: 'csv', 'ndjson' (JSON Lines, una visita por línea con hits,
+# totals, device... como objetos anidados, p. ej. una exportación de BigQuery) o
+# 'auto' (ndjson si la extensión es .json, .jsonl o .ndjson)
+formato_entrada = 'auto'
+
 # Nombre del archivo de salida
 nombre_archivo_salida = 'visitas_expandidas_completo.csv'
 
@@ -28,22 +45,133 @@ nombre_archivo_outliers = 'visitas_muchos_hits.csv'
 # Umbral para considerar una fila como "con demasiados hits"
 umbral_hits_outliers = 250  # Filas con más hits que este umbral se separarán
 
+# Preescaneo de los bytes crudos para contar los hits de cada visita antes de expandir
+# (máximo exacto, distribución y filas outlier sin interpretar el JSON)
+usar_preescaneo_hits = True
+
+# Salida estándar (--salida -): su cabecera sale con el primer lote y ya no puede
+# ampliarse. Sin preescaneo (stdin) las columnas de hits se reservan hasta
+# umbral_hits_outliers y una columna nueva en un lote posterior detiene la expansión;
+# con una lista fija de columnas (p. ej. la cabecera de una ejecución anterior) se
+# escriben exactamente esas y las demás se descartan con un aviso
+columnas_salida_flujo = None
+
 # Tamaño del lote para procesamiento por partes
 batch_size = 1000  # Procesar 1000 filas a la vez para mantener el uso de memoria bajo
 
+# Salida particionada por fecha (date=YYYYMMDD/part-N.csv + manifest.json) en lugar
+# del archivo principal único. None para escribir un solo archivo
+directorio_salida_particionada = None  # p. ej. 'visitas_expandidas_particionado'
+
 # Indexación de hits (True: empezar desde 1, False: empezar desde 0)
 indexar_desde_uno = True
 
+# Deduplicación de visitas (fullVisitorId + visitId) antes de expandir
+deduplicar_visitas = True
+nombre_almacen_claves = 'claves_visitas.sqlite'  # Almacén exacto de claves en disco
+capacidad_inicial_claves = 1_000_000  # Filtro de Bloom inicial (~1,4 MB al 1%); crece por etapas con las claves
+reiniciar_almacen_claves = True  # False: deduplicar también contra lotes de ejecuciones anteriores
+
+# Tablas de agregados (sesiones, pageviews, transacciones, ingresos) calculadas durante
+# la expansión: nombre -> dimensiones de agrupación. Se escriben como rollup_<nombre>.csv
+dimensiones_rollup = {
+    'fecha': ['date'],
+    'fecha_canal': ['date', 'channelGrouping'],
+    'fecha_dispositivo': ['date', 'device_deviceCategory'],
+    'fecha_pais': ['date', 'geoNetwork_country'],
+}
+prefijo_archivos_rollup = 'rollup_'
+
+# Filtros de filas evaluados antes de expandir (ver filtros_filas.py): las visitas
+# descartadas no llegan a interpretar sus hits. Lista vacía: se expanden todas
+filtros_filas = [
+    # {'columna': 'date', 'tipo': 'rango', 'min': 20170801, 'max': 20170807},
+    # {'columna': 'channelGrouping', 'tipo': 'en', 'valores': ['Organic Search', 'Direct']},
+    # {'columna': 'totals_bounces', 'tipo': 'nulo'},  # Sesiones sin rebote
+]
+
+# Poda de columnas sin información (siempre vacías o constantes): se registran en
+# <salida>.columnas.json para que la limpieza no las lea ni las escriba
+podar_columnas = True
+proporcion_minima_valores = 0.0  # > 0: podar también las columnas con menos valores que esta proporción
+
+# Progreso: una sola barra para toda la ejecución, redibujada como mucho cada
+# intervalo_progreso segundos; solo los primeros outliers se anuncian uno a uno
+intervalo_progreso = 5.0
+max_avisos_outliers = 20
+
+# Telemetría de recursos: segundos entre muestras (None para desactivarla)
+intervalo_telemetria = 1.0
+nombre_archivo_telemetria = 'telemetria_expansion.csv'  # Serie temporal de RSS, CPU, E/S y pausas del GC
+nombre_archivo_metricas_prometheus = 'telemetria_expansion.prom'  # Instantánea para el textfile collector
+
+# Muestreo aleatorio de todo el archivo (no solo de sus primeras filas)
+filas_muestra_deteccion = 500  # Filas usadas para detectar las columnas JSON
+muestra_desarrollo = None  # N: ejecución rápida sobre N visitas al azar estratificadas por fecha (o --muestra N)
+semilla_muestra = 42  # Semilla del muestreo (None para una muestra distinta en cada ejecución)
+
 # ==========================================
 # FIN DE LA CONFIGURACIÓN
 # ==========================================
 
+# Ruta que indica entrada o salida estándar (modo tubería: zstdcat ... | python finalcsv.py
+# --entrada - --salida - | python limpiezaFinal.py --entrada - --salida - > limpio.csv)
+FLUJO_ESTANDAR = '-'
+EXTENSIONES_NDJSON = ('.json', '.jsonl', '.ndjson')
+
+# Argumentos de línea de comandos (sobrescriben la configuración; los desconocidos,
+# como los que añade Jupyter, se ignoran)
+parser = argparse.ArgumentParser(description="Paso 1: expansión JSON del dataset de visitas")
+parser.add_argument('--entrada', default=file_path, help="CSV de entrada ('-' para leer de stdin)")
+parser.add_argument('--formato', choices=['auto', 'csv', 'ndjson'], default=formato_entrada,
+                    help="formato de la entrada (auto: por la extensión; stdin se lee como CSV)")
+parser.add_argument('--salida', default=nombre_archivo_salida,
+                    help="CSV expandido ('-' para escribir en stdout; los mensajes van a stderr)")
+parser.add_argument('--muestra', '--sample', type=int, default=muestra_desarrollo, metavar='N',
+                    help="procesa solo N visitas al azar de todo el archivo (estratificadas por fecha)")
+parser.add_argument('--semilla', type=int, default=semilla_muestra, help="semilla del muestreo")
+argumentos, _ = parser.parse_known_args()
+file_path, nombre_archivo_salida = argumentos.entrada, argumentos.salida
+muestra_desarrollo, semilla_muestra = argumentos.muestra, argumentos.semilla
+formato_entrada = argumentos.formato
+if formato_entrada == 'auto':
+    formato_entrada = 'ndjson' if file_path.lower().endswith(EXTENSIONES_NDJSON) else 'csv'
+
+# Con la salida en stdout, los datos se escriben en el flujo original y todos los
+# mensajes (print) se desvían a stderr para no mezclarse con el CSV
+salida_datos = nombre_archivo_salida
+if nombre_archivo_salida == FLUJO_ESTANDAR:
+    salida_datos = sys.stdout
+    sys.stdout = sys.stderr
+
+if muestra_desarrollo and file_path == FLUJO_ESTANDAR:
+    print("El modo muestra necesita un archivo de entrada; se ignora con la entrada estándar")
+    muestra_desarrollo = None
+if muestra_desarrollo and formato_entrada == 'ndjson':
+    print("El modo muestra solo admite entradas CSV; se ignora con JSON Lines")
+    muestra_desarrollo = None
+
+if muestra_desarrollo:
+    # Ejecución de desarrollo: la entrada se sustituye por una muestra y las salidas
+    # llevan el sufijo _muestra para no pisar las del dataset completo
+    archivo_muestra = ruta_muestra(os.path.basename(file_path))
+    filas_muestra = escribir_muestra(file_path, archivo_muestra, muestra_desarrollo, estratificar_por='date',
+                                     semilla=semilla_muestra)
+    print(f"Modo muestra: {filas_muestra} visitas de {file_path} copiadas a {archivo_muestra}")
+    file_path = archivo_muestra
+    if salida_datos is nombre_archivo_salida:
+        nombre_archivo_salida = salida_datos = ruta_muestra(nombre_archivo_salida)
+    nombre_archivo_outliers = ruta_muestra(nombre_archivo_outliers)
+    if directorio_salida_particionada:
+        directorio_salida_particionada = directorio_salida_particionada + '_muestra'
+
 print(f"Procesamiento completo iniciado: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-print(f"Archivo de entrada: {file_path}")
+print(f"Archivo de entrada: {file_path} ({formato_entrada})")
 print(f"Archivo de salida principal: {nombre_archivo_salida}")
 print(f"Archivo de salida para outliers: {nombre_archivo_outliers}")
 print(f"Umbral de hits para outliers: {umbral_hits_outliers}")
 print(f"Indexación de hits: Comienza desde {'1' if indexar_desde_uno else '0'}")
+print(f"Deduplicación de visitas: {'activada' if deduplicar_visitas else 'desactivada'}")
 
 # Función para normalizar JSON (reemplaza comillas simples por dobles)
 def normalizar_json(texto_json):
@@ -84,6 +212,29 @@ def normalizar_json(texto_json):
             # En caso de error, devolver el original
             return texto_json
 
+# Planes de aplanado: cada nombre de columna (hit, clave y subclave) se construye
+# una sola vez, se interna y queda en caché; en el bucle caliente solo se busca la
+# clave en el plan. Las filas comparten así los mismos objetos de nombre, lo que
+# reduce la memoria de los lotes y acelera la construcción del DataFrame.
+_planes_hits = {}  # {(columna, desplazamiento): [plan del hit 0, plan del hit 1, ...]}
+_nombres_columnas = {}  # {prefijo: {clave: nombre}} para las columnas JSON que no son hits
+
+def _planes_columna_hits(columna, desplazamiento):
+    """Lista de planes por posición de hit; cada plan es {clave: ranura}"""
+    return _planes_hits.setdefault((columna, desplazamiento), [])
+
+def _nueva_ranura(prefix, k, item_index):
+    """Nombres de una clave de hit: [simple, contador, {subclave: nombre}, {clave de item: nombre}, prefijos]"""
+    return [sys.intern(f"{prefix}{k}"), sys.intern(f"{prefix}{k}_count"), {}, {},
+            f"{prefix}{k}_", f"{prefix}{k}_{item_index}_"]
+
+def _nombres_prefijo(prefijo):
+    """Caché {clave: nombre internado} de un prefijo de columna"""
+    nombres = _nombres_columnas.get(prefijo)
+    if nombres is None:
+        nombres = _nombres_columnas[prefijo] = {}
+    return nombres
+
 # Función para expandir filas JSON
 def expandir_fila_json(fila, columnas_json, indexar_desde_uno=True):
     """
@@ -91,14 +242,14 @@ def expandir_fila_json(fila, columnas_json, indexar_desde_uno=True):
     con los valores expandidos, adaptándose al número de hits en cada fila.
 
     Args:
-        fila: La fila a expandir
-        columnas_json: Lista de columnas que contienen datos JSON
+        fila: La fila a expandir (Series del CSV o diccionario de una visita JSON Lines)
+        columnas_json: Columnas (lista o dict) que contienen datos JSON
         indexar_desde_uno: Si es True, los hits se indexarán desde 1 (hit_1, hit_2, ...),
                           en lugar de desde 0 (hit_0, hit_1, ...)
     """
     # Crear un diccionario con los valores actuales (no-JSON)
     resultado = {}
-    for col in fila.index:
+    for col in fila.keys():
         if col not in columnas_json:
             resultado[col] = fila[col]
 
@@ -144,35 +295,53 @@ def expandir_fila_json(fila, columnas_json, indexar_desde_uno=True):
                     hits_count = len(datos)
                     resultado[f"{columna}_count"] = hits_count
 
+                    # Usar índice 1 o 0 según configuración para hits e items de listas
+                    desplazamiento = 1 if indexar_desde_uno else 0
+                    planes = _planes_columna_hits(columna, desplazamiento)
+
                     # Para cada hit en la lista
                     for i, hit in enumerate(datos):
                         if isinstance(hit, dict):
-                            # Crear un prefijo para este hit específico, con índice ajustado si es necesario
-                            hit_index = i + 1 if indexar_desde_uno else i
-                            prefix = f"{columna}_{hit_index}_"
+                            # Plan con los nombres de columna de esta posición de hit
+                            while len(planes) <= i:
+                                planes.append({})
+                            plan = planes[i]
+                            prefix = None
 
                             # Procesar cada clave en el hit
                             for k, v in hit.items():
+                                ranura = plan.get(k)
+                                if ranura is None:
+                                    if prefix is None:
+                                        prefix = f"{columna}_{i + desplazamiento}_"
+                                    ranura = plan[k] = _nueva_ranura(prefix, k, desplazamiento)
+
                                 # Valores anidados: diccionarios
                                 if isinstance(v, dict):
+                                    nombres = ranura[2]
                                     for sub_k, sub_v in v.items():
-                                        resultado[f"{prefix}{k}_{sub_k}"] = sub_v
+                                        nombre = nombres.get(sub_k)
+                                        if nombre is None:
+                                            nombre = nombres[sub_k] = sys.intern(f"{ranura[4]}{sub_k}")
+                                        resultado[nombre] = sub_v
 
                                 # Valores anidados: listas
                                 elif isinstance(v, list) and len(v) > 0:
                                     # Guardar longitud de la lista
-                                    resultado[f"{prefix}{k}_count"] = len(v)
+                                    resultado[ranura[1]] = len(v)
 
                                     # Para listas de diccionarios, procesar el primero
-                                    if v and isinstance(v[0], dict):
-                                        # Usar índice 1 o 0 según configuración
-                                        item_index = 1 if indexar_desde_uno else 0
+                                    if isinstance(v[0], dict):
+                                        nombres = ranura[3]
                                         for item_k, item_v in v[0].items():
-                                            resultado[f"{prefix}{k}_{item_index}_{item_k}"] = item_v
+                                            nombre = nombres.get(item_k)
+                                            if nombre is None:
+                                                nombre = nombres[item_k] = sys.intern(f"{ranura[5]}{item_k}")
+                                            resultado[nombre] = item_v
 
                                 # Valores simples
                                 else:
-                                    resultado[f"{prefix}{k}"] = v
+                                    resultado[ranura[0]] = v
 
                 continue
 
@@ -192,8 +361,12 @@ def expandir_fila_json(fila, columnas_json, indexar_desde_uno=True):
             # Si es un diccionario
             if isinstance(datos, dict):
                 # Añadir cada clave-valor al resultado
+                nombres = _nombres_prefijo(f"{columna}_")
                 for k, v in datos.items():
-                    resultado[f"{columna}_{k}"] = v
+                    nombre = nombres.get(k)
+                    if nombre is None:
+                        nombre = nombres[k] = sys.intern(f"{columna}_{k}")
+                    resultado[nombre] = v
 
             # Si es una lista
             elif isinstance(datos, list) and len(datos) > 0:
@@ -207,8 +380,12 @@ def expandir_fila_json(fila, columnas_json, indexar_desde_uno=True):
                     # Añadir cada clave-valor del primer elemento al resultado
                     # Usar índice 1 o 0 según configuración
                     item_index = 1 if indexar_desde_uno else 0
+                    nombres = _nombres_prefijo(f"{columna}_item{item_index}_")
                     for k, v in primer_elem.items():
-                        resultado[f"{columna}_item{item_index}_{k}"] = v
+                        nombre = nombres.get(k)
+                        if nombre is None:
+                            nombre = nombres[k] = sys.intern(f"{columna}_item{item_index}_{k}")
+                        resultado[nombre] = v
 
         except Exception:
             continue
@@ -217,12 +394,13 @@ def expandir_fila_json(fila, columnas_json, indexar_desde_uno=True):
 
 # Función para determinar el máximo número de hits en el dataset
 
-def encontrar_max_hits(file_path, sample_size=5000, encoding='utf-8'):
-    print(f"\nAnalizando estructura de hits en el dataset (muestra de {sample_size} filas)...")
+def encontrar_max_hits(file_path, sample_size=5000, encoding='utf-8', semilla=None):
+    print(f"\nAnalizando estructura de hits en el dataset (muestra aleatoria de {sample_size} filas)...")
 
-    # Leer una muestra del dataset para analizar estructura
+    # Leer una muestra de todo el dataset (estratificada por fecha) para analizar estructura
     try:
-        df_muestra = pd.read_csv(file_path, nrows=sample_size, encoding=encoding)
+        df_muestra = leer_muestra(file_path, sample_size, estratificar_por='date', semilla=semilla,
+                                  encoding=encoding)
     except Exception as e:
         print(f"Error al leer muestra para análisis de hits: {e}")
         return 0, False
@@ -411,57 +589,171 @@ def generar_reporte_hits(conteo_hits, filas_outliers):
     return html
 
 # Función para procesar el dataset en lotes con seguimiento del máximo de hits
+def leer_lotes_ndjson(origen, batch_size):
+    """
+    Lee visitas JSON Lines (una por línea) en lotes de pares (índice, visita), con
+    los campos anidados ya convertidos en diccionarios y listas. El índice cuenta
+    las líneas no vacías desde 0, como el índice global del lector CSV; las líneas
+    que no son un objeto JSON válido se descartan con un aviso.
+    """
+    lote = []
+    indice = 0
+    for linea in origen:
+        if not linea.strip():
+            continue
+        try:
+            visita = json.loads(linea)
+        except ValueError:
+            visita = None
+        if isinstance(visita, dict):
+            lote.append((indice, visita))
+        else:
+            print(f"Línea {indice + 1} descartada: no es un objeto JSON válido")
+        indice += 1
+        if len(lote) >= batch_size:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
 def procesar_dataset_en_lotes(file_path, output_path, output_outliers_path, batch_size=1000,
-                              umbral_hits=250, indexar_desde_uno=True):
+                              umbral_hits=250, indexar_desde_uno=True, almacen_claves=None,
+                              agregador_rollups=None, escritor_particionado=None, filas_muestra=500,
+                              semilla=None, filas_preescaneo=None, formato='csv', seguimiento_columnas=None,
+                              filtros=None, intervalo_progreso=5.0, max_avisos_outliers=20, max_hits_salida=None,
+                              columnas_flujo=None):
+    """
+    Expande el dataset por lotes. Si se pasa almacen_claves (AlmacenClavesVisitas),
+    las visitas repetidas (mismo fullVisitorId + visitId) se descartan antes de expandir.
+    Si se pasa agregador_rollups (AgregadorRollups), cada lote expandido se agrega a
+    sus tablas de resumen sin una pasada extra sobre los datos. Si se pasa
+    escritor_particionado (EscritorParticionado), las filas normales se reparten por
+    fecha en lugar de escribirse en output_path. Las columnas JSON se detectan con
+    una muestra aleatoria de filas_muestra filas de todo el archivo. file_path puede
+    ser '-' (entrada estándar, una sola pasada) y output_path un flujo abierto (stdout). Las
+    filas van al archivo de outliers según los hits de cada fila expandida; si se
+    pasa filas_preescaneo (las visitas que contó preescanear_hits), se avisa cuando
+    no coinciden con las leídas. Con formato='ndjson' la
+    entrada es JSON Lines: los objetos anidados pasan directamente a la expansión,
+    sin deshacer el entrecomillado CSV ni interpretarlos con ast.literal_eval. Si se
+    pasa seguimiento_columnas (SeguimientoColumnas), se le agregan las filas normales
+    escritas para saber al final qué columnas quedaron vacías o constantes. Si se
+    pasan filtros (lista de filtros_filas.py), las visitas que no los cumplen se
+    descartan sobre el lote crudo, antes de la deduplicación y la expansión. El
+    progreso se muestra en una única barra actualizada como mucho cada
+    intervalo_progreso segundos, y solo se anuncian los primeros max_avisos_outliers
+    outliers (el resto se cuenta en la barra). Todas las filas de cada archivo se
+    escriben con las mismas columnas (columnas_salida.py); con max_hits_salida (el
+    máximo de hits del archivo principal según el preescaneo) el ancho de hits del
+    archivo principal se fija desde el primer lote. Si output_path es un flujo, sin
+    max_hits_salida se reservan los hits hasta umbral_hits y, con columnas_flujo,
+    se escribe exactamente esa lista de columnas.
+
+    Returns:
+        (filas procesadas, columnas generadas, máximo de hits, conteo de hits por fila,
+         filas outlier, visitas duplicadas descartadas, visitas descartadas por los filtros)
+    """
     print(f"\nProcesando dataset completo en lotes de {batch_size} filas...")
 
-    # Primero, contar el número total de filas con la codificación adecuada
-    print("Contando filas totales...")
-    try:
-        # Intentar con UTF-8 primero (codificación común)
-        total_filas = sum(1 for _ in open(file_path, 'r', encoding='utf-8')) - 1
+    # Columnas que identifican una visita; se leen como texto para comparar los IDs exactos
+    columnas_clave = ['fullVisitorId', 'visitId']
+    tipos_lectura = {col: str for col in columnas_clave} if almacen_claves is not None else None
+
+    es_flujo = file_path == FLUJO_ESTANDAR
+    es_ndjson = formato == 'ndjson'
+    if es_ndjson:
+        # JSON Lines: las columnas JSON son las que traen objetos o listas; se
+        # acumulan visita a visita (en orden de aparición) en lugar de muestrearse
+        encoding_usado = 'utf-8'
+        if es_flujo:
+            total_filas = None
+            origen = sys.stdin.buffer
+        else:
+            print("Contando visitas totales...")
+            with open(file_path, 'rb') as f:
+                total_filas = sum(1 for linea in f if linea.strip())
+            print(f"Total de filas a procesar: {total_filas}")
+            origen = open(file_path, 'rb')
+        reader = leer_lotes_ndjson(origen, batch_size)
+    elif es_flujo:
+        # Entrada estándar: una sola pasada hacia delante, sin conteo previo ni muestreo;
+        # las columnas JSON se detectan con el primer lote
+        total_filas = None
         encoding_usado = 'utf-8'
-    except UnicodeDecodeError:
+        reader = pd.read_csv(sys.stdin.buffer, chunksize=batch_size, encoding=encoding_usado, dtype=tipos_lectura)
+        primer_chunk = next(reader, None)
+        if primer_chunk is None:
+            print("La entrada estándar está vacía")
+            return 0, 0, 0, [], [], 0, 0
+        muestra = primer_chunk.head(filas_muestra)
+        reader = itertools.chain([primer_chunk], reader)
+    else:
+        # Primero, contar el número total de filas con la codificación adecuada
+        print("Contando filas totales...")
         try:
-            # Si falla, intentar con Latin-1 (que acepta cualquier byte)
-            total_filas = sum(1 for _ in open(file_path, 'r', encoding='latin-1')) - 1
-            encoding_usado = 'latin-1'
-        except Exception as e:
-            print(f"Error al contar líneas: {e}")
-            return 0, 0, 0, [], []
-
-    print(f"Total de filas a procesar: {total_filas}")
-    print(f"Codificación detectada: {encoding_usado}")
-
-    # Detectar columnas JSON usando la primera fila
-    try:
-        primera_fila = pd.read_csv(file_path, nrows=1, encoding=encoding_usado).iloc[0]
-    except Exception as e:
-        print(f"Error al leer la primera fila: {e}")
-        return 0, 0, 0, [], []
-
-    columnas_json = []
+            # Intentar con UTF-8 primero (codificación común)
+            total_filas = sum(1 for _ in open(file_path, 'r', encoding='utf-8')) - 1
+            encoding_usado = 'utf-8'
+        except UnicodeDecodeError:
+            try:
+                # Si falla, intentar con Latin-1 (que acepta cualquier byte)
+                total_filas = sum(1 for _ in open(file_path, 'r', encoding='latin-1')) - 1
+                encoding_usado = 'latin-1'
+            except Exception as e:
+                print(f"Error al contar líneas: {e}")
+                return 0, 0, 0, [], [], 0, 0
 
-    for columna in primera_fila.index:
-        valor = primera_fila[columna]
-        # Convertir a string para evaluar
-        valor_str = str(valor)
+        print(f"Total de filas a procesar: {total_filas}")
 
-        # Detectar posibles valores JSON
-        if isinstance(valor, str) and (
-            (valor_str.startswith('{') and valor_str.endswith('}')) or
-            (valor_str.startswith('[') and valor_str.endswith(']'))
-        ):
-            columnas_json.append(columna)
+        # Detectar columnas JSON con una muestra aleatoria de todo el archivo (la primera
+        # fila puede tener nulos en columnas que sí son JSON)
+        try:
+            muestra = leer_muestra(file_path, filas_muestra, semilla=semilla, encoding=encoding_usado, dtype=str)
+        except Exception as e:
+            print(f"Error al leer la muestra para detectar columnas JSON: {e}")
+            return 0, 0, 0, [], [], 0, 0
 
-    print(f"Columnas JSON detectadas: {', '.join(columnas_json)}")
+        # Inicializar lector de CSV para procesar por lotes
+        reader = pd.read_csv(file_path, chunksize=batch_size, encoding=encoding_usado, dtype=tipos_lectura)
 
-    # Inicializar lector de CSV para procesar por lotes
-    reader = pd.read_csv(file_path, chunksize=batch_size, encoding=encoding_usado)
+    print(f"Codificación detectada: {encoding_usado}")
 
-    # Para el primer lote, crearemos los archivos y escribiremos los encabezados
-    first_batch_normal = True
-    first_batch_outliers = True
+    columnas_json = {}  # Dict en lugar de set: orden de columnas estable entre ejecuciones
+
+    if not es_ndjson:
+        for columna in muestra.columns:
+            valores = muestra[columna].dropna().astype(str)
+
+            # Detectar posibles valores JSON: todos los valores no nulos de la muestra lo parecen
+            if len(valores) > 0 and (
+                (valores.str.startswith('{') & valores.str.endswith('}')) |
+                (valores.str.startswith('[') & valores.str.endswith(']'))
+            ).all():
+                columnas_json[columna] = None
+
+        print(f"Columnas JSON detectadas: {', '.join(columnas_json)}")
+
+    filtros = compilar_filtros(filtros)
+    if filtros and not es_ndjson:
+        verificar_columnas(filtros, muestra.columns)
+        print(f"Filtros de filas: {', '.join(filtro['columna'] for filtro in filtros)}")
+
+    if almacen_claves is not None and not es_ndjson and not all(col in muestra.columns for col in columnas_clave):
+        print(f"Deduplicación desactivada: faltan las columnas {', '.join(columnas_clave)}")
+        almacen_claves = None
+
+    # Columnas comunes para todos los lotes de cada archivo (la cabecera sale con el primero)
+    desplazamiento_hits = 1 if indexar_desde_uno else 0
+    if hasattr(output_path, 'write'):
+        if max_hits_salida is None:
+            # La cabecera del flujo no se puede ampliar: todas las posiciones de hit que
+            # pueden llegar al archivo principal (las de más hits van a los outliers)
+            max_hits_salida = umbral_hits
+    else:
+        columnas_flujo = None
+    escritor_normal = EscritorCSVAlineado(output_path, encoding_usado, max_hits_salida, desplazamiento_hits,
+                                          columnas_flujo)
+    escritor_outliers = EscritorCSVAlineado(output_outliers_path, encoding_usado)
     total_filas_procesadas = 0
 
     # Para registrar todas las columnas que hemos visto
@@ -474,18 +766,58 @@ def procesar_dataset_en_lotes(file_path, output_path, output_outliers_path, batc
     conteo_hits_por_fila = []
     filas_outliers = []
     fila_actual = 0  # Para llevar la cuenta del número real de fila en el dataset
+    duplicados_descartados = 0
+    filtradas_descartadas = 0
+
+    # Una sola barra de progreso para todos los lotes (avanza por lote, no por fila)
+    barra = tqdm(total=total_filas, desc="Expandiendo filas", unit="filas", mininterval=intervalo_progreso)
 
     # Procesar cada lote
     for i, chunk in enumerate(reader):
-        print(f"\nProcesando lote {i+1} ({total_filas_procesadas}/{total_filas} filas)...")
-
         # Listas para almacenar filas expandidas
         filas_expandidas_normal = []
         filas_expandidas_outliers = []
 
+        total_filas_procesadas += len(chunk)
+        filas_leidas_lote = len(chunk)
+
+        # Descartar las visitas que no cumplen los filtros sobre el lote crudo
+        if filtros and len(chunk):
+            cumplen = mascara_filtros(tabla_filtros(chunk, filtros, es_ndjson), filtros).to_numpy()
+            if not cumplen.all():
+                filtradas_descartadas += len(chunk) - int(cumplen.sum())
+                if es_ndjson:
+                    chunk = [par for par, cumple in zip(chunk, cumplen) if cumple]
+                else:
+                    chunk = chunk[cumplen]
+
+        # Descartar visitas ya vistas (en este lote o en anteriores) antes de expandir
+        if almacen_claves is not None:
+            if es_ndjson:
+                claves = pd.Series([
+                    '|'.join('' if visita.get(col) is None else str(visita[col]) for col in columnas_clave)
+                    for _, visita in chunk
+                ])
+            else:
+                claves = chunk['fullVisitorId'].fillna('') + '|' + chunk['visitId'].fillna('')
+            nuevas = almacen_claves.filtrar_nuevas(claves)
+            if not nuevas.all():
+                duplicados_descartados += len(chunk) - int(nuevas.sum())
+                if es_ndjson:
+                    chunk = [par for par, nueva in zip(chunk, nuevas) if nueva]
+                else:
+                    chunk = chunk[nuevas]
+
         # Procesar cada fila en el lote actual
-        for _, fila in tqdm(chunk.iterrows(), total=len(chunk), desc="Expandiendo filas"):
-            fila_actual += 1  # Incrementar contador de fila
+        filas_lote = chunk if es_ndjson else chunk.iterrows()
+        for indice, fila in filas_lote:
+            fila_actual = indice + 1  # Número real de fila en el dataset (el índice del lector es global)
+
+            if es_ndjson:
+                for col, valor in fila.items():
+                    if isinstance(valor, (dict, list)) and col not in columnas_json:
+                        columnas_json[col] = None
+                        barra.write(f"Columna JSON detectada: {col}")
 
             fila_expandida = expandir_fila_json(fila, columnas_json, indexar_desde_uno)
 
@@ -498,11 +830,16 @@ def procesar_dataset_en_lotes(file_path, output_path, output_outliers_path, batc
                 if hits_count > max_hits_global:
                     max_hits_global = hits_count
 
-            # Separar filas con muchos hits
+            # Separar filas con muchos hits (por los hits de la propia fila, no por su
+            # posición en el preescaneo: una diferencia al separar registros desplazaría
+            # todas las filas siguientes)
             if hits_count > umbral_hits:
                 filas_expandidas_outliers.append(fila_expandida)
                 filas_outliers.append((fila_actual, hits_count))
-                print(f"Outlier detectado: Fila {fila_actual} con {hits_count} hits")
+                if len(filas_outliers) <= max_avisos_outliers:
+                    barra.write(f"Outlier detectado: Fila {fila_actual} con {hits_count} hits")
+                if len(filas_outliers) == max_avisos_outliers:
+                    barra.write("Siguientes outliers sin aviso individual (ver el resumen final)")
             else:
                 filas_expandidas_normal.append(fila_expandida)
 
@@ -512,43 +849,137 @@ def procesar_dataset_en_lotes(file_path, output_path, output_outliers_path, batc
         # Guardar filas normales en el archivo CSV principal
         if filas_expandidas_normal:
             df_expandido_normal = pd.DataFrame(filas_expandidas_normal)
+            if agregador_rollups is not None:
+                agregador_rollups.actualizar(df_expandido_normal)
+            if seguimiento_columnas is not None:
+                seguimiento_columnas.actualizar(df_expandido_normal)
 
-            if first_batch_normal:
-                df_expandido_normal.to_csv(output_path, index=False, encoding=encoding_usado)
-                first_batch_normal = False
+            if escritor_particionado is not None:
+                escritor_particionado.escribir(df_expandido_normal)
             else:
-                df_expandido_normal.to_csv(output_path, mode='a', header=False, index=False, encoding=encoding_usado)
+                escritor_normal.escribir(df_expandido_normal)
 
         # Guardar outliers en archivo separado
         if filas_expandidas_outliers:
             df_expandido_outliers = pd.DataFrame(filas_expandidas_outliers)
-
-            if first_batch_outliers:
-                df_expandido_outliers.to_csv(output_outliers_path, index=False, encoding=encoding_usado)
-                first_batch_outliers = False
-            else:
-                df_expandido_outliers.to_csv(output_outliers_path, mode='a', header=False, index=False, encoding=encoding_usado)
-
-        total_filas_procesadas += len(chunk)
-        print(f"Progreso: {total_filas_procesadas}/{total_filas} filas ({(total_filas_procesadas/total_filas)*100:.1f}%)")
-        print(f"Máximo número de hits hasta ahora: {max_hits_global}")
+            if agregador_rollups is not None:
+                agregador_rollups.actualizar(df_expandido_outliers)
+
+            escritor_outliers.escribir(df_expandido_outliers)
+
+        barra.set_postfix(lote=i + 1, max_hits=max_hits_global, outliers=len(filas_outliers),
+                          duplicados=duplicados_descartados, refresh=False)
+        barra.update(filas_leidas_lote)
+
+    barra.close()
+    if es_ndjson and not es_flujo:
+        origen.close()
+    if filas_preescaneo is not None and filas_preescaneo != total_filas_procesadas:
+        print(f"Aviso: el preescaneo contó {filas_preescaneo} visitas y se leyeron {total_filas_procesadas}; "
+              "su máximo de hits puede no corresponder a las filas leídas (las columnas de hits que falten "
+              "se añaden al realinear y los outliers se decidieron con los hits de cada fila)")
+
+    # Columnas aparecidas después de la cabecera: una sola reescritura por archivo
+    for escritor, nombre in ((escritor_normal, "principal"), (escritor_outliers, "de outliers")):
+        if escritor.columnas_cabecera and len(escritor.columnas) > escritor.columnas_cabecera:
+            print(f"Realineando el archivo {nombre}: {len(escritor.columnas) - escritor.columnas_cabecera} "
+                  "columnas aparecieron después de la cabecera")
+        escritor.cerrar()
+        if escritor.omitidas:
+            print(f"Aviso: {len(escritor.omitidas)} columnas no están en la lista fija del archivo {nombre} "
+                  f"y no se escribieron: {', '.join(escritor.omitidas[:10])}")
+    if seguimiento_columnas is not None:
+        # Columnas planificadas que ningún lote trajo: vacías en todas las filas
+        seguimiento_columnas.registrar_columnas(escritor_normal.columnas)
 
     print(f"\nTotal de columnas generadas: {len(todas_columnas)}")
     print(f"\nFilas separadas por exceso de hits: {len(filas_outliers)}")
+    if almacen_claves is not None:
+        print(f"Visitas duplicadas descartadas: {duplicados_descartados}")
+    if filtros:
+        print(f"Visitas descartadas por los filtros: {filtradas_descartadas}")
 
-    return total_filas_procesadas, len(todas_columnas), max_hits_global, conteo_hits_por_fila, filas_outliers
+    return (total_filas_procesadas, len(todas_columnas), max_hits_global, conteo_hits_por_fila,
+            filas_outliers, duplicados_descartados, filtradas_descartadas)
 
 # Ejecutar el procesamiento completo
 inicio = datetime.now()
 print(f"Hora de inicio: {inicio.strftime('%Y-%m-%d %H:%M:%S')}")
 
-total_filas, total_columnas, max_hits, conteo_hits, filas_outliers = procesar_dataset_en_lotes(
-    file_path, nombre_archivo_salida, nombre_archivo_outliers, batch_size, umbral_hits_outliers, indexar_desde_uno
-)
+# Muestreo de recursos en segundo plano mientras dura la expansión
+telemetria = None
+if intervalo_telemetria:
+    telemetria = MuestreadorRecursos(intervalo_telemetria, nombre_archivo_telemetria,
+                                     nombre_archivo_metricas_prometheus, etapa="expansion").iniciar()
+
+# Almacén de claves de visita para la deduplicación
+almacen_claves = None
+if deduplicar_visitas:
+    almacen_claves = AlmacenClavesVisitas(nombre_almacen_claves, capacidad_inicial_claves,
+                                          reiniciar=reiniciar_almacen_claves)
+
+# Agregados incrementales para los dashboards
+agregador_rollups = AgregadorRollups(dimensiones_rollup) if dimensiones_rollup else None
+
+# Salida particionada por fecha (opcional)
+escritor_particionado = None
+if directorio_salida_particionada:
+    escritor_particionado = EscritorParticionado(directorio_salida_particionada, columna_particion='date')
+
+# Seguimiento de columnas vacías y constantes (solo con un archivo de salida junto al
+# que dejar la lista para la limpieza)
+seguimiento_columnas = None
+if podar_columnas and escritor_particionado is None and salida_datos is nombre_archivo_salida:
+    seguimiento_columnas = SeguimientoColumnas(vacios_como_nulos=True)
+
+try:
+    # Preescaneo de hits: ancho de la salida y distribución conocidos antes de expandir
+    preescaneo = None
+    if usar_preescaneo_hits and file_path == FLUJO_ESTANDAR:
+        print("\nPreescaneo de hits omitido: la entrada estándar solo puede leerse una vez")
+    elif usar_preescaneo_hits:
+        print("\nPreescaneando el número de hits por visita...")
+        inicio_preescaneo = datetime.now()
+        preescaneo = preescanear_hits(file_path, umbral_hits_outliers, formato_entrada)
+        print(f"Visitas: {preescaneo['filas']} | Máximo de hits: {preescaneo['max_hits']} | "
+              f"Máximo en el archivo principal: {preescaneo['max_hits_normales']} | "
+              f"Outliers (> {umbral_hits_outliers} hits): {len(preescaneo['outliers'])} "
+              f"({(datetime.now() - inicio_preescaneo).total_seconds():.2f} s)")
+        distribucion = sorted(preescaneo['distribucion'].items(), key=lambda x: x[1], reverse=True)
+        print("Hits por visita más frecuentes: " + ", ".join(f"{hits} ({filas})" for hits, filas in distribucion[:10]))
+
+    (total_filas, total_columnas, max_hits, conteo_hits, filas_outliers, duplicados,
+     filtradas) = procesar_dataset_en_lotes(
+        file_path, salida_datos, nombre_archivo_outliers, batch_size, umbral_hits_outliers, indexar_desde_uno,
+        almacen_claves, agregador_rollups, escritor_particionado, filas_muestra_deteccion, semilla_muestra,
+        preescaneo['filas'] if preescaneo is not None else None, formato_entrada, seguimiento_columnas,
+        filtros_filas, intervalo_progreso, max_avisos_outliers,
+        preescaneo['max_hits_normales'] if preescaneo is not None else None, columnas_salida_flujo
+    )
+finally:
+    if salida_datos is not nombre_archivo_salida:
+        salida_datos.flush()
+    if telemetria is not None:
+        telemetria.detener()
+    if almacen_claves is not None:
+        almacen_claves.cerrar()
+    if escritor_particionado is not None:
+        manifiesto = escritor_particionado.cerrar()
 
 fin = datetime.now()
 tiempo_total = fin - inicio
 
+# Columnas que la limpieza no necesita leer
+columnas_podadas = {}
+if seguimiento_columnas is not None and os.path.exists(nombre_archivo_salida):
+    columnas_podadas = seguimiento_columnas.columnas_podables(proporcion_minima_valores)
+    seguimiento_columnas.guardar(nombre_archivo_salida, columnas_podadas)
+
+# Escribir las tablas de agregados
+archivos_rollup = {}
+if agregador_rollups is not None:
+    archivos_rollup = agregador_rollups.escribir(prefijo_archivos_rollup)
+
 # Generar reporte HTML
 if conteo_hits:
     print("\nGenerando reporte visual de la distribución de hits...")
@@ -568,12 +999,40 @@ print(f"Total de filas procesadas: {total_filas}")
 print(f"Total de columnas generadas: {total_columnas}")
 print(f"Máximo número de hits por fila: {max_hits}")
 print(f"Filas con hits > {umbral_hits_outliers}: {len(filas_outliers)}")
+if filtros_filas:
+    print(f"Visitas descartadas por los filtros: {filtradas}")
 print(f"Hits indexados desde: {'1' if indexar_desde_uno else '0'}")
+if seguimiento_columnas is not None:
+    motivos = {}
+    for motivo in columnas_podadas.values():
+        motivos[motivo] = motivos.get(motivo, 0) + 1
+    print(f"Columnas sin información: {len(columnas_podadas)}"
+          + (f" ({', '.join(f'{motivo}: {n}' for motivo, n in motivos.items())})" if motivos else ""))
+if almacen_claves is not None:
+    resumen_dedup = almacen_claves.resumen()
+    print(f"Visitas duplicadas descartadas: {duplicados}")
+    print(f"Claves de visita almacenadas: {resumen_dedup['claves_almacenadas']} "
+          f"(filtro de Bloom: {resumen_dedup['memoria_filtro_mb']} MB, "
+          f"consultas a disco: {resumen_dedup['consultas_disco']}, "
+          f"falsos positivos: {resumen_dedup['falsos_positivos_bloom']})")
+    if resumen_dedup['claves_desincronizadas']:
+        print(f"Aviso: {resumen_dedup['claves_desincronizadas']} claves ya almacenadas no estaban en el filtro "
+              "de Bloom (se reconstruyó)")
 print(f"Tiempo de procesamiento: {tiempo_total}")
 
+if telemetria is not None:
+    resumen_telemetria = telemetria.resumen()
+    print(f"Memoria máxima utilizada: {resumen_telemetria['memoria_pico_gb']:.2f} GB")
+    print(f"CPU promedio: {resumen_telemetria['cpu_promedio_porcentaje']:.1f}%")
+    print(f"Pausas del GC: {resumen_telemetria['gc_pausas']} "
+          f"(total {resumen_telemetria['gc_pausa_total_ms']:.1f} ms, máxima {resumen_telemetria['gc_pausa_max_ms']:.1f} ms)")
+
 # Tamaño de los archivos resultantes
-tamaño_mb_normal = os.path.getsize(nombre_archivo_salida) / (1024 * 1024)
-print(f"Tamaño del archivo principal: {tamaño_mb_normal:.2f} MB")
+if escritor_particionado is not None:
+    print(f"Particiones generadas: {len(manifiesto['particiones'])} ({manifiesto['total_filas']} filas)")
+elif os.path.exists(nombre_archivo_salida):
+    tamaño_mb_normal = os.path.getsize(nombre_archivo_salida) / (1024 * 1024)
+    print(f"Tamaño del archivo principal: {tamaño_mb_normal:.2f} MB")
 
 if os.path.exists(nombre_archivo_outliers):
     tamaño_mb_outliers = os.path.getsize(nombre_archivo_outliers) / (1024 * 1024)
@@ -591,6 +1050,16 @@ if len(filas_outliers) > 10:
 print("\n" + "="*50)
 print("FINALIZADO")
 print("="*50)
-print(f"Archivo principal generado: {nombre_archivo_salida}")
+if escritor_particionado is not None:
+    print(f"Salida particionada generada en: {directorio_salida_particionada} (manifest.json)")
+else:
+    print(f"Archivo principal generado: {nombre_archivo_salida}")
 print(f"Archivo de outliers generado: {nombre_archivo_outliers}")
-print(f"Reporte HTML generado: {nombre_reporte}")
\ No newline at end of file
+for ruta_rollup in archivos_rollup.values():
+    print(f"Tabla de agregados generada: {ruta_rollup}")
+if seguimiento_columnas is not None and os.path.exists(nombre_archivo_salida):
+    print(f"Columnas a podar en la limpieza: {ruta_columnas(nombre_archivo_salida)}")
+if telemetria is not None:
+    print(f"Telemetría de recursos: {nombre_archivo_telemetria} y {nombre_archivo_metricas_prometheus}")
+if conteo_hits:
+    print(f"Reporte HTML generado: {nombre_reporte}")
\ No newline at end of file
@@ -0,0 +1,670 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+import pandas as pd
+
+from agregados import fusionar_archivos_rollup
+from deduplicacion import AlmacenClavesVisitas
+from registros_csv import iterar_registros
+from vigilancia import NOMBRE_LIMPIO, precargar_modulos, procesar_lote
+
+
+# Ejecución por fragmentos en varias máquinas que comparten un directorio (NFS,
+# SMB...). La planificación divide la entrada en rangos de bytes que terminan en
+# un límite de registro (paridad de comillas, como registros_csv; líneas en
+# NDJSON) y los anota en manifiesto_fragmentos.json. Los trabajadores, en
+# cualquier nodo, reclaman cada fragmento creando su archivo de bloqueo con
+# O_CREAT | O_EXCL (solo uno lo consigue), lo expanden y limpian en
+# fragmentos/<id>/intento-<token>/ y dejan un hecho.json que apunta a ese
+# intento. Un bloqueo sin latido durante SEGUNDOS_EXPIRACION_BLOQUEO se da por
+# abandonado y otro trabajador lo toma; el trabajador original, si seguía vivo,
+# comprueba el token del bloqueo antes de escribir hecho.json y de liberarlo, y
+# descarta su intento si ya no es suyo.
+# La unión fusiona las estadísticas de limpieza de todos los fragmentos, decide
+# la poda de columnas sobre el total, suma los rollups y concatena las salidas.
+# Al planificar también se buscan las visitas duplicadas (fullVisitorId + visitId)
+# en todo el archivo: sus rangos de bytes se anotan y no se copian al fragmento,
+# así que cada visita se procesa una sola vez aunque se repita entre fragmentos.
+# La entrada debe estar en la misma ruta en todos los nodos.
+#
+#   python fragmentos.py planificar visitas.csv /compartido/visitas --tamano-mb 256
+#   python fragmentos.py trabajar /compartido/visitas          (en cada nodo, uno o varios)
+#   python fragmentos.py unir /compartido/visitas
+#   python fragmentos.py local visitas.csv /tmp/visitas --trabajadores 4   (todo en una máquina)
+
+NOMBRE_MANIFIESTO = "manifiesto_fragmentos.json"
+NOMBRE_RESULTADO = "resultado_fragmentos.json"
+DIRECTORIO_FRAGMENTOS = "fragmentos"
+DIRECTORIO_BLOQUEOS = "bloqueos"
+NOMBRE_HECHO = "hecho.json"
+NOMBRE_ERROR = "error.json"
+PREFIJO_INTENTO = "intento-"  # Subdirectorio de cada intento: fragmentos/<id>/intento-<token del bloqueo>/
+NOMBRE_ESTADISTICAS = "estadisticas_limpieza.pkl"
+NOMBRE_OUTLIERS = "visitas_muchos_hits.csv"
+PREFIJO_ROLLUP = "rollup_"
+EXTENSIONES_NDJSON = (".json", ".jsonl", ".ndjson")
+
+TAMANO_FRAGMENTO_MB = 256
+TAMANO_BUFFER_LECTURA = 8 * 1024 * 1024
+SEGUNDOS_EXPIRACION_BLOQUEO = 600  # Sin latido durante este tiempo, el trabajador se da por caído
+FILAS_LOTE_UNION = 100000
+
+# Deduplicación entre fragmentos, con la misma clave que la etapa 1
+COLUMNAS_CLAVE = ("fullVisitorId", "visitId")
+NOMBRE_ALMACEN_CLAVES = "claves_planificacion.sqlite"
+CAPACIDAD_INICIAL_CLAVES = 1_000_000  # El filtro de Bloom crece con las claves
+REGISTROS_POR_CONSULTA_CLAVES = 10000
+_PATRONES_CLAVE_NDJSON = [re.compile(rb'"' + columna.encode() + rb'"\s*:\s*(?:"([^"]*)"|([^,}\s]+))')
+                          for columna in COLUMNAS_CLAVE]
+
+
+def _ahora():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _escribir_json(ruta, datos):
+    """Escritura atómica (archivo temporal + os.replace); el temporal es único por proceso"""
+    temporal = f"{ruta}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False, indent=2)
+    os.replace(temporal, ruta)
+
+
+def _leer_json(ruta):
+    with open(ruta, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _directorio_fragmento(directorio, id_fragmento):
+    return os.path.join(directorio, DIRECTORIO_FRAGMENTOS, id_fragmento)
+
+
+def _clave_registro(registro, posiciones_clave=None):
+    """
+    Clave fullVisitorId|visitId de un registro crudo: de los campos del CSV en las
+    posiciones dadas o, sin posiciones, de una línea NDJSON (sin interpretar el objeto)
+    """
+    if posiciones_clave is None:
+        partes = []
+        for patron in _PATRONES_CLAVE_NDJSON:
+            encontrado = patron.search(registro)
+            valor = b"" if encontrado is None else encontrado.group(1) or encontrado.group(2) or b""
+            partes.append("" if valor == b"null" else valor.decode("utf-8", "replace"))
+        return "|".join(partes)
+    campos = next(csv.reader(io.StringIO(registro.decode("utf-8", "replace"))), [])
+    return "|".join(campos[i] if i < len(campos) else "" for i in posiciones_clave)
+
+
+def cargar_manifiesto(directorio):
+    ruta = os.path.join(directorio, NOMBRE_MANIFIESTO)
+    if not os.path.exists(ruta):
+        raise FileNotFoundError(f"No hay {NOMBRE_MANIFIESTO} en {directorio}: ejecute antes 'planificar'")
+    return _leer_json(ruta)
+
+
+def planificar_fragmentos(archivo, directorio, tamano_fragmento_mb=TAMANO_FRAGMENTO_MB, reiniciar=False,
+                          deduplicar=True):
+    """
+    Divide la entrada en fragmentos de unos tamano_fragmento_mb MB y escribe el
+    manifiesto. Si ya hay uno para el mismo archivo (ruta, tamaño y fecha) se
+    reutiliza, con el progreso que tenga; con reiniciar se descarta el anterior.
+    Con deduplicar, las repeticiones de una visita ya vista (en cualquier
+    fragmento anterior) se anotan para no extraerlas.
+
+    Returns:
+        El manifiesto: archivo, formato, bytes de cabecera y la lista de fragmentos
+        ({id, inicio, fin, registros, omitidos}, offsets en bytes; omitidos son los
+        rangos [inicio, fin) de los registros duplicados)
+    """
+    archivo = os.path.abspath(archivo)
+    info = os.stat(archivo)
+    os.makedirs(directorio, exist_ok=True)
+    ruta_manifiesto = os.path.join(directorio, NOMBRE_MANIFIESTO)
+    if os.path.exists(ruta_manifiesto) and not reiniciar:
+        existente = _leer_json(ruta_manifiesto)
+        if (existente["archivo"], existente["tamano"], existente["mtime"]) == (archivo, info.st_size, info.st_mtime):
+            return existente
+        raise ValueError(f"{directorio} ya tiene un manifiesto de otra entrada ({existente['archivo']}); "
+                         "use --reiniciar para descartarlo")
+    if reiniciar:
+        for subdirectorio in (DIRECTORIO_FRAGMENTOS, DIRECTORIO_BLOQUEOS):
+            shutil.rmtree(os.path.join(directorio, subdirectorio), ignore_errors=True)
+
+    formato = "ndjson" if archivo.lower().endswith(EXTENSIONES_NDJSON) else "csv"
+    objetivo = max(1, int(tamano_fragmento_mb * 1024 * 1024))
+    fragmentos = []
+    omitidos = []  # Rangos de bytes de los registros duplicados, en orden
+    pendientes = []  # (inicio, fin, clave) aún sin comprobar
+    almacen_claves = None
+    ruta_almacen = os.path.join(directorio, NOMBRE_ALMACEN_CLAVES)
+
+    def cerrar_fragmento(inicio, fin, registros):
+        fragmentos.append({"id": f"{len(fragmentos):05d}", "inicio": inicio, "fin": fin, "registros": registros})
+
+    def comprobar_claves():
+        nuevas = almacen_claves.filtrar_nuevas([clave for _, _, clave in pendientes])
+        omitidos.extend([inicio, fin] for (inicio, fin, _), nueva in zip(pendientes, nuevas) if not nueva)
+        pendientes.clear()
+
+    with open(archivo, "rb", buffering=TAMANO_BUFFER_LECTURA) as f:
+        # Registros completos: un fragmento nunca corta un campo con saltos de línea
+        registros = f if formato == "ndjson" else iterar_registros(f)
+        cabecera = b"" if formato == "ndjson" else next(registros, b"")
+        posiciones_clave = None
+        if deduplicar and formato == "csv":
+            columnas = next(csv.reader(io.StringIO(cabecera.decode("utf-8-sig", "replace"))), [])
+            if all(columna in columnas for columna in COLUMNAS_CLAVE):
+                posiciones_clave = [columnas.index(columna) for columna in COLUMNAS_CLAVE]
+            else:
+                print(f"Deduplicación entre fragmentos desactivada: faltan las columnas {', '.join(COLUMNAS_CLAVE)}")
+                deduplicar = False
+        if deduplicar:
+            almacen_claves = AlmacenClavesVisitas(ruta_almacen, CAPACIDAD_INICIAL_CLAVES)
+        inicio = posicion = len(cabecera)
+        num_registros = 0
+        for registro in registros:
+            if almacen_claves is not None:
+                pendientes.append((posicion, posicion + len(registro), _clave_registro(registro, posiciones_clave)))
+                if len(pendientes) >= REGISTROS_POR_CONSULTA_CLAVES:
+                    comprobar_claves()
+            posicion += len(registro)
+            num_registros += 1
+            if posicion - inicio >= objetivo:
+                cerrar_fragmento(inicio, posicion, num_registros)
+                inicio, num_registros = posicion, 0
+        if num_registros:
+            cerrar_fragmento(inicio, posicion, num_registros)
+    if almacen_claves is not None:
+        if pendientes:
+            comprobar_claves()
+        almacen_claves.cerrar()
+        for ruta in (ruta_almacen, almacen_claves.ruta_filtro):
+            os.remove(ruta)
+
+    # Cada rango omitido cae dentro de un único fragmento (ambos están ordenados)
+    siguiente = 0
+    for fragmento in fragmentos:
+        primero = siguiente
+        while siguiente < len(omitidos) and omitidos[siguiente][0] < fragmento["fin"]:
+            siguiente += 1
+        fragmento["omitidos"] = omitidos[primero:siguiente]
+
+    manifiesto = {
+        "archivo": archivo,
+        "tamano": info.st_size,
+        "mtime": info.st_mtime,
+        "formato": formato,
+        "bytes_cabecera": len(cabecera),
+        "tamano_fragmento_mb": tamano_fragmento_mb,
+        "creado": _ahora(),
+        "duplicados_omitidos": len(omitidos),
+        "fragmentos": fragmentos,
+    }
+    os.makedirs(os.path.join(directorio, DIRECTORIO_FRAGMENTOS), exist_ok=True)
+    os.makedirs(os.path.join(directorio, DIRECTORIO_BLOQUEOS), exist_ok=True)
+    _escribir_json(ruta_manifiesto, manifiesto)
+    return manifiesto
+
+
+def extraer_fragmento(manifiesto, fragmento, ruta_salida):
+    """Copia la cabecera y el rango de bytes del fragmento, sin sus duplicados, a un archivo propio"""
+    info = os.stat(manifiesto["archivo"])
+    if (info.st_size, info.st_mtime) != (manifiesto["tamano"], manifiesto["mtime"]):
+        raise RuntimeError(f"{manifiesto['archivo']} cambió desde la planificación; vuelva a planificar")
+    tramos = []
+    posicion = fragmento["inicio"]
+    for inicio_omitido, fin_omitido in fragmento.get("omitidos", []):
+        tramos.append((posicion, inicio_omitido))
+        posicion = fin_omitido
+    tramos.append((posicion, fragmento["fin"]))
+    with open(manifiesto["archivo"], "rb") as origen, open(ruta_salida, "wb") as destino:
+        destino.write(origen.read(manifiesto["bytes_cabecera"]))
+        for inicio, fin in tramos:
+            origen.seek(inicio)
+            restantes = fin - inicio
+            while restantes > 0:
+                datos = origen.read(min(TAMANO_BUFFER_LECTURA, restantes))
+                if not datos:
+                    break
+                destino.write(datos)
+                restantes -= len(datos)
+
+
+class TrabajadorFragmentos:
+    """
+    Reclama y procesa fragmentos pendientes del manifiesto de un directorio compartido.
+
+    Args:
+        directorio: directorio compartido con el manifiesto
+        id_trabajador: nombre en los bloqueos y en hecho.json (por defecto host-pid)
+        expiracion_bloqueo: segundos sin latido tras los que un bloqueo se considera abandonado
+        reintentar_errores: volver a procesar los fragmentos que fallaron (tienen error.json)
+    """
+
+    def __init__(self, directorio, id_trabajador=None, expiracion_bloqueo=SEGUNDOS_EXPIRACION_BLOQUEO,
+                 reintentar_errores=False):
+        self.directorio = os.path.abspath(directorio)
+        self.id_trabajador = id_trabajador or f"{socket.gethostname()}-{os.getpid()}"
+        self.expiracion_bloqueo = expiracion_bloqueo
+        self.reintentar_errores = reintentar_errores
+        self.manifiesto = cargar_manifiesto(self.directorio)
+        self._tokens = {}  # {id de fragmento: token del bloqueo} de los fragmentos reclamados
+        self._marcas_toma = {}  # {token: marca .toma} de los bloqueos retomados, hasta liberarlos
+
+    def _ruta_bloqueo(self, id_fragmento):
+        return os.path.join(self.directorio, DIRECTORIO_BLOQUEOS, f"{id_fragmento}.lock")
+
+    def _pendiente(self, fragmento):
+        directorio_fragmento = _directorio_fragmento(self.directorio, fragmento["id"])
+        if os.path.exists(os.path.join(directorio_fragmento, NOMBRE_HECHO)):
+            return False
+        return self.reintentar_errores or not os.path.exists(os.path.join(directorio_fragmento, NOMBRE_ERROR))
+
+    def _crear_bloqueo(self, ruta):
+        """Crea el bloqueo si no existe (atómico también en NFSv3+); devuelve su token o None"""
+        try:
+            fd = os.open(ruta, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"token": token, "trabajador": self.id_trabajador, "desde": _ahora()}, f)
+        return token
+
+    def _tomar_bloqueo_caducado(self, ruta):
+        """
+        Toma un bloqueo abandonado. Varios trabajadores pueden verlo caducado a la
+        vez: solo el que crea <bloqueo>.<token anterior>.toma con O_EXCL lo sustituye,
+        y solo si el bloqueo sigue teniendo ese token. La marca se conserva hasta
+        liberar el bloqueo (o hasta la unión) para que nadie que leyera el mismo
+        token pueda volver a crearla.
+        """
+        try:
+            if time.time() - os.stat(ruta).st_mtime < self.expiracion_bloqueo:
+                return None
+            token_anterior = _leer_json(ruta)["token"]
+        except (OSError, ValueError, KeyError):
+            return None  # Liberado o a medio escribir: se reintentará en otra pasada
+        ruta_toma = f"{ruta}.{token_anterior}.toma"
+        try:
+            os.close(os.open(ruta_toma, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            return None
+        if not self._es_propietario(ruta, token_anterior):
+            # Otro trabajador lo retomó (y ya lo liberó) entre la lectura del token y la marca
+            os.remove(ruta_toma)
+            return None
+        token = uuid.uuid4().hex
+        _escribir_json(ruta, {"token": token, "trabajador": self.id_trabajador, "desde": _ahora(),
+                              "tomado_de": token_anterior})
+        self._marcas_toma[token] = ruta_toma
+        print(f"[{_ahora()}] {self.id_trabajador}: bloqueo abandonado retomado ({os.path.basename(ruta)})",
+              flush=True)
+        return token
+
+    def reclamar(self, fragmento):
+        """Intenta reclamar un fragmento pendiente; devuelve True si ahora es de este trabajador"""
+        if not self._pendiente(fragmento):
+            return False
+        ruta = self._ruta_bloqueo(fragmento["id"])
+        token = self._crear_bloqueo(ruta) or self._tomar_bloqueo_caducado(ruta)
+        if token is None:
+            return False
+        if not self._pendiente(fragmento):
+            # Otro trabajador lo terminó entre la comprobación y el bloqueo
+            self._liberar(ruta, token)
+            return False
+        self._tokens[fragmento["id"]] = token
+        return True
+
+    def _es_propietario(self, ruta, token):
+        """Indica si el bloqueo sigue teniendo el token de este trabajador"""
+        try:
+            return _leer_json(ruta).get("token") == token
+        except (OSError, ValueError):
+            return False
+
+    def _liberar(self, ruta, token):
+        # Solo se borra el bloqueo propio: si caducó y otro trabajador lo tomó, es suyo
+        # (la marca de toma queda entonces para la unión)
+        ruta_toma = self._marcas_toma.pop(token, None)
+        if not self._es_propietario(ruta, token):
+            return
+        for ruta_archivo in (ruta, ruta_toma):
+            if ruta_archivo is None:
+                continue
+            try:
+                os.remove(ruta_archivo)
+            except FileNotFoundError:
+                pass
+
+    def _latir(self, ruta, token, parar):
+        # Mantiene reciente la fecha del bloqueo mientras el fragmento se procesa
+        while not parar.wait(self.expiracion_bloqueo / 10):
+            if not self._es_propietario(ruta, token):
+                return
+            try:
+                os.utime(ruta)
+            except OSError:
+                pass
+
+    def procesar(self, fragmento):
+        """
+        Expande y limpia un fragmento ya reclamado. Devuelve True si terminó bien,
+        False si falló y None si otro trabajador tomó su bloqueo entretanto (el
+        intento se descarta).
+        """
+        token = self._tokens.pop(fragmento["id"])
+        directorio_fragmento = _directorio_fragmento(self.directorio, fragmento["id"])
+        # Cada intento trabaja en su propio subdirectorio: uno que perdió el bloqueo
+        # no pisa las salidas del trabajador que lo tomó
+        directorio_intento = os.path.join(directorio_fragmento, PREFIJO_INTENTO + token)
+        os.makedirs(directorio_intento, exist_ok=True)
+        extension = ".jsonl" if self.manifiesto["formato"] == "ndjson" else ".csv"
+        ruta_entrada = os.path.join(directorio_intento, "entrada" + extension)
+        ruta_bloqueo = self._ruta_bloqueo(fragmento["id"])
+        parar = threading.Event()
+        latido = threading.Thread(target=self._latir, args=(ruta_bloqueo, token, parar), daemon=True)
+        latido.start()
+        inicio = time.time()
+        try:
+            extraer_fragmento(self.manifiesto, fragmento, ruta_entrada)
+            # Sin poda: cada fragmento vería constantes distintas; se decide al unir
+            resultado = procesar_lote(ruta_entrada, directorio_intento,
+                                      ["--sin-poda", "--estadisticas", NOMBRE_ESTADISTICAS])
+            os.remove(ruta_entrada)
+            if not self._es_propietario(ruta_bloqueo, token):
+                print(f"[{_ahora()}] {self.id_trabajador}: el bloqueo del fragmento {fragmento['id']} es ahora "
+                      "de otro trabajador; se descarta este intento", file=sys.stderr, flush=True)
+                shutil.rmtree(directorio_intento, ignore_errors=True)
+                return None
+            _escribir_json(os.path.join(directorio_fragmento, NOMBRE_HECHO), {
+                "id": fragmento["id"], "trabajador": self.id_trabajador, "directorio": PREFIJO_INTENTO + token,
+                "inicio": datetime.fromtimestamp(inicio).isoformat(timespec="seconds"), "fin": _ahora(),
+                "segundos": round(time.time() - inicio, 3), **resultado})
+            ruta_error = os.path.join(directorio_fragmento, NOMBRE_ERROR)
+            if os.path.exists(ruta_error):
+                os.remove(ruta_error)
+            # Intentos anteriores (fallidos o de trabajadores caídos)
+            for nombre in os.listdir(directorio_fragmento):
+                if nombre.startswith(PREFIJO_INTENTO) and nombre != PREFIJO_INTENTO + token:
+                    shutil.rmtree(os.path.join(directorio_fragmento, nombre), ignore_errors=True)
+            return True
+        except Exception as e:
+            if not self._es_propietario(ruta_bloqueo, token):
+                print(f"[{_ahora()}] {self.id_trabajador}: error en el fragmento {fragmento['id']} tras perder "
+                      f"su bloqueo: {e}", file=sys.stderr, flush=True)
+                return None
+            _escribir_json(os.path.join(directorio_fragmento, NOMBRE_ERROR), {
+                "id": fragmento["id"], "trabajador": self.id_trabajador, "directorio": PREFIJO_INTENTO + token,
+                "fin": _ahora(), "error": f"{type(e).__name__}: {e}", "traza": traceback.format_exc()})
+            print(f"[{_ahora()}] {self.id_trabajador}: error en el fragmento {fragmento['id']}: {e}",
+                  file=sys.stderr, flush=True)
+            return False
+        finally:
+            parar.set()
+            latido.join()
+            self._liberar(ruta_bloqueo, token)
+
+    def ejecutar(self, esperar=False, intervalo=10.0):
+        """
+        Procesa fragmentos hasta que no quede ninguno libre. Con esperar, sigue
+        mientras otros trabajadores tengan fragmentos en curso, por si alguno cae
+        y su bloqueo caduca.
+
+        Returns:
+            {"procesados": n, "fallidos": n, "perdidos": n}; perdidos son los fragmentos
+            cuyo bloqueo tomó otro trabajador mientras se procesaban
+        """
+        precargar_modulos()
+        resumen = {"procesados": 0, "fallidos": 0, "perdidos": 0}
+        intentados = set()  # Un fragmento fallido no se reintenta en la misma ejecución
+        while True:
+            reclamado = False
+            for fragmento in self.manifiesto["fragmentos"]:
+                if fragmento["id"] in intentados or not self.reclamar(fragmento):
+                    continue
+                reclamado = True
+                intentados.add(fragmento["id"])
+                print(f"[{_ahora()}] {self.id_trabajador}: fragmento {fragmento['id']} "
+                      f"({fragmento['registros']} registros)", flush=True)
+                terminado = self.procesar(fragmento)
+                if terminado:
+                    resumen["procesados"] += 1
+                elif terminado is None:
+                    resumen["perdidos"] += 1
+                else:
+                    resumen["fallidos"] += 1
+            if reclamado:
+                continue
+            if not esperar or not any(self._pendiente(f) for f in self.manifiesto["fragmentos"]
+                                      if f["id"] not in intentados):
+                return resumen
+            time.sleep(intervalo)
+
+
+def estado_fragmentos(directorio):
+    """Cuenta los fragmentos hechos, con error, en curso (bloqueados) y pendientes"""
+    manifiesto = cargar_manifiesto(directorio)
+    conteo = {"hechos": 0, "con_error": 0, "en_curso": 0, "pendientes": 0}
+    for fragmento in manifiesto["fragmentos"]:
+        directorio_fragmento = _directorio_fragmento(directorio, fragmento["id"])
+        if os.path.exists(os.path.join(directorio_fragmento, NOMBRE_HECHO)):
+            conteo["hechos"] += 1
+        elif os.path.exists(os.path.join(directorio, DIRECTORIO_BLOQUEOS, f"{fragmento['id']}.lock")):
+            conteo["en_curso"] += 1
+        elif os.path.exists(os.path.join(directorio_fragmento, NOMBRE_ERROR)):
+            conteo["con_error"] += 1
+        else:
+            conteo["pendientes"] += 1
+    return conteo
+
+
+def _unir_salidas_limpias(rutas, columnas, ruta_salida):
+    """Concatena las salidas limpias de los fragmentos con las columnas dadas (las que falten, vacías)"""
+    temporal = ruta_salida + ".tmp"
+    filas = 0
+    cabecera = True
+    for ruta in rutas:
+        for lote in pd.read_csv(ruta, dtype=str, keep_default_na=False, chunksize=FILAS_LOTE_UNION):
+            lote.reindex(columns=columnas).to_csv(temporal, mode="w" if cabecera else "a", header=cabecera,
+                                                  index=False, encoding="utf-8")
+            cabecera = False
+            filas += len(lote)
+    if cabecera:
+        pd.DataFrame(columns=columnas).to_csv(temporal, index=False, encoding="utf-8")
+    os.replace(temporal, ruta_salida)
+    return filas
+
+
+def unir_fragmentos(directorio, unir_salidas=True, podar_columnas=True, proporcion_minima_valores=0.0):
+    """
+    Fusiona los resultados de todos los fragmentos: estadísticas y reportes de
+    limpieza (en el directorio compartido), rollups sumados y, con unir_salidas,
+    un único CSV limpio. Falla si algún fragmento no ha terminado.
+
+    Returns:
+        Resumen de la unión (también en resultado_fragmentos.json)
+    """
+    directorio = os.path.abspath(directorio)
+    manifiesto = cargar_manifiesto(directorio)
+    sin_terminar = [f["id"] for f in manifiesto["fragmentos"]
+                    if not os.path.exists(os.path.join(_directorio_fragmento(directorio, f["id"]), NOMBRE_HECHO))]
+    if sin_terminar:
+        raise RuntimeError(f"{len(sin_terminar)} fragmentos sin terminar: {', '.join(sin_terminar[:10])}")
+
+    directorio_original = os.getcwd()
+    os.chdir(directorio)  # limpiezaFinal deja su log y sus reportes en el directorio actual
+    try:
+        from limpiezaFinal import EstadisticasLimpieza
+
+        estadisticas = EstadisticasLimpieza()
+        columnas_originales, columnas_finales = {}, {}
+        salidas, rollups, outliers, hechos = [], {}, [], {}
+        for fragmento in manifiesto["fragmentos"]:
+            directorio_fragmento = _directorio_fragmento(directorio, fragmento["id"])
+            hecho = hechos[fragmento["id"]] = _leer_json(os.path.join(directorio_fragmento, NOMBRE_HECHO))
+            directorio_salidas = os.path.join(directorio_fragmento, hecho.get("directorio", ""))
+            # Un fragmento vacío (todas sus visitas duplicadas, filtradas u outliers) no tiene limpieza
+            if not hecho.get("vacio"):
+                parcial = EstadisticasLimpieza.cargar_estado(os.path.join(directorio_salidas, NOMBRE_ESTADISTICAS))
+                # Los índices de fila son locales a cada fragmento
+                parcial.muestra_errores.elementos = [(f"{fragmento['id']}:{indice}", error)
+                                                     for indice, error in parcial.muestra_errores.elementos]
+                estadisticas.fusionar(parcial)
+                estadisticas.memoria_usada.extend(parcial.memoria_usada)
+                estadisticas.tiempo_inicio = min(estadisticas.tiempo_inicio, parcial.tiempo_inicio)
+                reporte = _leer_json(os.path.join(directorio_salidas, "reporte_limpieza_datos.json"))
+                columnas_originales.update(dict.fromkeys(reporte["columnas"]["originales"]))
+                columnas_finales.update(dict.fromkeys(reporte["columnas"]["finales"]))
+                salidas.append(os.path.join(directorio_salidas, NOMBRE_LIMPIO))
+            for nombre in sorted(os.listdir(directorio_salidas)):
+                if nombre.startswith(PREFIJO_ROLLUP) and nombre.endswith(".csv"):
+                    rollups.setdefault(nombre, []).append(os.path.join(directorio_salidas, nombre))
+            ruta_outliers = os.path.join(directorio_salidas, NOMBRE_OUTLIERS)
+            if os.path.exists(ruta_outliers) and os.path.getsize(ruta_outliers) > 0:
+                outliers.append(ruta_outliers)
+
+        # La poda se decide sobre todas las filas: una columna constante en cada
+        # fragmento puede tener valores distintos entre fragmentos
+        podadas = {}
+        if podar_columnas:
+            podadas = {columna: motivo for columna, motivo
+                       in estadisticas.seguimiento_columnas.columnas_podables(proporcion_minima_valores).items()
+                       if columna in columnas_finales}
+        estadisticas.columnas_podadas = podadas
+        for columna in podadas:
+            # Como en una ejecución única, donde la etapa 1 ya no las escribe
+            estadisticas.perfiles_columnas.pop(columna, None)
+            estadisticas.sketches_cuantiles.pop(columna, None)
+        columnas_salida = [columna for columna in columnas_finales if columna not in podadas]
+
+        filas_unidas = None
+        if unir_salidas:
+            filas_unidas = _unir_salidas_limpias(salidas, columnas_salida, os.path.join(directorio, NOMBRE_LIMPIO))
+        for nombre, rutas in rollups.items():
+            fusionar_archivos_rollup(rutas, os.path.join(directorio, nombre))
+        estadisticas.generar_reporte(manifiesto["archivo"], list(columnas_originales), columnas_salida)
+    finally:
+        os.chdir(directorio_original)
+
+    resultado = {
+        "archivo": manifiesto["archivo"],
+        "fragmentos": len(manifiesto["fragmentos"]),
+        "filas_expandidas": sum(hecho.get("filas_expandidas") or 0 for hecho in hechos.values()),
+        "max_hits": max((hecho.get("max_hits") or 0 for hecho in hechos.values()), default=0),
+        "filas_limpias": estadisticas.filas_procesadas,
+        "filas_con_error": estadisticas.filas_con_error,
+        "columnas_podadas": len(podadas),
+        "salida_limpia": os.path.join(directorio, NOMBRE_LIMPIO) if unir_salidas else salidas,
+        "filas_salida_limpia": filas_unidas,
+        "rollups": sorted(rollups),
+        "archivos_outliers": outliers,
+        "segundos_por_fragmento": {id_fragmento: hecho.get("segundos") for id_fragmento, hecho in hechos.items()},
+        "unido": _ahora(),
+    }
+    _escribir_json(os.path.join(directorio, NOMBRE_RESULTADO), resultado)
+    # Marcas de bloqueos retomados que quedaron de trabajadores caídos o desplazados
+    directorio_bloqueos = os.path.join(directorio, DIRECTORIO_BLOQUEOS)
+    for nombre in os.listdir(directorio_bloqueos) if os.path.isdir(directorio_bloqueos) else []:
+        if nombre.endswith(".toma"):
+            os.remove(os.path.join(directorio_bloqueos, nombre))
+    return resultado
+
+
+def ejecutar_local(archivo, directorio, trabajadores=2, tamano_fragmento_mb=TAMANO_FRAGMENTO_MB,
+                   unir_salidas=True, reiniciar=False, deduplicar=True):
+    """Planifica, lanza varios trabajadores como procesos en esta máquina y une el resultado"""
+    manifiesto = planificar_fragmentos(archivo, directorio, tamano_fragmento_mb, reiniciar, deduplicar)
+    print(f"[{_ahora()}] {len(manifiesto['fragmentos'])} fragmentos ({manifiesto['duplicados_omitidos']} "
+          f"visitas duplicadas omitidas); {trabajadores} trabajadores locales", flush=True)
+    procesos = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "trabajar", directorio,
+                                  "--id", f"{socket.gethostname()}-local{numero}"])
+                for numero in range(trabajadores)]
+    for proceso in procesos:
+        proceso.wait()
+    return unir_fragmentos(directorio, unir_salidas)
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description="Procesa un dataset grande por fragmentos con trabajadores en uno o varios nodos")
+    subparsers = parser.add_subparsers(dest="orden", required=True)
+
+    planificar = subparsers.add_parser("planificar", help="divide la entrada y escribe el manifiesto")
+    planificar.add_argument("archivo", help="CSV o NDJSON de entrada (accesible desde todos los nodos)")
+    planificar.add_argument("directorio", help="directorio compartido del trabajo")
+    planificar.add_argument("--tamano-mb", type=float, default=TAMANO_FRAGMENTO_MB, help="tamaño de cada fragmento")
+    planificar.add_argument("--reiniciar", action="store_true", help="descarta un manifiesto y fragmentos anteriores")
+    planificar.add_argument("--sin-deduplicar", action="store_true",
+                            help="no buscar visitas duplicadas entre fragmentos")
+
+    trabajar = subparsers.add_parser("trabajar", help="procesa fragmentos pendientes hasta que no quede ninguno")
+    trabajar.add_argument("directorio", help="directorio compartido del trabajo")
+    trabajar.add_argument("--id", default=None, help="nombre del trabajador (por defecto host-pid)")
+    trabajar.add_argument("--esperar", action="store_true",
+                          help="sigue mientras haya fragmentos en curso en otros trabajadores")
+    trabajar.add_argument("--reintentar-errores", action="store_true", help="vuelve a procesar los fallidos")
+    trabajar.add_argument("--expiracion-bloqueo", type=float, default=SEGUNDOS_EXPIRACION_BLOQUEO,
+                          help="segundos sin latido para dar por abandonado un fragmento")
+
+    estado = subparsers.add_parser("estado", help="muestra cuántos fragmentos hay en cada estado")
+    estado.add_argument("directorio", help="directorio compartido del trabajo")
+
+    unir = subparsers.add_parser("unir", help="fusiona estadísticas, reportes, rollups y salidas")
+    unir.add_argument("directorio", help="directorio compartido del trabajo")
+    unir.add_argument("--sin-union-salidas", action="store_true",
+                      help="deja las salidas limpias en cada fragmento en lugar de concatenarlas")
+    unir.add_argument("--sin-poda", action="store_true", help="no podar columnas vacías ni constantes")
+
+    local = subparsers.add_parser("local", help="planifica, procesa con N procesos locales y une")
+    local.add_argument("archivo", help="CSV o NDJSON de entrada")
+    local.add_argument("directorio", help="directorio del trabajo")
+    local.add_argument("--trabajadores", type=int, default=2, help="procesos trabajadores")
+    local.add_argument("--tamano-mb", type=float, default=TAMANO_FRAGMENTO_MB, help="tamaño de cada fragmento")
+    local.add_argument("--reiniciar", action="store_true", help="descarta un manifiesto y fragmentos anteriores")
+    local.add_argument("--sin-deduplicar", action="store_true", help="no buscar visitas duplicadas entre fragmentos")
+    local.add_argument("--sin-union-salidas", action="store_true",
+                       help="deja las salidas limpias en cada fragmento en lugar de concatenarlas")
+    args = parser.parse_args(argumentos)
+
+    if args.orden == "planificar":
+        manifiesto = planificar_fragmentos(args.archivo, args.directorio, args.tamano_mb, args.reiniciar,
+                                           not args.sin_deduplicar)
+        print(f"{len(manifiesto['fragmentos'])} fragmentos ({manifiesto['duplicados_omitidos']} visitas duplicadas "
+              f"omitidas) en {os.path.join(args.directorio, NOMBRE_MANIFIESTO)}")
+    elif args.orden == "trabajar":
+        trabajador = TrabajadorFragmentos(args.directorio, args.id, args.expiracion_bloqueo,
+                                          args.reintentar_errores)
+        resumen = trabajador.ejecutar(esperar=args.esperar)
+        print(f"[{_ahora()}] {trabajador.id_trabajador}: {resumen['procesados']} fragmentos procesados, "
+              f"{resumen['fallidos']} con error, {resumen['perdidos']} retomados por otro trabajador", flush=True)
+        if resumen["fallidos"]:
+            sys.exit(1)
+    elif args.orden == "estado":
+        print(json.dumps(estado_fragmentos(args.directorio), ensure_ascii=False))
+    else:
+        if args.orden == "unir":
+            resultado = unir_fragmentos(args.directorio, not args.sin_union_salidas, not args.sin_poda)
+        else:
+            resultado = ejecutar_local(args.archivo, args.directorio, args.trabajadores, args.tamano_mb,
+                                       not args.sin_union_salidas, args.reiniciar, not args.sin_deduplicar)
+        print(f"Unidos {resultado['fragmentos']} fragmentos: {resultado['filas_limpias']} filas limpias, "
+              f"{resultado['columnas_podadas']} columnas podadas (ver {NOMBRE_RESULTADO})")
+
+
+if __name__ == "__main__":
+    main()
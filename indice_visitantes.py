@@ -0,0 +1,223 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from registros_csv import iterar_bloques, iterar_registros, separar_registros
+
+
+# Índice hash particionado (shards) de un CSV por una columna clave, normalmente
+# fullVisitorId: para cada fila guarda (hash de la clave, posición en bytes,
+# longitud). Cada shard se ordena por hash al cerrar, así que una búsqueda es
+# una búsqueda binaria sobre un archivo mapeado en memoria más una lectura
+# directa (seek) de las filas, sin recorrer el CSV.
+
+NOMBRE_METADATOS = "meta.json"
+TIPO_ENTRADA = np.dtype([("hash", "<u8"), ("posicion", "<u8"), ("longitud", "<u4")])
+
+
+def ruta_indice_por_defecto(archivo_csv):
+    return archivo_csv + ".indice"
+
+
+def hash_claves(claves):
+    """Hash de 64 bits (estable entre ejecuciones) de una secuencia de claves como texto"""
+    return pd.util.hash_array(np.asarray([str(c) for c in claves], dtype=object))
+
+
+class IndiceVisitantes:
+    """
+    Constructor del índice. Se alimenta con los bytes exactos que se escriben en el
+    CSV (por lotes, en orden) y con las claves de sus filas.
+
+    Args:
+        archivo_csv: CSV indexado
+        columna: columna clave
+        ruta_indice: directorio del índice (por defecto <archivo_csv>.indice)
+        num_shards: número de archivos en que se reparte el índice
+        max_entradas_memoria: entradas acumuladas antes de volcarlas a disco
+    """
+
+    def __init__(self, archivo_csv, columna="fullVisitorId", ruta_indice=None, num_shards=256,
+                 max_entradas_memoria=1_000_000):
+        self.archivo_csv = archivo_csv
+        self.columna = columna
+        self.ruta_indice = ruta_indice or ruta_indice_por_defecto(archivo_csv)
+        self.num_shards = num_shards
+        self.max_entradas_memoria = max_entradas_memoria
+        self.posicion = 0  # Bytes del CSV ya registrados
+        self.total_filas = 0
+        self.valido = True  # False si algún lote no cuadró (habrá que reconstruir escaneando)
+        self._pendientes = []
+        self._num_pendientes = 0
+
+        if os.path.isdir(self.ruta_indice):
+            shutil.rmtree(self.ruta_indice)
+        os.makedirs(self.ruta_indice)
+
+    def _ruta_shard(self, numero):
+        return os.path.join(self.ruta_indice, f"shard_{numero:04d}.bin")
+
+    def omitir_bytes(self, num_bytes):
+        """Avanza la posición sin indexar (p. ej. la cabecera)"""
+        self.posicion += num_bytes
+
+    def registrar_lote(self, claves, datos, con_cabecera=False):
+        """
+        Registra un lote ya escrito en el CSV.
+
+        Args:
+            claves: valores de la columna clave, uno por fila y en orden
+            datos: bytes escritos para el lote
+            con_cabecera: si los datos empiezan con la cabecera del CSV
+        """
+        registros = separar_registros(datos, self.posicion)
+        self.posicion += len(datos)
+        if con_cabecera:
+            registros = registros[1:]
+        if len(registros) != len(claves):
+            self.valido = False
+            return
+        if not registros:
+            return
+        entradas = np.empty(len(registros), dtype=TIPO_ENTRADA)
+        entradas["hash"] = hash_claves(claves)
+        entradas["posicion"] = [posicion for posicion, _ in registros]
+        entradas["longitud"] = [len(registro) for _, registro in registros]
+        self._pendientes.append(entradas)
+        self._num_pendientes += len(entradas)
+        self.total_filas += len(entradas)
+        if self._num_pendientes >= self.max_entradas_memoria:
+            self._volcar()
+
+    def _volcar(self):
+        """Reparte las entradas pendientes entre los shards (añadiendo al final de cada archivo)"""
+        if not self._pendientes:
+            return
+        entradas = np.concatenate(self._pendientes)
+        self._pendientes = []
+        self._num_pendientes = 0
+        shards = entradas["hash"] % np.uint64(self.num_shards)
+        orden = np.argsort(shards, kind="stable")
+        entradas, shards = entradas[orden], shards[orden]
+        limites = np.searchsorted(shards, np.arange(self.num_shards + 1, dtype=np.uint64))
+        for numero in range(self.num_shards):
+            inicio, fin = limites[numero], limites[numero + 1]
+            if fin > inicio:
+                with open(self._ruta_shard(numero), "ab") as f:
+                    entradas[inicio:fin].tofile(f)
+
+    def cerrar(self):
+        """Ordena cada shard por hash y escribe los metadatos"""
+        self._volcar()
+        for numero in range(self.num_shards):
+            ruta = self._ruta_shard(numero)
+            if os.path.exists(ruta):
+                entradas = np.fromfile(ruta, dtype=TIPO_ENTRADA)
+                entradas.sort(order=["hash", "posicion"])
+                entradas.tofile(ruta)
+        metadatos = {
+            "archivo_csv": os.path.abspath(self.archivo_csv),
+            "columna": self.columna,
+            "num_shards": self.num_shards,
+            "total_filas": self.total_filas,
+            "tamano_csv": self.posicion,
+            "valido": self.valido,
+        }
+        with open(os.path.join(self.ruta_indice, NOMBRE_METADATOS), "w", encoding="utf-8") as f:
+            json.dump(metadatos, f, ensure_ascii=False, indent=2)
+        return metadatos
+
+
+def indexar_archivo(archivo_csv, columna="fullVisitorId", ruta_indice=None, registros_por_bloque=100_000,
+                    num_shards=256):
+    """Construye el índice recorriendo un CSV ya escrito (p. ej. si cambió tras la escritura)"""
+    indice = IndiceVisitantes(archivo_csv, columna, ruta_indice, num_shards)
+    with open(archivo_csv, "rb") as f:
+        cabecera = next(iterar_registros(f), b"")
+        indice.omitir_bytes(len(cabecera))
+        for _, _, datos, _ in iterar_bloques(f, registros_por_bloque, len(cabecera)):
+            claves = pd.read_csv(io.BytesIO(cabecera + datos), usecols=[columna], dtype=str,
+                                 keep_default_na=False)[columna]
+            indice.registrar_lote(claves.tolist(), datos)
+    return indice.cerrar()
+
+
+def buscar(archivo_csv, valores, ruta_indice=None):
+    """
+    Devuelve un DataFrame (columnas como texto) con todas las filas del CSV cuya
+    columna clave coincide con alguno de los valores, usando el índice
+    """
+    if isinstance(valores, str):
+        valores = [valores]
+    ruta_indice = ruta_indice or ruta_indice_por_defecto(archivo_csv)
+    with open(os.path.join(ruta_indice, NOMBRE_METADATOS), encoding="utf-8") as f:
+        metadatos = json.load(f)
+    if not metadatos.get("valido", True):
+        raise ValueError(f"El índice {ruta_indice} está incompleto; reconstrúyalo con indexar_archivo")
+    columna = metadatos["columna"]
+    num_shards = metadatos["num_shards"]
+
+    # Posiciones candidatas de cada valor (búsqueda binaria en su shard)
+    ubicaciones = []
+    for h in hash_claves(valores):
+        ruta_shard = os.path.join(ruta_indice, f"shard_{int(h % np.uint64(num_shards)):04d}.bin")
+        if not os.path.exists(ruta_shard) or os.path.getsize(ruta_shard) == 0:
+            continue
+        entradas = np.memmap(ruta_shard, dtype=TIPO_ENTRADA, mode="r")
+        izquierda = np.searchsorted(entradas["hash"], h, side="left")
+        derecha = np.searchsorted(entradas["hash"], h, side="right")
+        ubicaciones.extend((int(e["posicion"]), int(e["longitud"])) for e in entradas[izquierda:derecha])
+
+    with open(archivo_csv, "rb") as f:
+        cabecera = next(iterar_registros(f), b"")
+        if not ubicaciones:
+            return pd.read_csv(io.BytesIO(cabecera), dtype=str)
+        filas = []
+        for posicion, longitud in sorted(ubicaciones):
+            f.seek(posicion)
+            filas.append(f.read(longitud))
+
+    df = pd.read_csv(io.BytesIO(cabecera + b"".join(filas)), dtype=str, keep_default_na=False)
+    # Descarta colisiones de hash comparando la clave real
+    return df[df[columna].isin([str(v) for v in valores])].reset_index(drop=True)
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description="Busca todas las filas de uno o varios visitantes en un CSV indexado")
+    parser.add_argument("archivo_csv", help="CSV limpio (p. ej. visitas_expandidas_completo_limpio.csv)")
+    parser.add_argument("valores", nargs="*", help="valores de la columna clave (fullVisitorId)")
+    parser.add_argument("--indice", help="directorio del índice (por defecto <archivo_csv>.indice)")
+    parser.add_argument("--construir", action="store_true", help="(re)construye el índice recorriendo el CSV")
+    parser.add_argument("--columna", default="fullVisitorId", help="columna clave al construir el índice")
+    parser.add_argument("--formato", choices=["csv", "json"], default="csv", help="formato de salida")
+    args = parser.parse_intermixed_args(argumentos)
+
+    if args.construir:
+        inicio = time.perf_counter()
+        metadatos = indexar_archivo(args.archivo_csv, args.columna, args.indice)
+        print(f"Índice construido: {metadatos['total_filas']} filas en "
+              f"{time.perf_counter() - inicio:.2f} s", file=sys.stderr)
+    if not args.valores:
+        return
+
+    inicio = time.perf_counter()
+    resultado = buscar(args.archivo_csv, args.valores, args.indice)
+    transcurrido_ms = (time.perf_counter() - inicio) * 1000
+    if args.formato == "json":
+        resultado.to_json(sys.stdout, orient="records", force_ascii=False, indent=2)
+        print()
+    else:
+        resultado.to_csv(sys.stdout, index=False)
+    print(f"{len(resultado)} filas encontradas en {transcurrido_ms:.1f} ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,92 +7,271 @@ import json
 import logging
 import csv
 import traceback
+import io
+import sys
+import argparse
+import itertools
+import multiprocessing
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 from datetime import datetime
 import psutil
 
-# Configuración de logging
+from cache_columnas import CacheColumnas, calcular_huella_bloque, huella_codigo
+from estadisticas_streaming import MuestraReservorio, PerfilColumna, SketchCuantiles
+from indice_visitantes import IndiceVisitantes, indexar_archivo
+from muestreo import escribir_muestra, leer_muestra, ruta_muestra
+from particionado import EscritorParticionado, particionar_csv_en_texto
+from registro_cola import configurar_registro_en_cola, detener_registro_en_cola
+from poda_columnas import SeguimientoColumnas, cargar_columnas_podadas, esquema_sin_columnas, reescribir_sin_columnas
+from salida_sqlite import EscritorSQLite
+from registros_csv import formatear_cabecera, iterar_bloques, iterar_registros, separar_registros
+from telemetria import MuestreadorRecursos, proceso_actual
+
+# Configuración de logging: el archivo y la consola se escriben desde un hilo a
+# través de una cola acotada, sin bloquear la limpieza (ver registro_cola.py). Se
+# reconfigura en cada ejecución: en el modo vigilancia el script se ejecuta varias
+# veces en el mismo proceso y cada lote necesita su propio archivo de log
 log_filename = f"reporte_limpieza_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+configurar_registro_en_cola(
+    [logging.FileHandler(log_filename, encoding='utf-8'), logging.StreamHandler()],
+    nivel=logging.INFO,
+    formato='%(asctime)s - %(levelname)s - %(message)s',
 )
 logger = logging.getLogger()
 
 # Aumentar el límite de campos de CSV
 csv.field_size_limit(1000000)  # Aumentar para manejar campos grandes
 
+# Ruta que indica entrada o salida estándar (modo tubería)
+FLUJO_ESTANDAR = "-"
+
+# Buffer del archivo de salida (menos llamadas al sistema al escribir lotes grandes)
+TAMANO_BUFFER_ESCRITURA = 8 * 1024 * 1024
+
+# Modo paralelo: memoria estimada de un lote en vuelo (DataFrame, copia limpia y CSV
+# resultante) como múltiplo del tamaño en bytes del bloque leído
+FACTOR_MEMORIA_LOTE = 6
+
+# Opciones de lectura comunes a la ruta rápida (pandas) y a la tolerante (módulo csv)
+OPCIONES_LECTURA_CSV = {
+    "escapechar": '\\',  # Caracter de escape
+    "quotechar": '"',  # Caracter de comillas
+    "doublequote": True,  # Manejar dobles comillas
+    "skipinitialspace": True,  # Saltar espacios iniciales
+}
+
+# Valores aceptados al convertir texto a columnas booleanas en la ruta tolerante
+_VALORES_BOOLEANOS = {"True": True, "False": False, "true": True, "false": False,
+                      "TRUE": True, "FALSE": False}
+
+# Reglas de validación por fila. Se declaran aquí y se compilan una sola vez a
+# máscaras booleanas vectorizadas; las reglas cuyas columnas no existen en el
+# lote se omiten. Tipos soportados:
+#   - "requerido": la columna no puede ser nula ni vacía
+#   - "numerico": el valor (si existe) debe ser numérico; "entero" exige enteros
+#   - "rango": el valor numérico debe estar entre "min" y/o "max"
+#   - "regex": el valor (si existe) debe cumplir el patrón
+#   - "fecha": el valor (si existe) debe poder interpretarse como fecha
+#   - "comparacion": compara "columna" con "otra_columna" usando "operador"
+REGLAS_VALIDACION = [
+    {"nombre": "fullVisitorId_requerido", "tipo": "requerido", "columna": "fullVisitorId"},
+    {"nombre": "fullVisitorId_formato", "tipo": "regex", "columna": "fullVisitorId", "patron": r"^\d+$"},
+    {"nombre": "visitId_requerido", "tipo": "requerido", "columna": "visitId"},
+    {"nombre": "date_requerido", "tipo": "requerido", "columna": "date"},
+    {"nombre": "date_formato", "tipo": "fecha", "columna": "date"},
+    {"nombre": "visitNumber_entero", "tipo": "numerico", "columna": "visitNumber", "entero": True},
+    {"nombre": "visitNumber_rango", "tipo": "rango", "columna": "visitNumber", "min": 1},
+    {"nombre": "visitStartTime_rango", "tipo": "rango", "columna": "visitStartTime", "min": 0},
+    {"nombre": "hits_count_rango", "tipo": "rango", "columna": "hits_count", "min": 0},
+    {"nombre": "totals_pageviews_rango", "tipo": "rango", "columna": "totals_pageviews", "min": 0},
+    {"nombre": "totals_hits_rango", "tipo": "rango", "columna": "totals_hits", "min": 0},
+    {"nombre": "pageviews_menor_igual_hits", "tipo": "comparacion", "columna": "totals_pageviews",
+     "operador": "<=", "otra_columna": "hits_count"},
+]
+
+_OPERADORES_COMPARACION = {
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+}
+
+# Errores de filas: conteos por tipo y una muestra de filas de ejemplo, en memoria acotada
+MAX_TIPOS_ERROR = 100  # Tipos distintos contados por separado; el resto se acumula en TIPO_ERROR_OTROS
+TIPO_ERROR_OTROS = "Otros errores"
+EJEMPLOS_FILAS_CON_ERROR = 100  # Filas de ejemplo (muestra uniforme de todas las que fallaron)
+
 # Clase para manejar estadísticas y reportes
 class EstadisticasLimpieza:
     def __init__(self):
         self.tiempo_inicio = time.time()
         self.filas_procesadas = 0
-        self.filas_con_error = {}  # {indice_fila: mensaje_error}
+        self.filas_con_error = 0
+        self.errores_por_tipo = {}  # {tipo_error: filas}, como mucho MAX_TIPOS_ERROR tipos (+ otros)
+        self.muestra_errores = MuestraReservorio(EJEMPLOS_FILAS_CON_ERROR)  # [(indice_fila, tipo_error)]
         self.cambios_realizados = {}  # {tipo_cambio: cantidad}
         self.memoria_usada = []
         self.estadisticas_columnas = {}
+        self.perfiles_columnas = {}  # {columna: PerfilColumna} acumulados en todos los lotes
+        self.sketches_cuantiles = {}  # {columna: SketchCuantiles} acumulados en todos los lotes
+        self.limites_outliers = {}  # {columna: límites IQR globales}
+        self.registros_cuarentena = 0  # Registros rechazados y enviados al archivo de cuarentena
+        self.telemetria = None  # MuestreadorRecursos en segundo plano (opcional)
+        self.uso_cache_columnas = {"reutilizadas": 0, "recalculadas": 0}  # Columnas por lote (CacheColumnas)
+        self.seguimiento_columnas = SeguimientoColumnas()  # Columnas vacías o constantes tras la limpieza
+        self.columnas_podadas = {}  # {columna: motivo} de las columnas quitadas de la salida
         
-    def actualizar_memoria(self):
+    def actualizar_memoria(self, incluir_hijos=False):
         """Registra el uso actual de memoria"""
-        mem_uso = round(self.obtener_uso_memoria_gb(), 2)
+        mem_uso = round(self.obtener_uso_memoria_gb(incluir_hijos), 2)
         self.memoria_usada.append(mem_uso)
         return mem_uso
     
     @staticmethod
-    def obtener_uso_memoria_gb():
-        """Obtiene el uso actual de memoria en GB"""
-        proceso = psutil.Process(os.getpid())
-        mem_info = proceso.memory_info()
-        return mem_info.rss / (1024 ** 3)  # Convertir a GB
+    def obtener_uso_memoria_gb(incluir_hijos=False):
+        """Obtiene el uso actual de memoria en GB (opcionalmente sumando los procesos hijos)"""
+        proceso = proceso_actual()
+        rss = proceso.memory_info().rss
+        if incluir_hijos:
+            for hijo in proceso.children(recursive=True):
+                try:
+                    rss += hijo.memory_info().rss
+                except psutil.Error:
+                    pass  # El proceso terminó entre la consulta y la lectura
+        return rss / (1024 ** 3)  # Convertir a GB
     
+    def _contar_errores(self, tipo_error, cantidad):
+        if tipo_error not in self.errores_por_tipo and len(self.errores_por_tipo) >= MAX_TIPOS_ERROR:
+            tipo_error = TIPO_ERROR_OTROS
+        self.errores_por_tipo[tipo_error] = self.errores_por_tipo.get(tipo_error, 0) + int(cantidad)
+        self.filas_con_error += int(cantidad)
+
     def registrar_error(self, indice, error):
-        """Registra un error en una fila específica"""
-        self.filas_con_error[str(indice)] = str(error)
-        logger.warning(f"Error en fila {indice}: {error}")
-    
+        """Registra un error en una fila específica (el llamador ya lo escribió en el log)"""
+        self._contar_errores(str(error), 1)
+        self.muestra_errores.actualizar([(str(indice), str(error))])
+
+    def registrar_errores(self, errores):
+        """Registra en bloque los errores de un lote (serie indice_fila -> tipo de error)"""
+        if len(errores) == 0:
+            return
+        for tipo_error, cantidad in errores.value_counts(sort=False).items():
+            self._contar_errores(tipo_error, cantidad)
+        self.muestra_errores.actualizar(list(zip(errores.index.astype(str), errores)))
+        logger.warning(f"{len(errores)} filas no superaron la validación en este lote")
+
     def registrar_cambio(self, tipo_cambio, incremento=1):
         """Registra un tipo de cambio realizado durante la limpieza"""
+        incremento = int(incremento)  # Evitar enteros de numpy, que no son serializables a JSON
         if tipo_cambio in self.cambios_realizados:
             self.cambios_realizados[tipo_cambio] += incremento
         else:
             self.cambios_realizados[tipo_cambio] = incremento
     
+    def registrar_uso_cache(self, reutilizadas=0, recalculadas=0):
+        """Cuenta las columnas leídas de la caché de columnas limpias y las recalculadas"""
+        self.uso_cache_columnas["reutilizadas"] += reutilizadas
+        self.uso_cache_columnas["recalculadas"] += recalculadas
+    
+    def fusionar(self, otra):
+        """Incorpora las estadísticas parciales de otra instancia (lotes disjuntos, p. ej. de otro proceso)"""
+        self.filas_procesadas += otra.filas_procesadas
+        for tipo_error, cantidad in otra.errores_por_tipo.items():
+            self._contar_errores(tipo_error, cantidad)
+        self.muestra_errores.fusionar(otra.muestra_errores)
+        for tipo_cambio, cantidad in otra.cambios_realizados.items():
+            self.registrar_cambio(tipo_cambio, cantidad)
+        for columna, perfil in otra.perfiles_columnas.items():
+            if columna in self.perfiles_columnas:
+                self.perfiles_columnas[columna].fusionar(perfil)
+            else:
+                self.perfiles_columnas[columna] = perfil
+        for columna, sketch in otra.sketches_cuantiles.items():
+            if columna in self.sketches_cuantiles:
+                self.sketches_cuantiles[columna].fusionar(sketch)
+            else:
+                self.sketches_cuantiles[columna] = sketch
+        self.registros_cuarentena += otra.registros_cuarentena
+        self.registrar_uso_cache(**otra.uso_cache_columnas)
+        self.seguimiento_columnas.fusionar(otra.seguimiento_columnas)
+        return self
+
+    def guardar_estado(self, ruta):
+        """
+        Guarda las estadísticas acumuladas (perfiles, sketches, errores...) para
+        fusionarlas desde otro proceso o máquina (p. ej. al unir fragmentos).
+        """
+        estado = {clave: valor for clave, valor in vars(self).items() if clave != "telemetria"}
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "wb") as f:
+            pickle.dump(estado, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, ruta)
+
+    @classmethod
+    def cargar_estado(cls, ruta):
+        """Estadísticas guardadas con guardar_estado"""
+        estadisticas = cls()
+        with open(ruta, "rb") as f:
+            estadisticas.__dict__.update(pickle.load(f))
+        return estadisticas
+
+    def actualizar_cuantiles(self, nombre_columna, serie):
+        """Agrega los valores de una columna numérica al sketch de cuantiles global"""
+        sketch = self.sketches_cuantiles.get(nombre_columna)
+        if sketch is None:
+            sketch = SketchCuantiles()
+            self.sketches_cuantiles[nombre_columna] = sketch
+        valores = pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        sketch.actualizar(valores)
+
+    def calcular_limites_outliers(self, factor=3.0):
+        """Calcula los límites de outliers (Q1/Q3 ± factor*IQR) sobre todo el dataset"""
+        self.limites_outliers = {}
+        for columna, sketch in self.sketches_cuantiles.items():
+            limites = sketch.limites_iqr(factor)
+            if limites is not None:
+                self.limites_outliers[columna] = limites
+        return self.limites_outliers
+
     def calcular_estadisticas_columna(self, df, nombre_columna):
-        """Calcula estadísticas para una columna específica"""
+        """Acumula las estadísticas del lote para una columna específica"""
         try:
-            stats = {}
-            # Para columnas numéricas
-            if pd.api.types.is_numeric_dtype(df[nombre_columna]):
-                stats["tipo"] = "numérica"
-                stats["media"] = float(df[nombre_columna].mean()) if not df[nombre_columna].isna().all() else 0
-                stats["mediana"] = float(df[nombre_columna].median()) if not df[nombre_columna].isna().all() else 0
-                stats["desviacion_estandar"] = float(df[nombre_columna].std()) if not df[nombre_columna].isna().all() else 0
-                stats["min"] = float(df[nombre_columna].min()) if not df[nombre_columna].isna().all() else 0
-                stats["max"] = float(df[nombre_columna].max()) if not df[nombre_columna].isna().all() else 0
-                stats["nulos"] = int(df[nombre_columna].isna().sum())
-                stats["ceros"] = int((df[nombre_columna] == 0).sum())
-            # Para columnas categóricas/texto
-            else:
-                stats["tipo"] = "texto/categórica"
-                # Valores más frecuentes (top 5)
-                value_counts = df[nombre_columna].value_counts().head(5).to_dict()
-                stats["valores_frecuentes"] = {str(k): int(v) for k, v in value_counts.items()}
-                stats["nulos"] = int(df[nombre_columna].isna().sum())
-                stats["vacios"] = int((df[nombre_columna] == "").sum()) if df[nombre_columna].dtype == 'object' else 0
-                # Longitud promedio para textos
-                if df[nombre_columna].dtype == 'object':
-                    stats["longitud_promedio"] = float(df[nombre_columna].fillna("").astype(str).str.len().mean())
-            
-            self.estadisticas_columnas[nombre_columna] = stats
+            perfil = self.perfiles_columnas.get(nombre_columna)
+            if perfil is None:
+                perfil = PerfilColumna()
+                self.perfiles_columnas[nombre_columna] = perfil
+            perfil.actualizar(df[nombre_columna])
         except Exception as e:
             logger.warning(f"No se pudieron calcular estadísticas para columna {nombre_columna}: {e}")
+
+    def resumir_estadisticas_columnas(self):
+        """Convierte los perfiles acumulados en el diccionario de estadísticas del reporte"""
+        for nombre_columna, perfil in self.perfiles_columnas.items():
+            try:
+                self.estadisticas_columnas[nombre_columna] = perfil.resumen(
+                    self.sketches_cuantiles.get(nombre_columna)
+                )
+            except Exception as e:
+                logger.warning(f"No se pudieron resumir estadísticas para columna {nombre_columna}: {e}")
+        return self.estadisticas_columnas
     
     def generar_reporte(self, nombre_archivo, columnas_originales, columnas_finales):
         """Genera un reporte detallado en formato JSON y texto"""
         tiempo_total = time.time() - self.tiempo_inicio
+        if not self.limites_outliers:
+            self.calcular_limites_outliers()
+        self.resumir_estadisticas_columnas()
+        memoria_maxima = max(self.memoria_usada) if self.memoria_usada else 0
+        telemetria = self.telemetria.resumen() if self.telemetria is not None else None
+        if telemetria:
+            # El muestreador ve los picos dentro de los lotes, no solo al terminar cada uno
+            memoria_maxima = max(memoria_maxima, telemetria["memoria_pico_gb"])
         
         # Crear reporte en JSON
         reporte = {
@@ -101,9 +280,10 @@ class EstadisticasLimpieza:
                 "tiempo_procesamiento_segundos": round(tiempo_total, 2),
                 "tiempo_procesamiento_minutos": round(tiempo_total / 60, 2),
                 "filas_procesadas": self.filas_procesadas,
-                "filas_con_error": len(self.filas_con_error),
+                "filas_con_error": self.filas_con_error,
+                "registros_cuarentena": self.registros_cuarentena,
                 "cambios_realizados": self.cambios_realizados,
-                "memoria_maxima_gb": round(max(self.memoria_usada), 2) if self.memoria_usada else 0,
+                "memoria_maxima_gb": round(memoria_maxima, 2),
                 "memoria_promedio_gb": round(sum(self.memoria_usada) / len(self.memoria_usada), 2) if self.memoria_usada else 0
             },
             "columnas": {
@@ -113,8 +293,18 @@ class EstadisticasLimpieza:
                 "eliminadas": list(set(columnas_originales) - set(columnas_finales)) if columnas_finales and columnas_originales else []
             },
             "estadisticas_columnas": self.estadisticas_columnas,
-            "filas_con_error": self.filas_con_error
+            "outliers": self.limites_outliers,
+            "errores_por_tipo": dict(sorted(self.errores_por_tipo.items(), key=lambda x: x[1], reverse=True)),
+            # Filas de ejemplo en orden numérico de su índice
+            "muestra_filas_con_error": dict(sorted(self.muestra_errores.elementos,
+                                                   key=lambda x: (len(x[0]), x[0])))
         }
+        if telemetria:
+            reporte["telemetria"] = telemetria
+        if any(self.uso_cache_columnas.values()):
+            reporte["resumen"]["cache_columnas"] = self.uso_cache_columnas
+        if self.columnas_podadas:
+            reporte["columnas"]["podadas"] = self.columnas_podadas
         
         # Guardar reporte en JSON
         with open("reporte_limpieza_datos.json", "w", encoding="utf-8") as f:
@@ -141,9 +331,20 @@ class EstadisticasLimpieza:
             f.write(f"Tiempo de procesamiento: {reporte['resumen']['tiempo_procesamiento_minutos']:.2f} minutos ({reporte['resumen']['tiempo_procesamiento_segundos']:.2f} segundos)\n")
             f.write(f"Filas procesadas: {reporte['resumen']['filas_procesadas']}\n")
             f.write(f"Filas con errores: {reporte['resumen']['filas_con_error']}\n")
+            f.write(f"Registros en cuarentena: {reporte['resumen'].get('registros_cuarentena', 0)}\n")
             f.write(f"Memoria máxima utilizada: {reporte['resumen']['memoria_maxima_gb']:.2f} GB\n")
             f.write(f"Memoria promedio utilizada: {reporte['resumen']['memoria_promedio_gb']:.2f} GB\n\n")
             
+            # Telemetría de recursos
+            if reporte.get('telemetria'):
+                tel = reporte['telemetria']
+                f.write("TELEMETRÍA DE RECURSOS\n")
+                f.write("-" * 80 + "\n")
+                f.write(f"Pico de memoria (muestreo cada {tel['intervalo_segundos']} s + pico del SO): {tel['memoria_pico_gb']:.2f} GB\n")
+                f.write(f"CPU promedio: {tel['cpu_promedio_porcentaje']:.1f}%\n")
+                f.write(f"Bytes leídos / escritos: {tel['bytes_leidos']} / {tel['bytes_escritos']}\n")
+                f.write(f"Pausas del GC: {tel['gc_pausas']} (total {tel['gc_pausa_total_ms']:.1f} ms, máxima {tel['gc_pausa_max_ms']:.1f} ms)\n\n")
+            
             # Cambios realizados
             f.write("CAMBIOS REALIZADOS\n")
             f.write("-" * 80 + "\n")
@@ -164,8 +365,9 @@ class EstadisticasLimpieza:
             
             if reporte['columnas']['eliminadas']:
                 f.write("\nColumnas eliminadas:\n")
+                podadas = reporte['columnas'].get('podadas', {})
                 for col in reporte['columnas']['eliminadas']:
-                    f.write(f"• {col}\n")
+                    f.write(f"• {col}" + (f" ({podadas[col]})" if col in podadas else "") + "\n")
             f.write("\n")
             
             # Estadísticas de columnas
@@ -181,6 +383,8 @@ class EstadisticasLimpieza:
                     
                 f.write(f"Columna: {col_name}\n")
                 f.write(f"  Tipo: {stats['tipo']}\n")
+                if 'distintos_aprox' in stats:
+                    f.write(f"  Valores distintos (aprox.): {stats['distintos_aprox']}\n")
                 
                 if stats['tipo'] == "numérica":
                     f.write(f"  Media: {stats.get('media', 0):.2f}\n")
@@ -204,21 +408,40 @@ class EstadisticasLimpieza:
                         f.write(f"    - {val_str}: {count}\n")
                 f.write("\n")
             
+            # Outliers con límites globales
+            columnas_con_outliers = sorted(
+                ((col, lim) for col, lim in reporte.get('outliers', {}).items()
+                 if lim.get('outliers_exactos', lim['outliers_estimados']) > 0),
+                key=lambda x: x[1].get('outliers_exactos', x[1]['outliers_estimados']),
+                reverse=True
+            )
+            if columnas_con_outliers:
+                f.write("OUTLIERS (LÍMITES GLOBALES Q1/Q3 ± 3·IQR)\n")
+                f.write("-" * 80 + "\n")
+                for col_name, lim in columnas_con_outliers[:20]:
+                    if 'outliers_exactos' in lim:
+                        cantidad = f"{lim['outliers_exactos']} (exacto)"
+                    else:
+                        cantidad = f"~{lim['outliers_estimados']} (estimado)"
+                    f.write(f"• {col_name}: {cantidad}, límites [{lim['limite_inferior']:.2f}, {lim['limite_superior']:.2f}]\n")
+                if len(columnas_con_outliers) > 20:
+                    f.write(f"... y {len(columnas_con_outliers) - 20} columnas más con outliers\n")
+                f.write("\n")
+            
             # Filas con error
-            if reporte['filas_con_error']:
+            if reporte['resumen']['filas_con_error']:
                 f.write("FILAS CON ERROR\n")
                 f.write("-" * 80 + "\n")
-                f.write(f"Total de filas con error: {len(reporte['filas_con_error'])}\n\n")
+                f.write(f"Total de filas con error: {reporte['resumen']['filas_con_error']}\n\n")
+                for tipo_error, cantidad in list(reporte['errores_por_tipo'].items())[:10]:
+                    f.write(f"• {tipo_error}: {cantidad} filas\n")
+                if len(reporte['errores_por_tipo']) > 10:
+                    f.write(f"... y {len(reporte['errores_por_tipo']) - 10} tipos de error más\n")
                 
-                # Mostrar solo los primeros 10 errores para no hacer el reporte demasiado largo
-                count = 0
-                for idx, error in reporte['filas_con_error'].items():
-                    if count < 10:
-                        f.write(f"Fila {idx}: {error}\n")
-                        count += 1
-                    else:
-                        f.write(f"... y {len(reporte['filas_con_error']) - 10} errores más\n")
-                        break
+                # Mostrar solo 10 filas de ejemplo para no hacer el reporte demasiado largo
+                f.write("\nFilas de ejemplo (muestra aleatoria):\n")
+                for idx, error in list(reporte['muestra_filas_con_error'].items())[:10]:
+                    f.write(f"Fila {idx}: {error}\n")
             
             f.write("\n" + "=" * 80 + "\n")
             f.write("FIN DEL REPORTE\n")
@@ -262,34 +485,433 @@ def corregir_formato_fecha(fecha, formatos_posibles=None):
     except:
         return fecha
 
-def limpiar_lote(df, estadisticas):
-    """Aplica limpieza a un lote de datos"""
+def _a_fecha_vectorizado(serie):
+    """Convierte una serie a fechas de forma vectorizada (NaT si no es interpretable)"""
     try:
-        # Copiar el DataFrame para no modificar el original
-        df_limpio = df.copy()
-        filas_iniciales = len(df_limpio)
-        
-        # 1. Limpiar espacios y caracteres especiales en columnas de texto
-        for columna in df_limpio.select_dtypes(include=['object']).columns:
+        return pd.to_datetime(serie, errors='coerce', format='mixed')
+    except (TypeError, ValueError):
+        # Versiones de pandas sin soporte para format='mixed'
+        return pd.to_datetime(serie, errors='coerce')
+
+def _compilar_regla(regla):
+    """
+    Convierte una regla declarativa en una función que recibe el lote y devuelve
+    una máscara booleana con las filas que NO cumplen la regla.
+    """
+    tipo = regla["tipo"]
+    columna = regla["columna"]
+
+    if tipo == "requerido":
+        def evaluar(df):
+            serie = df[columna]
+            faltantes = serie.isna()
+            if serie.dtype == 'object' or pd.api.types.is_string_dtype(serie):
+                faltantes |= serie.astype(str).str.strip() == ""
+            return faltantes
+
+    elif tipo == "numerico":
+        entero = regla.get("entero", False)
+
+        def evaluar(df):
+            serie = df[columna]
+            valores = pd.to_numeric(serie, errors='coerce')
+            invalidos = valores.isna() & serie.notna()
+            if entero:
+                invalidos |= valores.notna() & (valores % 1 != 0)
+            return invalidos
+
+    elif tipo == "rango":
+        minimo = regla.get("min")
+        maximo = regla.get("max")
+
+        def evaluar(df):
+            valores = pd.to_numeric(df[columna], errors='coerce')
+            invalidos = pd.Series(False, index=df.index)
+            if minimo is not None:
+                invalidos |= valores < minimo
+            if maximo is not None:
+                invalidos |= valores > maximo
+            return invalidos
+
+    elif tipo == "regex":
+        patron = regla["patron"]
+
+        def evaluar(df):
+            serie = df[columna]
+            presentes = serie.notna()
+            cumple = serie[presentes].astype(str).str.match(patron)
+            return presentes & ~cumple.reindex(df.index, fill_value=True)
+
+    elif tipo == "fecha":
+        def evaluar(df):
+            serie = df[columna]
+            if pd.api.types.is_datetime64_any_dtype(serie):
+                return pd.Series(False, index=df.index)
+            return _a_fecha_vectorizado(serie).isna() & serie.notna()
+
+    elif tipo == "comparacion":
+        otra_columna = regla["otra_columna"]
+        operador = _OPERADORES_COMPARACION[regla["operador"]]
+
+        def evaluar(df):
+            a = pd.to_numeric(df[columna], errors='coerce')
+            b = pd.to_numeric(df[otra_columna], errors='coerce')
+            # Solo se evalúan las filas con ambos valores presentes
+            return a.notna() & b.notna() & ~operador(a, b)
+
+    else:
+        raise ValueError(f"Tipo de regla de validación desconocido: {tipo}")
+
+    columnas_requeridas = [columna] + ([regla["otra_columna"]] if "otra_columna" in regla else [])
+    return regla["nombre"], columnas_requeridas, evaluar
+
+def compilar_reglas(reglas=None):
+    """Compila la lista de reglas declarativas (por defecto REGLAS_VALIDACION)"""
+    if reglas is None:
+        reglas = REGLAS_VALIDACION
+    return [_compilar_regla(regla) for regla in reglas]
+
+def validar_lote(df, reglas_compiladas, estadisticas):
+    """
+    Evalúa las reglas compiladas sobre el lote completo sin iterar filas y registra
+    en las estadísticas las filas que fallan junto con los nombres de las reglas.
+
+    Returns:
+        Serie booleana con True en las filas que no superaron alguna regla
+    """
+    mascaras = {}
+    for nombre, columnas_requeridas, evaluar in reglas_compiladas:
+        if not all(col in df.columns for col in columnas_requeridas):
+            continue
+        try:
+            mascara = evaluar(df).fillna(False).astype(bool)
+        except Exception as e:
+            logger.error(f"Error al evaluar la regla de validación '{nombre}': {e}")
+            continue
+        num_fallos = int(mascara.sum())
+        if num_fallos > 0:
+            mascaras[nombre] = mascara
+            estadisticas.registrar_cambio(f"Filas que no cumplen la regla '{nombre}'", num_fallos)
+
+    if not mascaras:
+        return pd.Series(False, index=df.index)
+
+    fallos = pd.DataFrame(mascaras)
+    filas_fallidas = fallos.any(axis=1)
+    # Producto matricial booleano x texto: concatena los nombres de las reglas incumplidas
+    nombres = fallos[filas_fallidas].dot(pd.Index(fallos.columns) + ', ').str.rstrip(', ')
+    estadisticas.registrar_errores("Reglas incumplidas: " + nombres)
+    return filas_fallidas
+
+def _es_columna_fecha(nombre_columna):
+    """Indica si limpiar_lote tratará la columna como fecha"""
+    return 'fecha' in nombre_columna.lower() or 'date' in nombre_columna.lower()
+
+def _es_columna_identificador(nombre_columna):
+    """Los identificadores se leen como texto para no perder ceros ni desbordar enteros"""
+    return nombre_columna.endswith('Id') or nombre_columna.endswith('_id')
+
+def _tipo_entero_minimo(minimo, maximo, holgura=4):
+    """Devuelve el tipo entero nullable más pequeño que admite el rango con holgura"""
+    limite = max(abs(minimo), abs(maximo)) * holgura
+    # Int8 se omite a propósito: ahorra poco y es el que más fácil se desborda entre lotes
+    for tipo, maximo_tipo in (("Int16", 2 ** 15 - 1), ("Int32", 2 ** 31 - 1)):
+        if limite <= maximo_tipo:
+            return tipo
+    return "Int64"
+
+# Tipos de un esquema guardado que se relajan al reutilizarlo con otro archivo
+_TIPOS_ESQUEMA_REUTILIZADO = {"Int16": "Int64", "Int32": "Int64"}
+
+def inferir_esquema(archivo_entrada, filas_muestra=10000, umbral_categorias=50, columnas_excluidas=None,
+                    muestra=None):
+    """
+    Infiere los tipos de cada columna a partir de una muestra del archivo para
+    fijarlos en todas las lecturas por lotes (menos memoria y sin cambios de tipo
+    entre lotes).
+
+    Reglas:
+        - Identificadores y columnas de fecha: texto (las fechas las interpreta limpiar_lote)
+        - Enteros: el tipo entero nullable más pequeño con holgura (Int16/Int32/Int64)
+        - Decimales: float64 (no se reduce para no perder precisión en importes)
+        - Booleanos: boolean nullable
+        - Texto con pocos valores distintos: category; el resto, texto
+
+    Args:
+        archivo_entrada: ruta al archivo CSV
+        filas_muestra: número de filas a analizar (muestra aleatoria de todo el archivo)
+        umbral_categorias: máximo de valores distintos para usar category
+        columnas_excluidas: columnas que no se leerán (se quedan fuera de usecols)
+        muestra: DataFrame de texto ya leído (p. ej. el primer bloque de la entrada
+                 estándar); si se indica, no se lee archivo_entrada
+
+    Returns:
+        Diccionario con las claves "columnas", "dtype", "usecols" y "excluidas"
+    """
+    columnas_excluidas = set(columnas_excluidas or [])
+    if muestra is None:
+        muestra = leer_muestra(archivo_entrada, filas_muestra, semilla=0, dtype=str, on_bad_lines='skip')
+
+    tipos = {}
+    for columna in muestra.columns:
+        if columna in columnas_excluidas:
+            continue
+        valores = muestra[columna].dropna()
+        if len(valores) == 0 or _es_columna_fecha(columna) or _es_columna_identificador(columna):
+            tipos[columna] = "str"
+            continue
+
+        if valores.isin(["True", "False", "true", "false"]).all():
+            tipos[columna] = "boolean"
+            continue
+
+        numeros = pd.to_numeric(valores, errors='coerce')
+        if numeros.notna().all():
+            es_entero = (numeros % 1 == 0).all() and not valores.str.contains(r'[.eE]', regex=True).any()
+            tipos[columna] = _tipo_entero_minimo(numeros.min(), numeros.max()) if es_entero else "float64"
+            continue
+
+        num_distintos = valores.nunique()
+        if num_distintos <= umbral_categorias and num_distintos <= len(valores) / 2:
+            tipos[columna] = "category"
+        else:
+            tipos[columna] = "str"
+
+    return {
+        "columnas": list(muestra.columns),
+        "dtype": tipos,
+        "usecols": [col for col in muestra.columns if col not in columnas_excluidas],
+        "excluidas": [col for col in muestra.columns if col in columnas_excluidas],
+    }
+
+def obtener_esquema(archivo_entrada, archivo_esquema=None, columnas_excluidas=None, columnas_actuales=None,
+                    **kwargs):
+    """
+    Carga el esquema desde archivo_esquema si existe y corresponde a las columnas
+    del archivo de entrada (o a columnas_actuales, si la entrada no es un archivo);
+    si no, lo infiere y lo guarda en archivo_esquema. Al reutilizar un esquema
+    guardado, sus enteros Int16/Int32 se leen como Int64.
+    """
+    if columnas_actuales is None:
+        with open(archivo_entrada, 'r', encoding='utf-8', errors='replace') as f:
+            columnas_actuales = next(csv.reader([f.readline()]))
+
+    if archivo_esquema and os.path.exists(archivo_esquema):
+        try:
+            with open(archivo_esquema, 'r', encoding='utf-8') as f:
+                esquema = json.load(f)
+            if esquema.get("columnas") == columnas_actuales:
+                logger.info(f"Esquema cargado desde {archivo_esquema}")
+                nuevas_excluidas = set(columnas_excluidas or []) - set(esquema["excluidas"])
+                if nuevas_excluidas:
+                    # Las exclusiones pedidas se suman a las ya guardadas en el esquema
+                    esquema["excluidas"] = [col for col in columnas_actuales
+                                            if col in nuevas_excluidas or col in esquema["excluidas"]]
+                    esquema["usecols"] = [col for col in esquema["usecols"] if col not in nuevas_excluidas]
+                    esquema["dtype"] = {col: tipo for col, tipo in esquema["dtype"].items()
+                                        if col not in nuevas_excluidas}
+                    with open(archivo_esquema, 'w', encoding='utf-8') as f:
+                        json.dump(esquema, f, ensure_ascii=False, indent=4)
+                # Los tipos guardados salen de la muestra de otro archivo: los enteros pequeños
+                # se ensanchan a Int64 (y _leer_bloque ensancha lo que aun así no encaje)
+                esquema["dtype"] = {col: _TIPOS_ESQUEMA_REUTILIZADO.get(tipo, tipo)
+                                    for col, tipo in esquema["dtype"].items()}
+                return esquema
+            logger.warning(f"El esquema {archivo_esquema} no coincide con las columnas de {archivo_entrada}; se vuelve a inferir")
+        except Exception as e:
+            logger.warning(f"No se pudo leer el esquema {archivo_esquema}: {e}")
+
+    logger.info("Infiriendo tipos de columnas a partir de una muestra...")
+    esquema = inferir_esquema(archivo_entrada, columnas_excluidas=columnas_excluidas, **kwargs)
+    resumen_tipos = {}
+    for tipo in esquema["dtype"].values():
+        resumen_tipos[tipo] = resumen_tipos.get(tipo, 0) + 1
+    logger.info(f"Tipos inferidos: {resumen_tipos}; columnas excluidas: {len(esquema['excluidas'])}")
+
+    if archivo_esquema:
+        with open(archivo_esquema, 'w', encoding='utf-8') as f:
+            json.dump(esquema, f, ensure_ascii=False, indent=4)
+        logger.info(f"Esquema guardado en {archivo_esquema}")
+    return esquema
+
+def _aplicar_a_categorias(serie, funcion):
+    """Aplica una función de texto a las categorías de una columna categórica, no a cada fila"""
+    categorias = serie.cat.categories
+    nuevas = pd.Index([funcion(c) if isinstance(c, str) else c for c in categorias])
+    if nuevas.is_unique and not nuevas.hasnans:
+        return serie.cat.rename_categories(nuevas)
+    # Si dos categorías quedan iguales tras la transformación, se recodifica la columna
+    return serie.map(dict(zip(categorias, nuevas))).astype('category')
+
+# Columnas con menos valores distintos que este umbral (en el lote) se normalizan como categorías
+UMBRAL_NORMALIZACION_CATEGORIAS = 20  # Umbral arbitrario
+
+def _es_de_tipo(serie, tipos):
+    """Equivale a df.select_dtypes(include=tipos) para una sola columna"""
+    return serie.to_frame().select_dtypes(include=tipos).shape[1] == 1
+
+def _aplicar_a_valores_distintos(serie, funcion):
+    """
+    Aplica una función de texto una vez por valor distinto: las filas repetidas
+    comparten el objeto resultante (como los textos que deduplica el lector CSV)
+    en lugar de crear uno nuevo por fila
+    """
+    try:
+        resultados = {valor: funcion(valor) for valor in serie.dropna().unique()}
+    except TypeError:
+        return serie.apply(funcion)  # Valores no hashables (p. ej. listas)
+    return serie.map(resultados)
+
+def _normalizar_categorias(serie, es_categorica):
+    """Convierte a minúsculas y elimina espacios al inicio/final (en las categóricas, por categoría)"""
+    if es_categorica:
+        return _aplicar_a_categorias(serie, lambda c: c.lower().strip())
+    # Pocos valores distintos: se normalizan una vez y cada fila reutiliza el resultado
+    distintos = pd.Series(serie.dropna().unique(), dtype=serie.dtype)
+    return serie.map(dict(zip(distintos, distintos.str.lower().str.strip())))
+
+def _grupos_tipos(df):
+    """
+    Columnas de texto y categóricas del lote, calculadas una sola vez para todo el
+    lote en lugar de comprobar el tipo de cada columna por separado
+    """
+    return (set(df.select_dtypes(include=['object']).columns),
+            set(df.select_dtypes(include=['category']).columns))
+
+def _reglas_columna(serie, columna, es_texto=None, es_categorica=None):
+    """Reglas de limpieza que pueden modificar la columna (vacío si se escribe tal cual)"""
+    reglas = []
+    if es_texto is None or es_categorica is None:
+        es_texto, es_categorica = _es_de_tipo(serie, ['object']), _es_de_tipo(serie, ['category'])
+    if es_texto or es_categorica:
+        reglas.append("texto")
+    if _es_columna_fecha(columna):
+        reglas.append("fechas")
+    if reglas:
+        reglas.append("categorias")
+    return reglas
+
+def huellas_reglas_columna():
+    """
+    Huella de cada regla de limpieza por columna (código y parámetros). La caché de
+    columnas limpias guarda cada columna con las huellas de sus reglas, así que al
+    cambiar una regla solo se recalculan las columnas a las que afecta.
+    """
+    return {
+        "texto": huella_codigo(_limpiar_columna, limpiar_texto, _aplicar_a_categorias, _aplicar_a_valores_distintos),
+        "fechas": huella_codigo(_limpiar_columna, corregir_formato_fecha, _es_columna_fecha),
+        "categorias": huella_codigo(_limpiar_columna, _normalizar_categorias, _aplicar_a_categorias,
+                                    UMBRAL_NORMALIZACION_CATEGORIAS),
+    }
+
+def _limpiar_columna(serie, columna, es_texto=None, es_categorica=None):
+    """
+    Aplica a una columna las reglas de limpieza que solo dependen de sus valores:
+    limpieza de texto, corrección de fechas y normalización de categorías.
+    es_texto y es_categorica se calculan si no se indican (ver _grupos_tipos).
+
+    Returns:
+        (columna limpia, [(fase, tipo_cambio)]); la fase permite registrar los cambios
+        de todo el lote en el orden en que se aplican las reglas
+    """
+    cambios = []
+    if es_texto is None:
+        es_texto = _es_de_tipo(serie, ['object'])
+    if es_categorica is None:
+        es_categorica = _es_de_tipo(serie, ['category'])
+    
+    # 1. Limpiar espacios y caracteres especiales en columnas de texto
+    # (en columnas categóricas basta con limpiar cada categoría una vez)
+    if es_texto or es_categorica:
+        fase = 1 if es_texto else 2
+        try:
+            if es_texto:
+                serie = _aplicar_a_valores_distintos(serie, limpiar_texto)
+            else:
+                serie = _aplicar_a_categorias(serie, limpiar_texto)
+            cambios.append((fase, f"Limpieza de texto en columna '{columna}'"))
+        except Exception as e:
+            cambios.append((fase, f"Error al limpiar texto en columna '{columna}'"))
+            logger.error(f"Error al limpiar texto en columna '{columna}': {e}")
+    
+    # 2. Detectar y corregir columnas de fechas
+    if _es_columna_fecha(columna):
+        try:
+            serie = serie.apply(corregir_formato_fecha)
+            cambios.append((3, f"Corrección de formato fecha en columna '{columna}'"))
+        except Exception as e:
+            cambios.append((3, f"Error al corregir fechas en columna '{columna}'"))
+            logger.error(f"Error al corregir fechas en columna '{columna}': {e}")
+    
+    # 5. Convertir formatos consistentes en columnas con pocos valores únicos (probablemente categóricas)
+    for fase, categorica in ((5, False), (6, True)):
+        if (es_categorica if categorica else _es_de_tipo(serie, ['object'])) and \
+                serie.nunique() < UMBRAL_NORMALIZACION_CATEGORIAS:
             try:
-                df_limpio[columna] = df_limpio[columna].apply(limpiar_texto)
-                estadisticas.registrar_cambio(f"Limpieza de texto en columna '{columna}'")
+                serie = _normalizar_categorias(serie, categorica)
+                cambios.append((fase, f"Normalización de categorías en columna '{columna}'"))
             except Exception as e:
-                estadisticas.registrar_cambio(f"Error al limpiar texto en columna '{columna}'")
-                logger.error(f"Error al limpiar texto en columna '{columna}': {e}")
+                logger.error(f"Error al normalizar categorías en columna '{columna}': {e}")
+    
+    return serie, cambios
+
+def limpiar_lote(df, estadisticas, reglas_compiladas=None, cache=None, huella_bloque=None, en_sitio=False):
+    """
+    Aplica limpieza a un lote de datos
+
+    Args:
+        df: lote a limpiar
+        estadisticas: instancia de EstadisticasLimpieza donde se acumulan los resultados
+        reglas_compiladas: reglas de validación ya compiladas (ver compilar_reglas);
+                           si no se indican se compilan REGLAS_VALIDACION
+        cache: CacheColumnas con las columnas limpias de ejecuciones anteriores (opcional)
+        huella_bloque: hash del bloque de origen (ver cache_columnas.calcular_huella_bloque); sin
+                       él no se usa la caché
+        en_sitio: sustituir cada columna del propio lote por su versión limpia en cuanto
+                  se calcula, en lugar de construir un DataFrame nuevo: la columna
+                  original se libera enseguida y el pico de memoria queda cerca del
+                  tamaño del lote. Se devuelve el mismo df; si la limpieza falla a
+                  medias, df queda parcialmente limpio y el error se propaga para
+                  que quien llama escriba el lote original releído
+    """
+    try:
+        filas_iniciales = len(df)
+        columnas_texto, columnas_categoricas = _grupos_tipos(df)
         
-        # 2. Detectar y corregir columnas de fechas
-        posibles_columnas_fecha = [col for col in df_limpio.columns if 'fecha' in col.lower() or 'date' in col.lower()]
-        for columna in posibles_columnas_fecha:
-            try:
-                df_limpio[columna] = df_limpio[columna].apply(corregir_formato_fecha)
-                estadisticas.registrar_cambio(f"Corrección de formato fecha en columna '{columna}'")
-            except Exception as e:
-                estadisticas.registrar_cambio(f"Error al corregir fechas en columna '{columna}'")
-                logger.error(f"Error al corregir fechas en columna '{columna}': {e}")
+        # 1, 2 y 5. Reglas por columna (texto, fechas y categorías); con caché, las
+        # columnas ya limpiadas con las mismas reglas y el mismo bloque se reutilizan
+        columnas_limpias = {}
+        cambios = []  # (fase, tipo_cambio, incremento) en el orden de las columnas
+        for columna in list(df.columns):
+            serie = df[columna]
+            es_texto, es_categorica = columna in columnas_texto, columna in columnas_categoricas
+            clave = en_cache = None
+            if cache is not None and huella_bloque is not None:
+                reglas = _reglas_columna(serie, columna, es_texto, es_categorica)
+                if reglas:
+                    clave = cache.clave(huella_bloque, columna, reglas)
+                    en_cache = cache.cargar(clave, df.index)
+            if en_cache is not None:
+                limpia, cambios_columna = en_cache
+                estadisticas.registrar_uso_cache(reutilizadas=1)
+            else:
+                limpia, cambios_columna = _limpiar_columna(serie, columna, es_texto, es_categorica)
+                if clave is not None:
+                    cache.guardar(clave, limpia, cambios_columna)
+                    estadisticas.registrar_uso_cache(recalculadas=1)
+            cambios.extend((fase, tipo, 1) for fase, tipo in cambios_columna)
+            if not en_sitio:
+                columnas_limpias[columna] = limpia
+            elif limpia is not serie:
+                df[columna] = limpia
+            del serie, limpia, en_cache
+        df_limpio = df if en_sitio else pd.DataFrame(columnas_limpias, index=df.index)
+        del columnas_limpias
+        columnas_numericas = df_limpio.select_dtypes(include=['number']).columns
         
         # 3. Normalizar valores numéricos (por ejemplo, comprobar que no haya caracteres no numéricos)
-        for columna in df_limpio.select_dtypes(include=['number']).columns:
+        # (en sitio df ya es el lote limpio: las reglas no cambian las columnas numéricas)
+        for columna in columnas_numericas:
             try:
                 # Almacenar la cantidad de valores inválidos
                 valores_invalidos = pd.to_numeric(df[columna], errors='coerce').isna() & ~df[columna].isna()
@@ -297,56 +919,34 @@ def limpiar_lote(df, estadisticas):
                 
                 if num_invalidos > 0:
                     # No corregimos, solo registramos
-                    estadisticas.registrar_cambio(f"Detectados {num_invalidos} valores numéricos inválidos en '{columna}'", num_invalidos)
+                    cambios.append((4, f"Detectados {num_invalidos} valores numéricos inválidos en '{columna}'", num_invalidos))
             except Exception as e:
-                estadisticas.registrar_cambio(f"Error al validar valores numéricos en columna '{columna}'")
+                cambios.append((4, f"Error al validar valores numéricos en columna '{columna}'", 1))
                 logger.error(f"Error al validar valores numéricos en columna '{columna}': {e}")
         
+        # Los cambios se registran regla por regla, como si cada una recorriera todo el lote
+        for _, tipo_cambio, incremento in sorted(cambios, key=lambda cambio: cambio[0]):
+            estadisticas.registrar_cambio(tipo_cambio, incremento)
+        
         # 4. Verificar valores atípicos o outliers
-        for columna in df_limpio.select_dtypes(include=['number']).columns:
+        # Solo se alimentan los sketches de cuantiles; los límites (Q1/Q3 ± 3·IQR) se
+        # calculan al final sobre todo el dataset para no depender de los cortes de lote
+        for columna in columnas_numericas:
             try:
-                # Calculamos Q1, Q3 y el rango intercuartílico
-                q1 = df_limpio[columna].quantile(0.25)
-                q3 = df_limpio[columna].quantile(0.75)
-                iqr = q3 - q1
-                
-                # Identificamos outliers severos (no se eliminan, solo se registran)
-                lower_bound = q1 - 3 * iqr
-                upper_bound = q3 + 3 * iqr
-                outliers = ((df_limpio[columna] < lower_bound) | (df_limpio[columna] > upper_bound))
-                num_outliers = outliers.sum()
-                
-                if num_outliers > 0:
-                    estadisticas.registrar_cambio(f"Detectados {num_outliers} outliers en columna '{columna}'", num_outliers)
+                estadisticas.actualizar_cuantiles(columna, df_limpio[columna])
             except Exception as e:
                 logger.error(f"Error al detectar outliers en columna '{columna}': {e}")
         
-        # 5. Convertir formatos consistentes en columnas categóricas
-        for columna in df_limpio.select_dtypes(include=['object']).columns:
-            # Solo procesamos columnas con pocos valores únicos (probablemente categóricas)
-            if df_limpio[columna].nunique() < 20:  # Umbral arbitrario
-                try:
-                    # Convertimos a minúsculas y eliminamos espacios al inicio/final
-                    df_limpio[columna] = df_limpio[columna].str.lower().str.strip()
-                    estadisticas.registrar_cambio(f"Normalización de categorías en columna '{columna}'")
-                except Exception as e:
-                    logger.error(f"Error al normalizar categorías en columna '{columna}': {e}")
-        
         # 6. Detectar filas con errores graves (pero no las eliminamos)
-        for idx, fila in df_limpio.iterrows():
-            try:
-                # Verificamos si hay errores en la fila (por ejemplo, tipos de datos inconsistentes)
-                for columna in df_limpio.columns:
-                    # Este es un placeholder para tu lógica específica de detección de errores
-                    # por ejemplo, verificar que un valor numérico sea realmente numérico
-                    pass
-            except Exception as e:
-                estadisticas.registrar_error(idx, f"Error al procesar la fila: {e}")
+        try:
+            validar_lote(df_limpio, reglas_compiladas or compilar_reglas(), estadisticas)
+        except Exception as e:
+            logger.error(f"Error al validar filas del lote: {e}")
         
-        # 7. Calcular estadísticas para cada columna
-        if estadisticas.filas_procesadas == 0:  # Solo para el primer lote
-            for columna in df_limpio.columns:
-                estadisticas.calcular_estadisticas_columna(df_limpio, columna)
+        # 7. Acumular estadísticas de cada columna (todos los lotes, memoria acotada)
+        for columna in df_limpio.columns:
+            estadisticas.calcular_estadisticas_columna(df_limpio, columna)
+        estadisticas.seguimiento_columnas.actualizar(df_limpio)
         
         # Actualizamos estadísticas
         estadisticas.filas_procesadas += filas_iniciales
@@ -357,117 +957,177 @@ def limpiar_lote(df, estadisticas):
         
     except Exception as e:
         logger.error(f"Error al procesar lote: {e}")
+        if en_sitio:
+            # Las columnas ya sustituidas no se pueden recuperar: df no es el lote original
+            logger.error("El lote limpiado en sitio quedó parcialmente modificado; hay que releerlo")
+            raise
         # Devolvemos el DataFrame original sin cambios
         return df
 
-def _procesar_batch_lineas(lineas, archivo_salida, estadisticas, columnas_originales, num_batch):
-    """Procesa un lote de líneas y las escribe en el archivo de salida"""
-    logger.info(f"Procesando lote de líneas #{num_batch} ({len(lineas)} líneas)")
+def etiquetar_outliers_en_archivo(archivo_salida, limites_outliers, tamano_lote=100000,
+                                  columna_etiqueta="columnas_outlier", dtype=None):
+    """
+    Segunda pasada opcional: una vez conocidos los límites globales de outliers,
+    relee el archivo limpio por lotes y añade una columna con los nombres de las
+    columnas en las que cada fila es outlier (vacía si no lo es en ninguna).
+
+    Args:
+        archivo_salida: archivo CSV limpio a etiquetar (se reemplaza al terminar)
+        limites_outliers: límites por columna (ver EstadisticasLimpieza.calcular_limites_outliers)
+        tamano_lote: número de filas a procesar por lote
+        columna_etiqueta: nombre de la columna que se añade
+        dtype: tipos de columnas del esquema (ver obtener_esquema)
+
+    Returns:
+        Diccionario {columna: cantidad exacta de outliers}
+    """
+    logger.info(f"Etiquetando outliers en {archivo_salida} con límites globales...")
+    archivo_temporal = archivo_salida + ".outliers.tmp"
+    conteos = {columna: 0 for columna in limites_outliers}
+    primer_lote = True
+
+    for lote in pd.read_csv(archivo_salida, chunksize=tamano_lote, dtype=dtype, low_memory=False):
+        marcas = {}
+        for columna, limites in limites_outliers.items():
+            if columna not in lote.columns:
+                continue
+            valores = pd.to_numeric(lote[columna], errors='coerce')
+            mascara = (valores < limites["limite_inferior"]) | (valores > limites["limite_superior"])
+            num_outliers = int(mascara.sum())
+            if num_outliers > 0:
+                marcas[columna] = mascara
+                conteos[columna] += num_outliers
+
+        if marcas:
+            marcas = pd.DataFrame(marcas)
+            etiqueta = marcas.dot(pd.Index(marcas.columns) + '|').str.rstrip('|')
+        else:
+            etiqueta = pd.Series("", index=lote.index)
+        # pd.concat evita insertar una columna en un DataFrame ancho y fragmentado
+        lote = pd.concat([lote, etiqueta.rename(columna_etiqueta)], axis=1)
+
+        lote.to_csv(
+            archivo_temporal,
+            mode='w' if primer_lote else 'a',
+            header=primer_lote,
+            index=False,
+            encoding='utf-8'
+        )
+        primer_lote = False
+
+    os.replace(archivo_temporal, archivo_salida)
+    logger.info(f"Outliers etiquetados en la columna '{columna_etiqueta}'")
+    return conteos
+
+def _procesar_batch_lineas(registros, f_salida, estadisticas, columnas_originales, num_batch,
+                           reglas_compiladas=None, esquema=None, en_sitio=False):
+    """
+    Procesa un lote de registros CSV completos en memoria y escribe el resultado
+    en el archivo de salida ya abierto
+
+    Args:
+        registros: lista de registros (un registro puede ocupar varias líneas físicas)
+        f_salida: archivo de salida abierto en modo texto
+        estadisticas: instancia de EstadisticasLimpieza
+        columnas_originales: columnas de la cabecera del archivo de entrada
+        num_batch: número de lote (para los mensajes)
+        reglas_compiladas: reglas de validación ya compiladas
+        esquema: tipos de columnas (ver obtener_esquema); sin esquema todo se lee como texto
+        en_sitio: limpiar el lote leído columna a columna sin copiarlo (ver limpiar_lote)
+    """
+    logger.info(f"Procesando lote de registros #{num_batch} ({len(registros)} registros)")
+    excluidas = set(esquema["excluidas"]) if esquema else set()
     
-    # Crear un archivo temporal para este batch
-    temp_entrada = f"temp_batch_{num_batch}.csv"
-    temp_salida = f"temp_batch_{num_batch}_proc.csv"
+    def leer_lote():
+        # Cabecera + registros en un buffer en memoria (sin archivos temporales)
+        contenido = formatear_cabecera(columnas_originales) + ''.join(registros)
+        try:
+            if esquema is None:
+                raise ValueError("sin esquema")
+            return pd.read_csv(io.StringIO(contenido),
+                               dtype=esquema["dtype"],
+                               usecols=lambda col: col not in excluidas,
+                               low_memory=False,
+                               on_bad_lines='skip')
+        except ValueError:
+            # Sin esquema, o el lote no encaja en los tipos inferidos: todo como string
+            return pd.read_csv(io.StringIO(contenido), 
+                               dtype=str,  # Todo como string para evitar errores
+                               usecols=lambda col: col not in excluidas,
+                               on_bad_lines='skip')
     
+    # Intentar procesar el lote como CSV normal
     try:
-        # Escribir cabecera y líneas en archivo temporal
-        with open(temp_entrada, 'w', encoding='utf-8', newline='') as f_temp:
-            # Escribir cabecera
-            f_temp.write(','.join(columnas_originales) + '\n')
-            # Escribir líneas
-            for linea in lineas:
-                f_temp.write(linea)
-        
-        # Intentar procesar el archivo temporal como CSV normal
-        try:
-            df = pd.read_csv(temp_entrada, 
-                           dtype=str,  # Todo como string para evitar errores
-                           on_bad_lines='skip',
-                           encoding='utf-8')
+        df = leer_lote()
+        # Si tiene más columnas de las esperadas, tomamos solo las originales
+        if len(df.columns) > len(columnas_originales):
+            logger.warning(f"Número de columnas inconsistente en lote {num_batch}: "
+                          f"esperadas {len(columnas_originales)}, encontradas {len(df.columns)}")
+            estadisticas.registrar_cambio(f"Inconsistencia de columnas en lote {num_batch}")
             
-            # Si tiene más columnas de las esperadas, tomamos solo las originales
-            if len(df.columns) > len(columnas_originales):
-                logger.warning(f"Número de columnas inconsistente en lote {num_batch}: "
-                              f"esperadas {len(columnas_originales)}, encontradas {len(df.columns)}")
-                estadisticas.registrar_cambio(f"Inconsistencia de columnas en lote {num_batch}")
-                
-                # Intentar quedarnos solo con las columnas originales
-                try:
-                    df = df[columnas_originales]
-                except Exception as e:
-                    logger.error(f"No se pudieron filtrar columnas en lote {num_batch}: {e}")
-            
-            # Intentar limpiar datos (si es posible)
+            # Intentar quedarnos solo con las columnas originales
             try:
-                df_limpio = limpiar_lote(df, estadisticas)
+                df = df[[col for col in columnas_originales if col in df.columns]]
             except Exception as e:
-                logger.error(f"Error al limpiar lote {num_batch}: {e}")
-                df_limpio = df  # Usar DataFrame original si hay error
-            
-            # Guardar en archivo temporal procesado
-            df_limpio.to_csv(temp_salida, index=False)
-            
-            # Anexar al archivo final
-            with open(temp_salida, 'r', encoding='utf-8') as f_in, \
-                 open(archivo_salida, 'a', encoding='utf-8') as f_out:
-                next(f_in)  # Saltar cabecera
-                for linea in f_in:
-                    f_out.write(linea)
-                    
-            # Actualizar estadísticas
-            estadisticas.filas_procesadas += len(df)
-            
-        except Exception as e:
-            logger.error(f"Error al procesar lote de líneas #{num_batch} como DataFrame: {e}")
-            logger.error(traceback.format_exc())
-            
-            # Plan B: Procesar línea por línea manualmente
-            logger.info(f"Intentando procesar lote #{num_batch} línea por línea...")
-            
-            filas_escritas = 0
-            with open(archivo_salida, 'a', encoding='utf-8') as f_out:
-                for i, linea in enumerate(lineas):
-                    try:
-                        # Aquí podríamos añadir alguna limpieza simple a nivel de texto
-                        linea_limpia = linea.strip()
-                        f_out.write(linea_limpia + '\n')
-                        filas_escritas += 1
-                    except Exception as e2:
-                        logger.error(f"Error procesando línea {i} en lote #{num_batch}: {e2}")
-                        estadisticas.registrar_error(i, str(e2))
-                        # Escribir línea original como fallback
-                        try:
-                            f_out.write(linea)
-                            filas_escritas += 1
-                        except:
-                            pass
-            
-            logger.info(f"Procesamiento manual completado para lote #{num_batch}. Escritas {filas_escritas} líneas.")
-            estadisticas.filas_procesadas += filas_escritas
-            estadisticas.registrar_cambio(f"Procesamiento manual en lote {num_batch}")
-    
-    finally:
-        # Limpieza de archivos temporales
+                logger.error(f"No se pudieron filtrar columnas en lote {num_batch}: {e}")
+        
+        # Intentar limpiar datos (si es posible); limpiar_lote ya actualiza filas_procesadas
         try:
-            if os.path.exists(temp_entrada):
-                os.remove(temp_entrada)
-            if os.path.exists(temp_salida):
-                os.remove(temp_salida)
+            df_limpio = limpiar_lote(df, estadisticas, reglas_compiladas, en_sitio=en_sitio)
         except Exception as e:
-            logger.warning(f"No se pudieron eliminar archivos temporales: {e}")
+            logger.error(f"Error al limpiar lote {num_batch}: {e}")
+            if en_sitio:
+                # df quedó a medio limpiar: se relee el lote original de los registros
+                df = leer_lote()[list(df.columns)]
+            df_limpio = df  # Usar DataFrame original si hay error
+            estadisticas.filas_procesadas += len(df)
+        
+        # Escribir directamente en el archivo final
+        df_limpio.to_csv(f_salida, header=False, index=False)
+        
+    except Exception as e:
+        logger.error(f"Error al procesar lote de registros #{num_batch} como DataFrame: {e}")
+        logger.error(traceback.format_exc())
+        
+        # Plan B: Procesar registro por registro con el módulo csv
+        logger.info(f"Intentando procesar lote #{num_batch} registro por registro...")
+        
+        indices_salida = [i for i, col in enumerate(columnas_originales) if col not in excluidas]
+        writer = csv.writer(f_salida)
+        filas_escritas = 0
+        for i, registro in enumerate(registros):
+            try:
+                campos = next(csv.reader(io.StringIO(registro)))
+                writer.writerow([limpiar_texto(campos[j]) if j < len(campos) else '' for j in indices_salida])
+                filas_escritas += 1
+            except Exception as e2:
+                logger.error(f"Error procesando registro {i} en lote #{num_batch}: {e2}")
+                estadisticas.registrar_error(i, str(e2))
+        
+        logger.info(f"Procesamiento manual completado para lote #{num_batch}. Escritos {filas_escritas} registros.")
+        estadisticas.filas_procesadas += filas_escritas
+        estadisticas.registrar_cambio(f"Procesamiento manual en lote {num_batch}")
 
-def procesar_csv_manual(archivo_entrada, archivo_salida, tamano_lote=100000):
+def procesar_csv_manual(archivo_entrada, archivo_salida, tamano_lote=100000, archivo_esquema=None,
+                        columnas_excluidas=None, telemetria=None, limpieza_en_sitio=False):
     """
     Procesa un archivo CSV grande con formato inconsistente usando lectura línea por línea
     
     Args:
         archivo_entrada: ruta al archivo CSV de entrada
         archivo_salida: ruta donde guardar el archivo CSV procesado
-        tamano_lote: número aproximado de líneas a procesar por lote
+        tamano_lote: número de registros a procesar por lote
+        archivo_esquema: archivo JSON con los tipos de columnas (se infiere si no existe)
+        columnas_excluidas: columnas que no se leen ni se escriben
+        telemetria: MuestreadorRecursos en marcha cuyo resumen se añade al reporte
+        limpieza_en_sitio: limpiar cada lote sin copiarlo (ver limpiar_lote)
     """
     logger.info(f"Iniciando procesamiento manual del archivo: {archivo_entrada}")
     
     estadisticas = EstadisticasLimpieza()
     estadisticas.cambios_realizados = {}  # Inicializar explícitamente
+    estadisticas.telemetria = telemetria
+    reglas_compiladas = compilar_reglas()
     
     try:
         # Verificar que el archivo existe
@@ -491,35 +1151,46 @@ def procesar_csv_manual(archivo_entrada, archivo_salida, tamano_lote=100000):
         columnas_originales = next(reader)
         logger.info(f"Columnas detectadas: {len(columnas_originales)}")
         
-        # Escribir cabecera en el archivo de salida
-        with open(archivo_salida, 'w', encoding='utf-8', newline='') as f_out:
-            writer = csv.writer(f_out)
-            writer.writerow(columnas_originales)
+        try:
+            esquema = obtener_esquema(archivo_entrada, archivo_esquema, columnas_excluidas)
+        except Exception as e:
+            logger.warning(f"No se pudo obtener el esquema de tipos, se leerá todo como texto: {e}")
+            esquema = None
+        columnas_salida = esquema["usecols"] if esquema else columnas_originales
         
-        # Procesar archivo por lotes (líneas)
-        with open(archivo_entrada, 'r', encoding='utf-8', errors='replace') as f_in:
+        # Un único escritor con buffer grande para todo el archivo de salida
+        with open(archivo_entrada, 'r', encoding='utf-8', errors='replace') as f_in, \
+             open(archivo_salida, 'w', encoding='utf-8', newline='', buffering=TAMANO_BUFFER_ESCRITURA) as f_out:
+            # Escribir cabecera en el archivo de salida
+            writer = csv.writer(f_out)
+            writer.writerow(columnas_salida)
+            
             # Saltar cabecera
             next(f_in)
             
-            lineas_batch = []
+            registros_batch = []
+            lineas_procesadas = 0
             total_procesadas = 0
             num_batch = 0
             
-            logger.info("Comenzando procesamiento línea por línea...")
-            for i, linea in enumerate(f_in):
+            logger.info("Comenzando procesamiento por registros...")
+            # Los registros respetan campos entre comillas con saltos de línea (JSON multilínea)
+            for i, registro in enumerate(iterar_registros(f_in)):
                 try:
-                    lineas_batch.append(linea)
+                    registros_batch.append(registro)
                     
                     # Cuando llegamos al tamaño de lote, procesamos
-                    if len(lineas_batch) >= tamano_lote:
+                    if len(registros_batch) >= tamano_lote:
                         num_batch += 1
-                        _procesar_batch_lineas(lineas_batch, archivo_salida, estadisticas, columnas_originales, num_batch)
-                        total_procesadas += len(lineas_batch)
-                        lineas_batch = []  # Reiniciar lote
+                        _procesar_batch_lineas(registros_batch, f_out, estadisticas, columnas_originales, num_batch,
+                                               reglas_compiladas, esquema, limpieza_en_sitio)
+                        total_procesadas += len(registros_batch)
+                        lineas_procesadas += sum(r.count('\n') for r in registros_batch)
+                        registros_batch = []  # Reiniciar lote
                         
                         # Mostrar progreso
-                        porcentaje = (total_procesadas / num_lineas) * 100 if num_lineas > 0 else 0
-                        logger.info(f"Progreso: {total_procesadas}/{num_lineas} líneas ({porcentaje:.2f}%)")
+                        porcentaje = (lineas_procesadas / num_lineas) * 100 if num_lineas > 0 else 0
+                        logger.info(f"Progreso: {lineas_procesadas}/{num_lineas} líneas ({porcentaje:.2f}%)")
                         
                         # Liberar memoria
                         gc.collect()
@@ -529,19 +1200,20 @@ def procesar_csv_manual(archivo_entrada, archivo_salida, tamano_lote=100000):
                         logger.info(f"Memoria después del lote {num_batch}: {memoria_actual:.2f} GB")
                 
                 except Exception as e:
-                    logger.error(f"Error procesando línea {i+2}: {e}")  # +2 porque ya saltamos la cabecera
-                    estadisticas.registrar_error(i+2, str(e))
+                    logger.error(f"Error procesando registro {i+1}: {e}")
+                    estadisticas.registrar_error(i+1, str(e))
             
-            # Procesar último lote si quedaron líneas
-            if lineas_batch:
+            # Procesar último lote si quedaron registros
+            if registros_batch:
                 num_batch += 1
-                _procesar_batch_lineas(lineas_batch, archivo_salida, estadisticas, columnas_originales, num_batch)
-                total_procesadas += len(lineas_batch)
+                _procesar_batch_lineas(registros_batch, f_out, estadisticas, columnas_originales, num_batch,
+                                       reglas_compiladas, esquema, limpieza_en_sitio)
+                total_procesadas += len(registros_batch)
         
-        logger.info(f"Total de líneas procesadas: {total_procesadas}")
+        logger.info(f"Total de registros procesados: {total_procesadas}")
         
-        # Generar reporte con columnas finales = columnas originales (ya que estamos preservando la estructura)
-        reporte = estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_originales)
+        # Generar reporte con las columnas leídas (se preserva la estructura salvo las excluidas)
+        reporte = estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_salida)
         return reporte
         
     except Exception as e:
@@ -552,173 +1224,777 @@ def procesar_csv_manual(archivo_entrada, archivo_salida, tamano_lote=100000):
         if 'columnas_originales' not in locals():
             columnas_originales = []
         
-        if hasattr(estadisticas, 'generar_reporte'):
-            reporte = estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_originales)
-            return reporte
+        # Reporte parcial para el diagnóstico; el error se propaga porque la salida está incompleta
+        estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_originales)
+        raise
+
+class CuarentenaRegistros:
+    """
+    Archivo CSV con los registros rechazados durante la lectura: rango de bytes en
+    el archivo de origen, lote, motivo y el registro original. El archivo solo se
+    crea si hay algún registro que rechazar. Sin ruta, los registros se acumulan en
+    memoria (procesos trabajadores) para volcarlos después en el archivo.
+    """
+    COLUMNAS = ["inicio_byte", "fin_byte", "lote", "motivo", "registro"]
+
+    def __init__(self, ruta=None):
+        self.ruta = ruta
+        self.total = 0
+        self.registros = []
+        self._archivo = None
+        self._writer = None
+        # No dejar la cuarentena de una ejecución anterior
+        if ruta and os.path.exists(ruta):
+            os.remove(ruta)
+
+    def registrar(self, inicio, fin, num_lote, motivo, registro):
+        """Añade un registro rechazado (str o bytes) a la cuarentena"""
+        if isinstance(registro, bytes):
+            registro = registro.decode('utf-8', errors='replace')
+        fila = [inicio, fin, num_lote, motivo, registro.rstrip('\r\n')]
+        self.total += 1
+        if self.ruta is None:
+            self.registros.append(fila)
+            return
+        if self._archivo is None:
+            self._archivo = open(self.ruta, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._archivo)
+            self._writer.writerow(self.COLUMNAS)
+        self._writer.writerow(fila)
+
+    def volcar(self, registros):
+        """Añade los registros acumulados por otra cuarentena en memoria"""
+        for fila in registros:
+            self.registrar(*fila)
+
+    def cerrar(self):
+        if self._archivo is not None:
+            self._archivo.close()
+            self._archivo = None
+
+# Tipo al que se ensancha una columna cuando algún valor no encaja en el del esquema
+_TIPO_MAS_ANCHO = {"Int16": "Int64", "Int32": "Int64", "Int64": "float64", "float64": "str",
+                   "boolean": "str", "category": "str"}
+
+def _convertir_a_tipo(serie, tipo):
+    """
+    Convierte una columna leída como texto al tipo del esquema. Si algún valor no
+    encaja, el tipo se ensancha (Int16 → Int64 → float64 → str) en lugar de perder
+    filas. Devuelve (serie_convertida, tipo_usado).
+    """
+    presentes = serie.notna()
+    while tipo in _TIPO_MAS_ANCHO:
+        if tipo == "boolean":
+            convertida = serie.map(_VALORES_BOOLEANOS)
+            if not (presentes & convertida.isna()).any():
+                return convertida.astype("boolean"), tipo
+        elif tipo.startswith("Int") or tipo == "float64":
+            numerica = pd.to_numeric(serie, errors='coerce')
+            if not (presentes & numerica.isna()).any():
+                try:
+                    return (numerica if tipo == "float64" else serie).astype(tipo), tipo
+                except (TypeError, ValueError, OverflowError):
+                    pass  # Decimales en una columna entera o fuera de rango
         else:
-            logger.critical("No se pudo generar el reporte final")
-            return {"error": str(e)}
+            try:
+                return serie.astype(tipo), tipo
+            except (TypeError, ValueError):
+                pass
+        tipo = _TIPO_MAS_ANCHO[tipo]
+    return serie.astype(tipo), tipo
 
-def procesar_csv_grande(archivo_entrada, archivo_salida, tamano_lote=100000):
+def _aplicar_tipos(df, esquema, num_lote):
+    """
+    Aplica los tipos del esquema a un bloque leído como texto. Las columnas con
+    valores que no encajan se ensanchan y el tipo ensanchado queda en el esquema
+    para los bloques siguientes.
+    """
+    for columna, tipo in list(esquema["dtype"].items()):
+        if columna not in df.columns:
+            continue
+        df[columna], tipo_usado = _convertir_a_tipo(df[columna], tipo)
+        if tipo_usado != tipo:
+            logger.warning(f"Lote {num_lote}: la columna '{columna}' no encaja en {tipo}; se lee como {tipo_usado}")
+            esquema["dtype"][columna] = tipo_usado
+    return df
+
+def _leer_csv_bloque(cabecera, datos, esquema, dtype):
+    """Lee un bloque de registros con pandas, sin tolerar registros defectuosos"""
+    # Con usecols pandas recorta en silencio los registros con campos de más, así
+    # que solo se pasa cuando hay columnas excluidas
+    return pd.read_csv(io.BytesIO(cabecera + datos),
+                       dtype=dtype,
+                       usecols=esquema["usecols"] if esquema["excluidas"] else None,
+                       low_memory=False,  # Un solo bloque interno por lote: las categorías no se unen entre bloques
+                       encoding='utf-8',
+                       on_bad_lines='error',  # Los registros defectuosos no se descartan en silencio
+                       **OPCIONES_LECTURA_CSV)
+
+def _leer_bloque_tolerante(cabecera, datos, inicio, num_lote, esquema, cuarentena):
+    """
+    Relee un bloque que pandas no pudo interpretar, registro a registro. Solo los
+    registros mal formados (comillas rotas o más campos que la cabecera) van a la
+    cuarentena; los valores que no encajan en el esquema ensanchan su columna.
+    """
+    columnas_originales = next(csv.reader(io.StringIO(cabecera.decode('utf-8', errors='replace'))))
+    opciones_csv = {k: v for k, v in OPCIONES_LECTURA_CSV.items() if k != "encoding"}
+    aceptados = []  # (inicio, fin, registro)
+    for posicion, registro in separar_registros(datos, inicio):
+        fin = posicion + len(registro)
+        texto = registro.decode('utf-8', errors='replace')
+        try:
+            filas = list(csv.reader(io.StringIO(texto), **opciones_csv))
+        except csv.Error as e:
+            cuarentena.registrar(posicion, fin, num_lote, f"Registro mal formado: {e}", registro)
+            continue
+        if not filas or filas == [[]]:
+            continue  # Línea vacía: pandas también la ignora
+        if len(filas) > 1:
+            cuarentena.registrar(posicion, fin, num_lote, "Registro mal formado: varias filas", registro)
+        elif len(filas[0]) > len(columnas_originales):
+            cuarentena.registrar(posicion, fin, num_lote,
+                                 f"Se esperaban {len(columnas_originales)} campos, hay {len(filas[0])}", registro)
+        else:
+            aceptados.append((posicion, fin, texto))
+
+    contenido = cabecera.decode('utf-8', errors='replace') + ''.join(t for _, _, t in aceptados)
+    try:
+        df = pd.read_csv(io.StringIO(contenido), dtype=str, usecols=esquema["usecols"],
+                         on_bad_lines='error', **opciones_csv)
+    except ValueError as e:
+        # Último recurso: el bloque entero a cuarentena, el resto del archivo sigue
+        for posicion, fin, texto in aceptados:
+            cuarentena.registrar(posicion, fin, num_lote, f"Bloque ilegible: {e}", texto)
+        return pd.DataFrame(columns=esquema["usecols"])
+    df.index = range(len(df))
+    return _aplicar_tipos(df, esquema, num_lote)
+
+def _leer_bloque(cabecera, datos, inicio, fin, num_lote, esquema, cuarentena, fila_inicial=0):
+    """
+    Interpreta un bloque de registros con pandas. Si algún valor no encaja en los
+    tipos del esquema, el bloque se relee como texto y esas columnas se ensanchan;
+    si el bloque está mal formado, solo ese rango de bytes se relee con la ruta
+    tolerante y los registros defectuosos van a la cuarentena. Los índices de fila
+    continúan desde fila_inicial (registros de los bloques previos).
+    """
+    try:
+        df = _leer_csv_bloque(cabecera, datos, esquema, esquema["dtype"])  # Mismos tipos en todos los lotes
+    except (ValueError, OverflowError, TypeError) as e:  # ParserError y UnicodeDecodeError heredan de ValueError
+        try:
+            df = _leer_csv_bloque(cabecera, datos, esquema, str)
+        except ValueError:
+            logger.warning(f"Lote {num_lote} (bytes {inicio}-{fin}) no se pudo leer directamente: {e}. "
+                           "Releyendo el bloque registro a registro...")
+            rechazados_previos = cuarentena.total
+            df = _leer_bloque_tolerante(cabecera, datos, inicio, num_lote, esquema, cuarentena)
+            logger.warning(f"Lote {num_lote}: {cuarentena.total - rechazados_previos} registros enviados a cuarentena")
+        else:
+            # El bloque está bien formado: son los tipos del esquema los que no encajan
+            df = _aplicar_tipos(df, esquema, num_lote)
+    df.index += fila_inicial
+    return df
+
+# Reglas compiladas de cada proceso trabajador (las funciones compiladas no se pueden enviar entre procesos)
+_REGLAS_TRABAJADOR = None
+
+def _inicializar_trabajador():
+    global _REGLAS_TRABAJADOR
+    _REGLAS_TRABAJADOR = compilar_reglas()
+
+def _limpiar_bloque_trabajador(cabecera, datos, inicio, fin, num_lote, esquema, fila_inicial,
+                               columna_particion=None, devolver_lote=False, columna_indice=None, cache=None,
+                               en_sitio=False):
+    """
+    Tarea de un proceso trabajador: lee y limpia un bloque y devuelve las columnas,
+    el CSV resultante (sin cabecera; {partición: (csv, filas)} si se indica
+    columna_particion), sus estadísticas parciales, los registros en cuarentena,
+    el DataFrame limpio si devolver_lote es True (para la salida SQLite) y las
+    claves de columna_indice, si se indica (para el índice de visitantes). Con cache
+    (CacheColumnas) se reutilizan las columnas limpias de ejecuciones anteriores; con
+    en_sitio el bloque leído se limpia sin copiarlo (ver limpiar_lote).
+    """
+    estadisticas = EstadisticasLimpieza()
+    cuarentena = CuarentenaRegistros()
+    huella = calcular_huella_bloque(cabecera, datos, esquema) if cache is not None else None
+    lote = _leer_bloque(cabecera, datos, inicio, fin, num_lote, esquema, cuarentena, fila_inicial)
+    if not en_sitio:
+        del datos  # En sitio se conserva para releer el lote original si la limpieza falla
+    try:
+        lote_limpio = limpiar_lote(lote, estadisticas, _REGLAS_TRABAJADOR, cache, huella, en_sitio)
+    except Exception as e:
+        logger.error(f"Error procesando lote {num_lote}: {e}")
+        logger.error(traceback.format_exc())
+        # En caso de error, se escribe el lote original sin procesar (releído si se limpiaba en sitio;
+        # la cuarentena del bloque ya se contó en la primera lectura)
+        if en_sitio:
+            lote = _leer_bloque(cabecera, datos, inicio, fin, num_lote, esquema, CuarentenaRegistros(),
+                                fila_inicial)
+        lote_limpio = lote
+    estadisticas.registros_cuarentena = cuarentena.total
+    if columna_particion is not None:
+        csv_lote = particionar_csv_en_texto(lote_limpio, columna_particion)
+    else:
+        csv_lote = lote_limpio.to_csv(header=False, index=False)
+    claves = None
+    if columna_indice is not None and columna_indice in lote_limpio.columns:
+        claves = lote_limpio[columna_indice].astype(str).tolist()
+    return (list(lote_limpio.columns), csv_lote, estadisticas, cuarentena.registros,
+            lote_limpio if devolver_lote else None, claves)
+
+def _procesar_bloques_en_paralelo(bloques, cabecera, esquema, archivo_salida, estadisticas, cuarentena,
+                                  num_procesos, limite_memoria_gb=None, escritor_particionado=None,
+                                  escritor_sqlite=None, indice_visitantes=None, cache=None, en_sitio=False):
+    """
+    Limpia los bloques en un pool de procesos y escribe los resultados en el orden
+    original (en el archivo o flujo de salida o, si se indica, en la salida
+    particionada) y, opcionalmente, también en SQLite y en el índice de visitantes.
+    Los bloques en vuelo se limitan a 2 por proceso y, si hay límite de memoria, a
+    lo que quepa en él (proceso principal + trabajadores + resultados pendientes
+    de escribir). Si un trabajador falla o el pool se rompe, el bloque se limpia en
+    el proceso principal; si tampoco allí se puede, el error se propaga.
+
+    Returns:
+        Lista de columnas finales (vacía si no se escribió ningún lote)
+    """
+    # fork evita reimportar el módulo (y abrir otro log) en cada trabajador
+    contexto = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    max_en_vuelo = 2 * num_procesos
+    pendientes = deque()  # (num_lote, futuro, memoria_estimada_gb, argumentos), en orden de lectura
+    columnas_finales = []
+    memoria_en_vuelo = 0.0
+    fila_inicial = 0
+
+    columna_particion = None
+    if escritor_particionado is not None:
+        columna_particion = escritor_particionado.columna_particion
+        salida = nullcontext()  # Cada partición tiene sus propios archivos
+    elif hasattr(archivo_salida, 'write'):
+        salida = nullcontext(archivo_salida)  # Flujo ya abierto (stdout): no se cierra aquí
+    else:
+        salida = open(archivo_salida, 'w', encoding='utf-8', newline='', buffering=TAMANO_BUFFER_ESCRITURA)
+
+    with salida as f_salida, \
+            ProcessPoolExecutor(max_workers=num_procesos, mp_context=contexto,
+                                initializer=_inicializar_trabajador) as pool:
+
+        def enviar(argumentos):
+            """Envía un bloque al pool; con el pool roto devuelve None (se limpiará aquí)"""
+            try:
+                return pool.submit(_limpiar_bloque_trabajador, *argumentos)
+            except BrokenProcessPool as e:
+                logger.error(f"El pool de procesos no acepta más lotes: {e}")
+                return None
+
+        def escribir_siguiente():
+            """Espera al lote más antiguo, lo escribe y fusiona sus estadísticas"""
+            num_lote, futuro, memoria_estimada, argumentos = pendientes.popleft()
+            try:
+                if futuro is None:
+                    raise BrokenProcessPool("pool de procesos roto")
+                resultado = futuro.result()
+            except Exception as e:
+                # Ningún bloque se pierde: se limpia en el proceso principal
+                logger.error(f"Error procesando lote {num_lote} en paralelo: {e}. "
+                             "Se limpia en el proceso principal...")
+                if futuro is not None:
+                    logger.error(traceback.format_exc())
+                resultado = _limpiar_bloque_trabajador(*argumentos)
+                estadisticas.registrar_cambio("Lotes limpiados en el proceso principal")
+            del argumentos
+            columnas, csv_lote, parciales, rechazados, lote_limpio, claves = resultado
+            if escritor_sqlite is not None:
+                escritor_sqlite.escribir(lote_limpio)
+            if escritor_particionado is not None:
+                for valor, (texto_csv, num_filas) in csv_lote.items():
+                    escritor_particionado.escribir_csv(valor, columnas, texto_csv, num_filas)
+                if not columnas_finales:
+                    columnas_finales.extend(columnas)
+            else:
+                if not columnas_finales:
+                    columnas_finales.extend(columnas)
+                    texto_cabecera = formatear_cabecera(columnas)
+                    f_salida.write(texto_cabecera)
+                    if indice_visitantes is not None:
+                        indice_visitantes.omitir_bytes(len(texto_cabecera.encode('utf-8')))
+                f_salida.write(csv_lote)
+                if indice_visitantes is not None:
+                    if claves is None:
+                        indice_visitantes.valido = False
+                    else:
+                        indice_visitantes.registrar_lote(claves, csv_lote.encode('utf-8'))
+            estadisticas.fusionar(parciales)
+            cuarentena.volcar(rechazados)
+            logger.info(f"Lote {num_lote} escrito ({parciales.filas_procesadas} filas)")
+            memoria_actual = estadisticas.actualizar_memoria(incluir_hijos=True)
+            logger.info(f"Memoria total después del lote {num_lote}: {memoria_actual:.2f} GB")
+            return memoria_estimada
+
+        for i, (inicio, fin, datos, num_registros) in enumerate(bloques):
+            memoria_lote = len(datos) * FACTOR_MEMORIA_LOTE / (1024 ** 3)
+            while pendientes and (
+                len(pendientes) >= max_en_vuelo
+                or (limite_memoria_gb is not None and (
+                    memoria_en_vuelo + memoria_lote > limite_memoria_gb
+                    or estadisticas.obtener_uso_memoria_gb(incluir_hijos=True) > limite_memoria_gb))
+            ):
+                memoria_en_vuelo -= escribir_siguiente()
+            logger.info(f"Enviando lote {i+1} ({num_registros} registros, bytes {inicio}-{fin})")
+            # Los argumentos se guardan hasta escribir el lote por si hay que limpiarlo aquí
+            argumentos = (cabecera, datos, inicio, fin, i + 1, esquema, fila_inicial, columna_particion,
+                          escritor_sqlite is not None,
+                          indice_visitantes.columna if indice_visitantes is not None else None, cache, en_sitio)
+            pendientes.append((i + 1, enviar(argumentos), memoria_lote, argumentos))
+            memoria_en_vuelo += memoria_lote
+            fila_inicial += num_registros
+            del datos, argumentos
+        while pendientes:
+            escribir_siguiente()
+    return columnas_finales
+
+def procesar_csv_grande(archivo_entrada, archivo_salida, tamano_lote=100000, etiquetar_outliers=False,
+                        archivo_esquema=None, columnas_excluidas=None,
+                        archivo_cuarentena="registros_cuarentena.csv", num_procesos=1,
+                        limite_memoria_gb=None, telemetria=None, directorio_particionado=None,
+                        columna_particion="date", archivo_sqlite=None, prefijos_excluidos_sqlite=(),
+                        indexar_visitantes=False, columna_indice="fullVisitorId", directorio_cache_columnas=None,
+                        podar_columnas=False, proporcion_minima_valores=0.0, archivo_estadisticas=None,
+                        limpieza_en_sitio=False):
     """
     Procesa un archivo CSV grande por lotes para manejar eficientemente la memoria
     
     Args:
-        archivo_entrada: ruta al archivo CSV de entrada
-        archivo_salida: ruta donde guardar el archivo CSV procesado
+        archivo_entrada: ruta al archivo CSV de entrada ('-' para leer de stdin)
+        archivo_salida: ruta donde guardar el archivo CSV procesado ('-' o un flujo de
+                        texto abierto para escribir en stdout)
         tamano_lote: número de filas a procesar por lote
+        etiquetar_outliers: si es True, hace una segunda pasada sobre la salida para
+                            marcar las filas outlier con los límites globales
+        archivo_esquema: archivo JSON con los tipos de columnas (se infiere y se guarda si no existe)
+        columnas_excluidas: columnas que no se leen ni se escriben
+        archivo_cuarentena: CSV donde se guardan los registros rechazados con su
+                            rango de bytes en el origen y el motivo
+        num_procesos: con más de 1, los lotes se limpian en un pool de procesos
+        limite_memoria_gb: memoria total (todos los procesos) que el modo paralelo no debe superar
+        telemetria: MuestreadorRecursos en marcha cuyo resumen se añade al reporte
+        directorio_particionado: si se indica, la salida se reparte en
+                                 <directorio>/<columna_particion>=<valor>/part-N.csv con un
+                                 manifest.json, en lugar de escribirse en archivo_salida
+        columna_particion: columna que define las particiones
+        archivo_sqlite: si se indica, los lotes limpios también se cargan en la tabla
+                        `visitas` de esta base SQLite (índices creados al final)
+        prefijos_excluidos_sqlite: prefijos de columnas que no se cargan en SQLite
+        indexar_visitantes: si es True, se construye mientras se escribe un índice
+                            <archivo_salida>.indice de columna_indice -> posición en bytes
+                            (consultas con indice_visitantes.py)
+        columna_indice: columna clave del índice de visitantes
+        directorio_cache_columnas: si se indica, las columnas limpias de cada bloque se
+                                   guardan en esta caché y, en ejecuciones posteriores,
+                                   solo se recalculan las columnas cuyo bloque de origen o
+                                   cuyas reglas de limpieza cambiaron (ver cache_columnas.py)
+        podar_columnas: si es True, no se leen las columnas que la expansión marcó
+                        como vacías o constantes (<archivo_entrada>.columnas.json) y las
+                        que lo son tras la limpieza se quitan del archivo de salida
+        proporcion_minima_valores: las columnas con una proporción menor de valores no
+                                   nulos también se podan (0: solo vacías y constantes)
+        archivo_estadisticas: si se indica, las estadísticas acumuladas se guardan en
+                              este archivo para fusionarlas después con las de otros
+                              fragmentos del mismo dataset (ver fragmentos.py)
+        limpieza_en_sitio: limpiar cada lote columna a columna sobre el propio lote, sin
+                           construir otro DataFrame (pico de memoria cercano a 1x el lote)
     """
-    logger.info(f"Iniciando procesamiento del archivo: {archivo_entrada}")
+    # '-' (o un flujo ya abierto como salida) activa el modo tubería: una sola pasada
+    # hacia delante leyendo de stdin y/o escribiendo en stdout
+    es_flujo = archivo_entrada == FLUJO_ESTANDAR
+    if archivo_salida == FLUJO_ESTANDAR:
+        archivo_salida = sys.stdout
+    salida_es_flujo = hasattr(archivo_salida, 'write')
+    nombre_salida = "<stdout>" if salida_es_flujo else archivo_salida
+    
+    logger.info(f"Iniciando procesamiento del archivo: {'<stdin>' if es_flujo else archivo_entrada}")
     logger.info(f"Tamaño de lote configurado: {tamano_lote} filas")
     
     estadisticas = EstadisticasLimpieza()
     estadisticas.cambios_realizados = {}  # Inicializar explícitamente
+    estadisticas.telemetria = telemetria
+    reglas_compiladas = compilar_reglas()
+    cuarentena = CuarentenaRegistros(archivo_cuarentena)
     
     try:
-        # Intentamos leer las primeras filas para obtener columnas (más seguro)
-        try:
-            logger.info("Intentando determinar columnas con lectura inicial...")
-            df_muestra = pd.read_csv(
-                archivo_entrada, 
-                nrows=5,
-                on_bad_lines='skip'  # Ignorar líneas problemáticas
-            )
-            columnas_originales = list(df_muestra.columns)
-            logger.info(f"Columnas detectadas: {len(columnas_originales)}")
-        except Exception as e:
-            logger.warning(f"No se pudo determinar columnas automáticamente: {e}")
-            logger.info("Creando lista de columnas genérica basada en la primera línea...")
+        if es_flujo:
+            columnas_originales = []  # Se leen de la cabecera del flujo
+        else:
+            # Intentamos leer las primeras filas para obtener columnas (más seguro)
+            try:
+                logger.info("Intentando determinar columnas con lectura inicial...")
+                df_muestra = pd.read_csv(
+                    archivo_entrada, 
+                    nrows=5,
+                    on_bad_lines='skip'  # Ignorar líneas problemáticas
+                )
+                columnas_originales = list(df_muestra.columns)
+                logger.info(f"Columnas detectadas: {len(columnas_originales)}")
+            except Exception as e:
+                logger.warning(f"No se pudo determinar columnas automáticamente: {e}")
+                logger.info("Creando lista de columnas genérica basada en la primera línea...")
             
-            # Leer la primera línea manualmente para determinar columnas
-            with open(archivo_entrada, 'r', encoding='utf-8', errors='replace') as f:
-                primera_linea = f.readline().strip()
-                columnas_originales = primera_linea.split(',')
-                logger.info(f"Columnas detectadas manualmente: {len(columnas_originales)}")
-        
-        logger.info("Configurando lector CSV con manejo de errores...")
-        # Crear un iterator sobre el archivo CSV con manejo robusto de errores
-        df_iterator = pd.read_csv(
-            archivo_entrada, 
-            chunksize=tamano_lote,
-            low_memory=False,  # Evita warnings por tipos mixtos en columnas
-            encoding='utf-8',  # Ajustar según necesidades
-            on_bad_lines='skip',  # Saltar líneas problemáticas
-            escapechar='\\',  # Caracter de escape
-            quotechar='"',    # Caracter de comillas
-            doublequote=True, # Manejar dobles comillas
-            skipinitialspace=True,  # Saltar espacios iniciales
-        )
+                # Leer la primera línea manualmente para determinar columnas
+                with open(archivo_entrada, 'r', encoding='utf-8', errors='replace') as f:
+                    primera_linea = f.readline().strip()
+                    columnas_originales = primera_linea.split(',')
+                    logger.info(f"Columnas detectadas manualmente: {len(columnas_originales)}")
+        
+        logger.info("Configurando lector CSV por bloques de registros...")
+        # El archivo se recorre en bloques de registros completos con su rango de bytes:
+        # si pandas no puede leer un bloque, solo ese bloque se relee de forma tolerante
+        f_entrada = sys.stdin.buffer if es_flujo else open(archivo_entrada, 'rb')
+        cabecera = next(iterar_registros(f_entrada), b'')
+        bloques = iterar_bloques(f_entrada, tamano_lote, len(cabecera))
+        
+        # Tipos fijos para todos los lotes (inferidos o leídos del archivo de esquema)
+        if es_flujo:
+            # Entrada estándar: las columnas salen de la cabecera y, si hay que inferir el
+            # esquema, la muestra es el primer bloque (que luego se procesa como los demás)
+            columnas_originales = next(csv.reader([cabecera.decode('utf-8', errors='replace')]), [])
+            primer_bloque = next(bloques, None)
+            muestra = pd.DataFrame(columns=columnas_originales)
+            if primer_bloque is not None:
+                muestra = pd.read_csv(io.BytesIO(cabecera + primer_bloque[2]), dtype=str, on_bad_lines='skip')
+                bloques = itertools.chain([primer_bloque], bloques)
+            esquema = obtener_esquema(archivo_entrada, archivo_esquema, columnas_excluidas, columnas_originales,
+                                      muestra=muestra)
+            del muestra
+        else:
+            esquema = obtener_esquema(archivo_entrada, archivo_esquema, columnas_excluidas)
+        
+        # Columnas que la expansión ya sabe vacías o constantes: no se leen ni se escriben
+        if podar_columnas and not es_flujo:
+            podadas_expansion = {col: motivo for col, motivo in cargar_columnas_podadas(archivo_entrada).items()
+                                 if col in esquema["usecols"]}
+            if podadas_expansion:
+                esquema = esquema_sin_columnas(esquema, podadas_expansion)
+                estadisticas.columnas_podadas.update(podadas_expansion)
+                logger.info(f"Columnas podadas según la expansión: {len(podadas_expansion)} "
+                            f"(quedan {len(esquema['usecols'])})")
         
         # Procesar el primer lote y escribir con encabezados
         primer_lote = True
         columnas_finales = []
+        escritor_particionado = None
+        if directorio_particionado:
+            escritor_particionado = EscritorParticionado(directorio_particionado, columna_particion)
+            logger.info(f"Salida particionada por '{columna_particion}' en: {directorio_particionado}")
+        
+        escritor_sqlite = None
+        if archivo_sqlite:
+            escritor_sqlite = EscritorSQLite(archivo_sqlite, prefijos_excluidos=prefijos_excluidos_sqlite)
+            logger.info(f"Carga en SQLite activada: {archivo_sqlite}")
+        
+        indice = None
+        if indexar_visitantes and (escritor_particionado is not None or salida_es_flujo):
+            logger.warning("El índice de visitantes necesita un archivo de salida único; se omite")
+        elif indexar_visitantes:
+            indice = IndiceVisitantes(archivo_salida, columna_indice)
+            logger.info(f"Índice de visitantes por '{columna_indice}' en: {indice.ruta_indice}")
+        
+        cache = None
+        if directorio_cache_columnas:
+            cache = CacheColumnas(directorio_cache_columnas, huellas_reglas_columna())
+            logger.info(f"Caché de columnas limpias: {directorio_cache_columnas}")
+        
+        def escribir_lote(df):
+            """Escribe un lote en el archivo de salida o lo reparte entre las particiones"""
+            if escritor_sqlite is not None:
+                escritor_sqlite.escribir(df)
+            if escritor_particionado is not None:
+                escritor_particionado.escribir(df)
+            elif indice is not None:
+                # Se escriben los bytes exactos para que el índice conozca la posición de cada fila
+                datos = df.to_csv(header=primer_lote, index=False).encode('utf-8')
+                with open(archivo_salida, 'wb' if primer_lote else 'ab') as f_salida:
+                    f_salida.write(datos)
+                if columna_indice in df.columns:
+                    indice.registrar_lote(df[columna_indice].astype(str).tolist(), datos,
+                                          con_cabecera=primer_lote)
+                else:
+                    indice.valido = False
+            else:
+                df.to_csv(
+                    archivo_salida, 
+                    mode='w' if primer_lote else 'a',
+                    header=primer_lote,
+                    index=False,
+                    encoding='utf-8'
+                )
         
         try:
-            for i, lote in enumerate(df_iterator):
-                logger.info(f"Procesando lote {i+1} ({len(lote)} filas)")
+            if num_procesos > 1:
+                logger.info(f"Modo paralelo: {num_procesos} procesos"
+                            + (f", límite de memoria {limite_memoria_gb} GB" if limite_memoria_gb else ""))
+                columnas_finales = _procesar_bloques_en_paralelo(bloques, cabecera, esquema, archivo_salida,
+                                                                 estadisticas, cuarentena, num_procesos,
+                                                                 limite_memoria_gb, escritor_particionado,
+                                                                 escritor_sqlite, indice, cache,
+                                                                 limpieza_en_sitio)
+                primer_lote = not columnas_finales
+            else:
+                fila_inicial = 0
+                for i, (inicio, fin, datos, num_registros) in enumerate(bloques):
+                    huella = calcular_huella_bloque(cabecera, datos, esquema) if cache is not None else None
+                    lote = _leer_bloque(cabecera, datos, inicio, fin, i + 1, esquema, cuarentena, fila_inicial)
+                    fila_lote = fila_inicial
+                    fila_inicial += num_registros
+                    if not limpieza_en_sitio:
+                        del datos  # En sitio se conserva para releer el lote original si la limpieza falla
+                    logger.info(f"Procesando lote {i+1} ({len(lote)} filas, bytes {inicio}-{fin})")
                 
-                # Limpieza de lote
-                try:
-                    lote_limpio = limpiar_lote(lote, estadisticas)
-                    columnas_finales = list(lote_limpio.columns)
-                    
-                    # Escribir resultados (append mode después del primer lote)
-                    lote_limpio.to_csv(
-                        archivo_salida, 
-                        mode='w' if primer_lote else 'a',
-                        header=primer_lote,
-                        index=False,
-                        encoding='utf-8'
-                    )
-                    primer_lote = False
-                    
-                except Exception as e:
-                    logger.error(f"Error procesando lote {i+1}: {e}")
-                    logger.error(traceback.format_exc())  # Registrar traza completa
-                    # En caso de error, escribimos el lote original sin procesar
+                    # Limpieza de lote
                     try:
-                        lote.to_csv(
-                            archivo_salida, 
-                            mode='w' if primer_lote else 'a',
-                            header=primer_lote,
-                            index=False,
-                            encoding='utf-8'
-                        )
+                        lote_limpio = limpiar_lote(lote, estadisticas, reglas_compiladas, cache, huella,
+                                                   limpieza_en_sitio)
+                        columnas_finales = list(lote_limpio.columns)
+                    
+                        # Escribir resultados (append mode después del primer lote)
+                        escribir_lote(lote_limpio)
                         primer_lote = False
-                    except Exception as e2:
-                        logger.error(f"Error al escribir lote original: {e2}")
-                        # Si no podemos escribir el lote, intentamos escribir una versión simplificada
+                    
+                    except Exception as e:
+                        logger.error(f"Error procesando lote {i+1}: {e}")
+                        logger.error(traceback.format_exc())  # Registrar traza completa
+                        # En caso de error, escribimos el lote original sin procesar
                         try:
-                            logger.info("Intentando escribir versión simplificada del lote...")
-                            # Intentar convertir todo a string para prevenir errores
-                            lote_simple = lote.astype(str)
-                            lote_simple.to_csv(
-                                archivo_salida, 
-                                mode='w' if primer_lote else 'a',
-                                header=primer_lote,
-                                index=False,
-                                encoding='utf-8'
-                            )
+                            if limpieza_en_sitio:
+                                # El lote quedó a medio limpiar: se relee del bloque (sin volver a
+                                # contar su cuarentena)
+                                lote = _leer_bloque(cabecera, datos, inicio, fin, i + 1, esquema,
+                                                    CuarentenaRegistros(), fila_lote)
+                            escribir_lote(lote)
                             primer_lote = False
-                        except Exception as e3:
-                            logger.error(f"Error al escribir versión simplificada: {e3}")
+                        except Exception as e2:
+                            logger.error(f"Error al escribir lote original: {e2}")
+                            # Si no podemos escribir el lote, intentamos escribir una versión simplificada
+                            try:
+                                logger.info("Intentando escribir versión simplificada del lote...")
+                                # Intentar convertir todo a string para prevenir errores
+                                lote_simple = lote.astype(str)
+                                escribir_lote(lote_simple)
+                                primer_lote = False
+                            except Exception as e3:
+                                logger.error(f"Error al escribir versión simplificada: {e3}")
                 
-                # Liberar memoria
-                del lote
-                if 'lote_limpio' in locals():
-                    del lote_limpio
-                gc.collect()
+                    # Liberar memoria
+                    del lote
+                    if 'lote_limpio' in locals():
+                        del lote_limpio
+                    if 'datos' in locals():
+                        del datos
+                    gc.collect()
                 
-                # Verificar uso de memoria
-                memoria_actual = estadisticas.actualizar_memoria()
-                logger.info(f"Memoria después del lote {i+1}: {memoria_actual:.2f} GB")
+                    # Verificar uso de memoria
+                    memoria_actual = estadisticas.actualizar_memoria()
+                    logger.info(f"Memoria después del lote {i+1}: {memoria_actual:.2f} GB")
         except Exception as e:
+            # La salida quedaría truncada: el error se propaga para no dar el proceso por bueno
             logger.error(f"Error durante la iteración de lotes: {e}")
             logger.error(traceback.format_exc())  # Registrar traza completa
+            raise
+        finally:
+            if not es_flujo:
+                f_entrada.close()
+            if salida_es_flujo:
+                archivo_salida.flush()
+            cuarentena.cerrar()
+            if escritor_particionado is not None:
+                manifiesto = escritor_particionado.cerrar()
+                logger.info(f"Particiones escritas: {len(manifiesto['particiones'])} "
+                            f"(manifiesto en {escritor_particionado.ruta_manifiesto})")
+            if escritor_sqlite is not None:
+                logger.info("Creando índices de SQLite...")
+                filas_sqlite = escritor_sqlite.cerrar()
+                logger.info(f"Filas cargadas en SQLite: {filas_sqlite} ({archivo_sqlite})")
+            if indice is not None:
+                indice.cerrar()
+        
+        if cache is not None:
+            logger.info(f"Caché de columnas: {estadisticas.uso_cache_columnas['reutilizadas']} reutilizadas, "
+                        f"{estadisticas.uso_cache_columnas['recalculadas']} recalculadas")
+        
+        # Columnas que quedaron vacías o constantes tras la limpieza: se quitan de la salida
+        if podar_columnas and not primer_lote:
+            podadas_limpieza = estadisticas.seguimiento_columnas.columnas_podables(proporcion_minima_valores)
+            podadas_limpieza = {col: motivo for col, motivo in podadas_limpieza.items() if col in columnas_finales}
+            if podadas_limpieza and (escritor_particionado is not None or salida_es_flujo):
+                logger.warning(f"{len(podadas_limpieza)} columnas quedaron vacías o constantes tras la limpieza; "
+                               "solo se podan de un archivo de salida único")
+            elif podadas_limpieza:
+                try:
+                    reescribir_sin_columnas(archivo_salida, podadas_limpieza)
+                    columnas_finales = [col for col in columnas_finales if col not in podadas_limpieza]
+                    estadisticas.columnas_podadas.update(podadas_limpieza)
+                    if indice is not None:
+                        indice.valido = False  # El archivo se reescribió: las posiciones ya no sirven
+                    logger.info(f"Columnas podadas tras la limpieza: {len(podadas_limpieza)}")
+                except Exception as e:
+                    logger.error(f"Error al podar columnas de la salida: {e}")
+        
+        estadisticas.registros_cuarentena = cuarentena.total
+        if cuarentena.total:
+            estadisticas.registrar_cambio("Registros enviados a cuarentena", cuarentena.total)
+            logger.warning(f"{cuarentena.total} registros rechazados guardados en: {archivo_cuarentena}")
             
+        # Límites de outliers globales y, opcionalmente, segunda pasada de etiquetado
+        limites_outliers = estadisticas.calcular_limites_outliers()
+        if etiquetar_outliers and (escritor_particionado is not None or salida_es_flujo):
+            logger.warning("El etiquetado de outliers necesita releer un archivo de salida único; se omite")
+        elif etiquetar_outliers and limites_outliers and not primer_lote:
+            try:
+                conteos = etiquetar_outliers_en_archivo(archivo_salida, limites_outliers, tamano_lote,
+                                                        dtype=esquema["dtype"])
+                for columna, cantidad in conteos.items():
+                    limites_outliers[columna]["outliers_exactos"] = cantidad
+                columnas_finales = columnas_finales + ["columnas_outlier"]
+                if indice is not None:
+                    indice.valido = False  # El archivo se reescribió: las posiciones ya no sirven
+            except Exception as e:
+                logger.error(f"Error al etiquetar outliers: {e}")
+                logger.error(traceback.format_exc())
+        
+        # Si alguna posición no pudo registrarse al escribir, el índice se rehace escaneando la salida
+        if indice is not None and not primer_lote and not indice.valido:
+            logger.info("Reconstruyendo el índice de visitantes a partir del archivo de salida...")
+            metadatos = indexar_archivo(archivo_salida, columna_indice, indice.ruta_indice)
+            logger.info(f"Índice de visitantes reconstruido: {metadatos['total_filas']} filas")
+        
         # Generar reporte
         reporte = estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_finales)
+        if archivo_estadisticas:
+            estadisticas.guardar_estado(archivo_estadisticas)
         logger.info(f"Proceso completado. Se han procesado {estadisticas.filas_procesadas} filas.")
-        logger.info(f"El archivo limpio se ha guardado como: {archivo_salida}")
+        logger.info(f"El archivo limpio se ha guardado como: {directorio_particionado or nombre_salida}")
         logger.info(f"El reporte de limpieza se ha guardado como: reporte_limpieza_datos.json y reporte_limpieza_datos.txt")
         
         return reporte
         
     except Exception as e:
         logger.error(f"Error general en el procesamiento: {e}")
-        # Generar reporte parcial con la información disponible
+        # Reporte parcial para el diagnóstico; el error se propaga porque la salida está incompleta
         if 'columnas_originales' not in locals():
             columnas_originales = []
         if 'columnas_finales' not in locals():
             columnas_finales = columnas_originales
         
-        reporte = estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_finales)
-        return reporte
+        estadisticas.generar_reporte(archivo_entrada, columnas_originales, columnas_finales)
+        raise
 
 if __name__ == "__main__":
     # Configuración del procesamiento
     ARCHIVO_ENTRADA = "visitas_expandidas_completo.csv"
     ARCHIVO_SALIDA = "visitas_expandidas_completo_limpio.csv"
     TAMANO_LOTE = 100000  # Ajusta según la memoria disponible
+    ETIQUETAR_OUTLIERS = False  # Segunda pasada para marcar filas outlier con límites globales
+    ARCHIVO_ESQUEMA = "esquema_limpieza.json"  # Tipos de columnas; se infiere y guarda si no existe
+    ARCHIVO_CUARENTENA = "registros_cuarentena.csv"  # Registros rechazados con su rango de bytes y motivo
+    NUM_PROCESOS = 1  # >1 activa el modo paralelo (p. ej. os.cpu_count())
+    LIMITE_MEMORIA_GB = None  # Memoria total para el modo paralelo (None = sin límite)
+    DIRECTORIO_PARTICIONADO = None  # p. ej. "visitas_limpias_particionado": salida date=YYYYMMDD/part-N.csv
+    ARCHIVO_SQLITE = None  # p. ej. "visitas_limpias.sqlite": carga también los lotes limpios en SQLite
+    PREFIJOS_EXCLUIDOS_SQLITE = ["hits_"]  # Columnas por hit fuera de SQLite (filas ~7 veces más estrechas)
+    INDEXAR_VISITANTES = False  # Índice fullVisitorId -> posición en <ARCHIVO_SALIDA>.indice (indice_visitantes.py)
+    DIRECTORIO_CACHE_COLUMNAS = None  # p. ej. "cache_limpieza": al cambiar una regla solo se recalculan sus columnas
+    PODAR_COLUMNAS = True  # Quitar las columnas siempre vacías o constantes (poda_columnas.py)
+    LIMPIEZA_EN_SITIO = True  # Limpiar cada lote columna a columna sin copiarlo (False: DataFrame nuevo por lote)
+    PROPORCION_MINIMA_VALORES = 0.0  # > 0: podar también las columnas con menos valores que esta proporción
+    INTERVALO_TELEMETRIA = 1.0  # Segundos entre muestras de recursos (None = sin telemetría)
+    ARCHIVO_TELEMETRIA = "telemetria_limpieza.csv"  # Serie temporal de RSS, CPU, E/S y pausas del GC
+    ARCHIVO_METRICAS_PROMETHEUS = "telemetria_limpieza.prom"  # Instantánea para el textfile collector
+    COLUMNAS_EXCLUIDAS = []  # Columnas que no se leen (ni se escriben en la salida)
+    MUESTRA_DESARROLLO = None  # N: limpia solo N filas al azar estratificadas por fecha (o --muestra N)
+    SEMILLA_MUESTRA = 42
+    
+    parser = argparse.ArgumentParser(description="Paso 2: limpieza del CSV expandido")
+    parser.add_argument("--entrada", default=ARCHIVO_ENTRADA, help="CSV expandido ('-' para leer de stdin)")
+    parser.add_argument("--salida", default=ARCHIVO_SALIDA,
+                        help="CSV limpio ('-' para escribir en stdout; el resumen va a stderr)")
+    parser.add_argument("--muestra", "--sample", type=int, default=MUESTRA_DESARROLLO, metavar="N",
+                        help="procesa solo N filas al azar de todo el archivo (estratificadas por fecha)")
+    parser.add_argument("--semilla", type=int, default=SEMILLA_MUESTRA, help="semilla del muestreo")
+    parser.add_argument("--sin-poda", action="store_true",
+                        help="no podar columnas (p. ej. en un fragmento: la poda se decide al unirlos)")
+    parser.add_argument("--estadisticas", default=None, metavar="RUTA",
+                        help="guarda las estadísticas acumuladas para fusionarlas con las de otros fragmentos")
+    argumentos = parser.parse_args()
+    ARCHIVO_ENTRADA, ARCHIVO_SALIDA = argumentos.entrada, argumentos.salida
+    if argumentos.sin_poda:
+        PODAR_COLUMNAS = False
+    
+    # Con la salida en stdout, los datos se escriben en el flujo original y el resumen
+    # (print) se desvía a stderr; el log ya va a stderr y al archivo de log
+    salida_datos = ARCHIVO_SALIDA
+    if ARCHIVO_SALIDA == FLUJO_ESTANDAR:
+        salida_datos = sys.stdout
+        sys.stdout = sys.stderr
     
     # Iniciar limpieza
+    codigo_salida = 0
     logger.info("=" * 80)
     logger.info("INICIANDO PROCESO DE LIMPIEZA DE DATOS")
     logger.info("=" * 80)
     
+    # Muestreo de recursos en segundo plano durante todo el proceso
+    telemetria = None
+    if INTERVALO_TELEMETRIA:
+        telemetria = MuestreadorRecursos(INTERVALO_TELEMETRIA, ARCHIVO_TELEMETRIA,
+                                         ARCHIVO_METRICAS_PROMETHEUS, etapa="limpieza").iniciar()
+    
     try:
-        # Primero intentamos con el método estándar
+        if argumentos.muestra and ARCHIVO_ENTRADA == FLUJO_ESTANDAR:
+            logger.warning("El modo muestra necesita un archivo de entrada; se ignora con la entrada estándar")
+        elif argumentos.muestra:
+            # Ejecución de desarrollo: muestra de todo el archivo y salidas con sufijo _muestra
+            archivo_muestra = ruta_muestra(ARCHIVO_ENTRADA, "_muestra_limpieza")
+            filas_muestra = escribir_muestra(ARCHIVO_ENTRADA, archivo_muestra, argumentos.muestra,
+                                             estratificar_por="date", semilla=argumentos.semilla)
+            logger.info(f"Modo muestra: {filas_muestra} filas de {ARCHIVO_ENTRADA} copiadas a {archivo_muestra}")
+            ARCHIVO_ENTRADA = archivo_muestra
+            if salida_datos is ARCHIVO_SALIDA:
+                ARCHIVO_SALIDA = salida_datos = ruta_muestra(ARCHIVO_SALIDA)
+            if DIRECTORIO_PARTICIONADO:
+                DIRECTORIO_PARTICIONADO = DIRECTORIO_PARTICIONADO + "_muestra"
+        
+        # Primero intentamos con el método estándar; los bloques defectuosos se recuperan
+        # dentro de él, así que el método manual es solo el último recurso
         logger.info("Intentando procesamiento con método estándar...")
         try:
-            resultado = procesar_csv_grande(ARCHIVO_ENTRADA, ARCHIVO_SALIDA, TAMANO_LOTE)
+            resultado = procesar_csv_grande(ARCHIVO_ENTRADA, salida_datos, TAMANO_LOTE,
+                                            etiquetar_outliers=ETIQUETAR_OUTLIERS,
+                                            archivo_esquema=ARCHIVO_ESQUEMA,
+                                            columnas_excluidas=COLUMNAS_EXCLUIDAS,
+                                            archivo_cuarentena=ARCHIVO_CUARENTENA,
+                                            num_procesos=NUM_PROCESOS,
+                                            limite_memoria_gb=LIMITE_MEMORIA_GB,
+                                            telemetria=telemetria,
+                                            directorio_particionado=DIRECTORIO_PARTICIONADO,
+                                            archivo_sqlite=ARCHIVO_SQLITE,
+                                            prefijos_excluidos_sqlite=PREFIJOS_EXCLUIDOS_SQLITE,
+                                            indexar_visitantes=INDEXAR_VISITANTES,
+                                            directorio_cache_columnas=DIRECTORIO_CACHE_COLUMNAS,
+                                            podar_columnas=PODAR_COLUMNAS,
+                                            proporcion_minima_valores=PROPORCION_MINIMA_VALORES,
+                                            archivo_estadisticas=argumentos.estadisticas,
+                                            limpieza_en_sitio=LIMPIEZA_EN_SITIO)
             metodo_usado = "estándar"
         except Exception as e:
             logger.warning(f"El método estándar falló: {e}")
             logger.warning(traceback.format_exc())
+            if ARCHIVO_ENTRADA == FLUJO_ESTANDAR or salida_datos is not ARCHIVO_SALIDA:
+                raise  # La entrada estándar ya se consumió: no hay segunda lectura posible
             logger.info("Intentando método alternativo de procesamiento línea por línea...")
             
             # Si falla, intentamos con el método manual línea por línea
-            resultado = procesar_csv_manual(ARCHIVO_ENTRADA, ARCHIVO_SALIDA, TAMANO_LOTE)
+            resultado = procesar_csv_manual(ARCHIVO_ENTRADA, ARCHIVO_SALIDA, TAMANO_LOTE,
+                                            archivo_esquema=ARCHIVO_ESQUEMA,
+                                            columnas_excluidas=COLUMNAS_EXCLUIDAS,
+                                            telemetria=telemetria,
+                                            limpieza_en_sitio=LIMPIEZA_EN_SITIO)
             metodo_usado = "manual línea por línea"
         
         logger.info("=" * 80)
@@ -731,7 +2007,7 @@ if __name__ == "__main__":
         print("=" * 80)
         print(f"- Método de procesamiento: {metodo_usado}")
         print(f"- Archivo procesado: {ARCHIVO_ENTRADA}")
-        print(f"- Archivo generado: {ARCHIVO_SALIDA}")
+        print(f"- Archivo generado: {DIRECTORIO_PARTICIONADO or ARCHIVO_SALIDA}")
         
         # Mostrar estadísticas si están disponibles
         if isinstance(resultado, dict) and 'resumen' in resultado:
@@ -739,15 +2015,26 @@ if __name__ == "__main__":
             print(f"- Tiempo total: {resultado['resumen']['tiempo_procesamiento_minutos']:.2f} minutos")
             print(f"- Memoria máxima utilizada: {resultado['resumen']['memoria_maxima_gb']:.2f} GB")
             print(f"- Filas con errores: {resultado['resumen']['filas_con_error']}")
+            if resultado['resumen'].get('registros_cuarentena'):
+                print(f"- Registros en cuarentena: {resultado['resumen']['registros_cuarentena']} ({ARCHIVO_CUARENTENA})")
         else:
             print("- Estadísticas completas no disponibles")
             
         print(f"- Reporte detallado guardado en: reporte_limpieza_datos.txt")
         print(f"- Reporte JSON guardado en: reporte_limpieza_datos.json")
         print(f"- Log completo guardado en: {log_filename}")
+        if telemetria is not None:
+            print(f"- Telemetría de recursos: {ARCHIVO_TELEMETRIA} y {ARCHIVO_METRICAS_PROMETHEUS}")
         print("=" * 80)
         
     except Exception as e:
         logger.critical(f"ERROR FATAL EN EL PROCESO: {e}")
         logger.critical(traceback.format_exc())
-        print(f"\nERROR: El proceso de limpieza falló. Consulte el archivo de log '{log_filename}' para más detalles.")
\ No newline at end of file
+        print(f"\nERROR: El proceso de limpieza falló. Consulte el archivo de log '{log_filename}' para más detalles.")
+        codigo_salida = 1
+    finally:
+        if telemetria is not None:
+            telemetria.detener()
+        detener_registro_en_cola()
+    if codigo_salida:
+        sys.exit(codigo_salida)
\ No newline at end of file
@@ -0,0 +1,210 @@
+import csv
+import io
+import os
+import random
+
+import pandas as pd
+
+from registros_csv import contar_comillas, iterar_registros
+
+
+# Muestras aleatorias de todo el archivo en lugar de sus primeras filas (que
+# suelen ser de una sola fecha). Se salta a posiciones en bytes al azar, se
+# descarta la línea a medias y se toma el siguiente registro completo; como un
+# salto puede caer dentro de un campo multilínea, un registro solo se acepta si
+# él y los siguientes tienen tantos campos como la cabecera (si no, se prueba
+# desde la línea siguiente). La probabilidad de elegir un registro depende de la
+# longitud del registro anterior, no de la suya, así que la muestra no favorece
+# a las visitas con muchos hits.
+
+MAX_LINEAS_RESINCRONIZACION = 64  # Líneas que se prueban tras un salto antes de descartarlo
+MAX_BYTES_REGISTRO = 16 * 1024 * 1024  # Un "registro" más largo indica que el salto cayó en un campo
+REGISTROS_VERIFICACION = 2  # Registros posteriores que también deben cuadrar para aceptar un candidato
+FACTOR_SOBREMUESTREO_ESTRATOS = 3  # Registros extra leídos para repartir la muestra por estratos
+REGISTROS_ESTIMACION_TAMANO = 100  # Registros iniciales usados para estimar su tamaño medio
+
+
+def _num_campos(registro, encoding, escapechar):
+    """Campos del registro, o -1 si el texto no forma exactamente una fila CSV"""
+    filas = list(csv.reader(io.StringIO(registro.decode(encoding, errors="replace")), escapechar=escapechar))
+    return len(filas[0]) if len(filas) == 1 else -1
+
+
+def _leer_registro(f):
+    """Lee un registro por paridad de comillas desde la posición actual: (registro, completo) o None"""
+    lineas = []
+    comillas = tamano = 0
+    while True:
+        linea = f.readline()
+        if not linea:
+            break
+        lineas.append(linea)
+        comillas += contar_comillas(linea)
+        tamano += len(linea)
+        if comillas % 2 == 0 or tamano > MAX_BYTES_REGISTRO:
+            break
+    if not lineas:
+        return None
+    return b"".join(lineas), comillas % 2 == 0
+
+
+def _registro_tras(f, posicion, num_campos, encoding, escapechar):
+    """
+    Primer registro válido que empieza después de la posición dada: (inicio, registro)
+    o None. Un candidato se acepta si él y los REGISTROS_VERIFICACION siguientes
+    tienen el número de campos de la cabecera: tras caer dentro de un campo entre
+    comillas la paridad queda invertida y esa condición deja de cumplirse enseguida.
+    """
+    def valido(leido):
+        return leido[1] and _num_campos(leido[0], encoding, escapechar) == num_campos
+
+    f.seek(posicion)
+    f.readline()  # Línea a medias
+    for _ in range(MAX_LINEAS_RESINCRONIZACION):
+        inicio = f.tell()
+        candidato = _leer_registro(f)
+        if candidato is None:
+            return None  # Fin del archivo
+        if valido(candidato):
+            siguientes_validos = True
+            for _ in range(REGISTROS_VERIFICACION):
+                siguiente = _leer_registro(f)
+                if siguiente is None:
+                    break
+                if not valido(siguiente):
+                    siguientes_validos = False
+                    break
+            if siguientes_validos:
+                return inicio, candidato[0]
+        f.seek(inicio)
+        f.readline()  # Probar desde la línea siguiente
+    return None
+
+
+def muestrear_registros(archivo, num_registros, semilla=None, encoding="utf-8", escapechar=None):
+    """
+    Elige registros al azar de todo el archivo.
+
+    Args:
+        archivo: CSV con cabecera
+        num_registros: tamaño de la muestra
+        semilla: semilla del generador (None para una muestra distinta en cada llamada)
+        encoding: codificación usada para validar los registros
+        escapechar: carácter de escape del CSV, si lo tiene
+
+    Returns:
+        (cabecera, [(posición, registro)]) con los registros en bytes, ordenados por posición
+    """
+    aleatorio = random.Random(semilla)
+    tamano_archivo = os.path.getsize(archivo)
+    with open(archivo, "rb") as f:
+        registros = iterar_registros(f)
+        cabecera = next(registros, b"")
+        num_campos = _num_campos(cabecera, encoding, escapechar)
+        iniciales = []
+        for registro in registros:
+            iniciales.append(registro)
+            if len(iniciales) >= REGISTROS_ESTIMACION_TAMANO:
+                break
+
+        # Archivos pequeños (o muestras que cubren buena parte del archivo): lectura completa
+        tamano_medio = sum(len(r) for r in iniciales) / max(len(iniciales), 1)
+        cuerpo = tamano_archivo - len(cabecera)
+        if len(iniciales) < REGISTROS_ESTIMACION_TAMANO or num_registros * tamano_medio * 2 >= cuerpo:
+            f.seek(len(cabecera))
+            todos = []
+            posicion = len(cabecera)
+            for registro in iterar_registros(f):
+                todos.append((posicion, registro))
+                posicion += len(registro)
+            elegidos = aleatorio.sample(todos, min(num_registros, len(todos)))
+            return cabecera, sorted(elegidos)
+
+        # Saltos a posiciones aleatorias; la posición inicial menos uno apunta al salto
+        # de línea de la cabecera, así que el primer registro también puede salir
+        elegidos = {}
+        intentos = 0
+        while len(elegidos) < num_registros and intentos < num_registros * 4:
+            pendientes = num_registros - len(elegidos)
+            saltos = sorted(aleatorio.randrange(len(cabecera) - 1, tamano_archivo - 1) for _ in range(pendientes))
+            intentos += pendientes
+            for salto in saltos:
+                encontrado = _registro_tras(f, salto, num_campos, encoding, escapechar)
+                if encontrado is not None:
+                    elegidos[encontrado[0]] = encontrado[1]
+    return cabecera, sorted(elegidos.items())[:num_registros]
+
+
+def _estratificar(cabecera, registros, columna, num_registros, aleatorio, opciones_lectura):
+    """Reparte la muestra a partes iguales entre los valores de la columna (los que existan)"""
+    tabla = pd.read_csv(io.BytesIO(cabecera + b"".join(r for _, r in registros)), usecols=[columna],
+                        dtype=str, **opciones_lectura)
+    if len(tabla) != len(registros):
+        return registros[:num_registros]
+    tabla.index = range(len(registros))
+    orden = list(tabla.index)
+    aleatorio.shuffle(orden)
+    tabla = tabla.loc[orden]
+    grupos = tabla.groupby(columna, dropna=False, sort=False)
+    cuota = max(1, num_registros // max(grupos.ngroups, 1))
+    seleccion = list(grupos.head(cuota).index)
+    if len(seleccion) < num_registros:
+        # Estratos con menos registros que la cuota: se completa con el resto
+        tomados = set(seleccion)
+        seleccion += [i for i in orden if i not in tomados][:num_registros - len(seleccion)]
+    return [registros[i] for i in sorted(seleccion[:num_registros])]
+
+
+def leer_muestra(archivo, num_filas=10000, estratificar_por=None, semilla=None, encoding="utf-8",
+                 **opciones_lectura):
+    """
+    Lee una muestra aleatoria de todo el archivo como DataFrame. El índice es la
+    posición en bytes de cada fila dentro del archivo.
+
+    Args:
+        archivo: CSV con cabecera
+        num_filas: tamaño de la muestra
+        estratificar_por: columna (p. ej. `date`) cuyos valores reciben el mismo número de filas
+        semilla: semilla del generador
+        encoding: codificación del archivo
+        **opciones_lectura: argumentos adicionales para pd.read_csv (dtype, escapechar, ...)
+    """
+    escapechar = opciones_lectura.get("escapechar")
+    num_candidatos = num_filas * (FACTOR_SOBREMUESTREO_ESTRATOS if estratificar_por else 1)
+    cabecera, registros = muestrear_registros(archivo, num_candidatos, semilla, encoding, escapechar)
+    if estratificar_por and estratificar_por in next(csv.reader([cabecera.decode(encoding, errors="replace")])):
+        opciones_estratos = {k: v for k, v in opciones_lectura.items() if k not in ("dtype", "usecols")}
+        registros = _estratificar(cabecera, registros, estratificar_por, num_filas, random.Random(semilla),
+                                  opciones_estratos)
+    else:
+        registros = registros[:num_filas]
+    muestra = pd.read_csv(io.BytesIO(cabecera + b"".join(r for _, r in registros)), encoding=encoding,
+                          **opciones_lectura)
+    if len(muestra) == len(registros):
+        muestra.index = [posicion for posicion, _ in registros]
+    return muestra
+
+
+def escribir_muestra(archivo, archivo_salida, num_filas, estratificar_por=None, semilla=None, encoding="utf-8"):
+    """
+    Copia una muestra aleatoria de registros (bytes originales, en el orden del
+    archivo) a un CSV nuevo con la misma cabecera, para ejecuciones rápidas de
+    desarrollo del pipeline completo. Devuelve el número de registros escritos.
+    """
+    num_candidatos = num_filas * (FACTOR_SOBREMUESTREO_ESTRATOS if estratificar_por else 1)
+    cabecera, registros = muestrear_registros(archivo, num_candidatos, semilla, encoding)
+    if estratificar_por and estratificar_por in next(csv.reader([cabecera.decode(encoding, errors="replace")])):
+        registros = _estratificar(cabecera, registros, estratificar_por, num_filas, random.Random(semilla), {})
+    else:
+        registros = registros[:num_filas]
+    with open(archivo_salida, "wb") as f:
+        f.write(cabecera)
+        for _, registro in registros:
+            f.write(registro)
+    return len(registros)
+
+
+def ruta_muestra(ruta, sufijo="_muestra"):
+    """visitas.csv -> visitas_muestra.csv (salidas de una ejecución de desarrollo)"""
+    base, extension = os.path.splitext(ruta)
+    return f"{base}{sufijo}{extension}"
@@ -0,0 +1,161 @@
+import csv
+import glob
+import json
+import os
+import re
+from collections import OrderedDict
+from datetime import date, datetime
+
+import pandas as pd
+
+
+# Salida particionada por fecha: <directorio>/date=YYYYMMDD/part-N.csv más un
+# manifest.json con las particiones, sus partes y el número de filas. Así una
+# carga posterior puede saltarse particiones y reprocesar un día solo toca su
+# directorio. Los archivos abiertos se limitan con una caché LRU.
+
+NOMBRE_MANIFIESTO = "manifest.json"
+VALOR_PARTICION_NULA = "sin_fecha"
+
+
+def _valor_particion(valor):
+    """Texto seguro para el nombre de directorio de una partición"""
+    if valor is None or pd.isna(valor):
+        return VALOR_PARTICION_NULA
+    if isinstance(valor, (datetime, date)):
+        return valor.strftime("%Y%m%d")  # Fechas ya convertidas (etapa 2): mismo formato que GA
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)  # 20180501.0 -> 20180501
+    texto = str(valor).strip()
+    return re.sub(r'[^0-9A-Za-z_.-]', '_', texto) or VALOR_PARTICION_NULA
+
+
+class EscritorParticionado:
+    """
+    Escribe lotes en archivos CSV particionados por el valor de una columna.
+
+    Args:
+        directorio_base: directorio raíz de la salida particionada
+        columna_particion: columna cuyo valor define la partición (por defecto `date`)
+        max_archivos_abiertos: máximo de archivos abiertos a la vez (LRU)
+        reemplazar_particiones: si es True, la primera vez que se escribe en una
+                                partición se borran sus partes anteriores (reproceso de un día)
+        encoding: codificación de los CSV
+    """
+
+    def __init__(self, directorio_base, columna_particion="date", max_archivos_abiertos=64,
+                 reemplazar_particiones=True, encoding="utf-8"):
+        self.directorio_base = directorio_base
+        self.columna_particion = columna_particion
+        self.max_archivos_abiertos = max(1, max_archivos_abiertos)
+        self.reemplazar_particiones = reemplazar_particiones
+        self.encoding = encoding
+        os.makedirs(directorio_base, exist_ok=True)
+
+        self.ruta_manifiesto = os.path.join(directorio_base, NOMBRE_MANIFIESTO)
+        self.manifiesto = self._cargar_manifiesto()
+        self._abiertos = OrderedDict()  # {ruta: archivo}, del menos al más usado
+        self._parte_actual = {}  # {valor: {"ruta", "columnas", "parte"}} de la parte en curso
+        self._particiones_tocadas = set()
+
+    def _cargar_manifiesto(self):
+        if os.path.exists(self.ruta_manifiesto):
+            try:
+                with open(self.ruta_manifiesto, encoding="utf-8") as f:
+                    manifiesto = json.load(f)
+                if manifiesto.get("columna_particion") == self.columna_particion:
+                    return manifiesto
+            except (OSError, ValueError):
+                pass
+        return {"columna_particion": self.columna_particion, "particiones": {}}
+
+    def _abrir(self, ruta):
+        """Devuelve el archivo abierto en modo append, cerrando el menos usado si hace falta"""
+        archivo = self._abiertos.get(ruta)
+        if archivo is not None:
+            self._abiertos.move_to_end(ruta)
+            return archivo
+        while len(self._abiertos) >= self.max_archivos_abiertos:
+            _, menos_usado = self._abiertos.popitem(last=False)
+            menos_usado.close()
+        archivo = open(ruta, "a", encoding=self.encoding, newline="")
+        self._abiertos[ruta] = archivo
+        return archivo
+
+    def _preparar_particion(self, valor):
+        """Crea el directorio de la partición y, la primera vez en esta ejecución, limpia sus partes"""
+        directorio = os.path.join(self.directorio_base, f"{self.columna_particion}={valor}")
+        if valor not in self._particiones_tocadas:
+            self._particiones_tocadas.add(valor)
+            os.makedirs(directorio, exist_ok=True)
+            entrada = self.manifiesto["particiones"].get(valor)
+            if self.reemplazar_particiones or entrada is None:
+                for ruta in glob.glob(os.path.join(directorio, "part-*.csv")):
+                    os.remove(ruta)
+                entrada = {"directorio": os.path.basename(directorio), "partes": [], "filas": 0}
+                self.manifiesto["particiones"][valor] = entrada
+        return directorio
+
+    def _nueva_parte(self, valor, columnas):
+        directorio = self._preparar_particion(valor)
+        entrada = self.manifiesto["particiones"][valor]
+        numero = len(entrada["partes"])
+        nombre = f"part-{numero}.csv"
+        while os.path.exists(os.path.join(directorio, nombre)):
+            numero += 1
+            nombre = f"part-{numero}.csv"
+        parte = {"archivo": nombre, "filas": 0, "columnas": len(columnas)}
+        entrada["partes"].append(parte)
+        ruta = os.path.join(directorio, nombre)
+        archivo = self._abrir(ruta)
+        csv.writer(archivo, lineterminator="\n").writerow(columnas)
+        self._parte_actual[valor] = {"ruta": ruta, "columnas": list(columnas), "parte": parte}
+        return self._parte_actual[valor]
+
+    def escribir_csv(self, valor, columnas, texto_csv, num_filas):
+        """
+        Añade filas ya serializadas como CSV (sin cabecera) a una partición. Si las
+        columnas no coinciden con las de la parte en curso, se abre una parte nueva.
+        """
+        valor = _valor_particion(valor)
+        self._preparar_particion(valor)
+        actual = self._parte_actual.get(valor)
+        if actual is None or actual["columnas"] != list(columnas):
+            actual = self._nueva_parte(valor, columnas)
+        self._abrir(actual["ruta"]).write(texto_csv)
+        actual["parte"]["filas"] += num_filas
+        self.manifiesto["particiones"][valor]["filas"] += num_filas
+
+    def escribir(self, df):
+        """Reparte un DataFrame entre sus particiones"""
+        if df.empty:
+            return
+        for valor, (texto_csv, num_filas) in particionar_csv_en_texto(df, self.columna_particion).items():
+            self.escribir_csv(valor, df.columns, texto_csv, num_filas)
+
+    def cerrar(self):
+        """Cierra los archivos y escribe el manifiesto"""
+        for archivo in self._abiertos.values():
+            archivo.close()
+        self._abiertos.clear()
+        self.manifiesto["generado"] = datetime.now().isoformat(timespec="seconds")
+        self.manifiesto["particiones"] = dict(sorted(self.manifiesto["particiones"].items()))
+        self.manifiesto["total_filas"] = sum(p["filas"] for p in self.manifiesto["particiones"].values())
+        temporal = self.ruta_manifiesto + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(self.manifiesto, f, ensure_ascii=False, indent=2)
+        os.replace(temporal, self.ruta_manifiesto)
+        return self.manifiesto
+
+
+def particionar_csv_en_texto(df, columna_particion="date"):
+    """
+    Serializa un DataFrame por partición: {valor: (texto_csv, num_filas)}. Lo usan
+    los procesos trabajadores, que devuelven texto en lugar del DataFrame.
+    """
+    if columna_particion not in df.columns:
+        return {None: (df.to_csv(header=False, index=False, lineterminator="\n"), len(df))}
+    resultado = {}
+    for valor, grupo in df.groupby(columna_particion, sort=False, dropna=False):
+        resultado[valor] = (grupo.to_csv(header=False, index=False, lineterminator="\n"), len(grupo))
+    return resultado
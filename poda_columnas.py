@@ -0,0 +1,183 @@
+import csv
+import json
+import os
+
+
+# Poda de columnas sin información: siempre vacías (la mayoría de los hits_N_* de
+# N alto), constantes en todas las filas (socialEngagementType, totals_visits) o,
+# opcionalmente, casi vacías. Los nulos y la constancia se siguen en streaming,
+# lote a lote, con conteos exactos; al terminar se decide qué columnas sobran.
+# La etapa 1 deja la lista junto al CSV expandido (<csv>.columnas.json) para que
+# la etapa 2 ni las lea ni las escriba; la etapa 2 reescribe su salida si
+# encuentra más tras la limpieza.
+
+SUFIJO_COLUMNAS = ".columnas.json"
+MOTIVO_VACIA = "vacía"
+MOTIVO_CASI_VACIA = "casi vacía"
+MOTIVO_CONSTANTE = "constante"
+
+# Identificadores de la visita y fecha: se conservan aunque sean constantes en un
+# lote (p. ej. `date` en una exportación diaria), porque distinguen lotes al unirlos
+COLUMNAS_CONSERVADAS = ("date", "fullVisitorId", "visitId", "visitStartTime", "visitNumber")
+
+
+def ruta_columnas(archivo_csv):
+    return archivo_csv + SUFIJO_COLUMNAS
+
+
+class SeguimientoColumnas:
+    """
+    Valores no nulos y constancia de cada columna sobre todos los lotes. Una
+    columna que falta en un lote cuenta como nula en sus filas (los lotes de la
+    etapa 1 no siempre tienen las mismas columnas).
+
+    Args:
+        vacios_como_nulos: contar los textos vacíos como nulos (en el CSV se escriben igual)
+    """
+
+    def __init__(self, vacios_como_nulos=False):
+        self.vacios_como_nulos = vacios_como_nulos
+        self.filas = 0
+        self.no_nulos = {}  # {columna: valores no nulos}
+        self.valores_constantes = {}  # {columna: único valor visto, como texto} mientras la columna sea constante
+        self.no_constantes = set()
+
+    def actualizar(self, df):
+        """Agrega un lote"""
+        self.filas += len(df)
+        presentes_df = df.notna()
+        if self.vacios_como_nulos:
+            presentes_df &= df.ne("")
+        conteos = presentes_df.sum()
+        for columna, presentes in conteos.items():
+            self.no_nulos[columna] = self.no_nulos.get(columna, 0) + int(presentes)
+            if presentes == 0 or columna in self.no_constantes:
+                continue
+            # Se compara el texto que se escribe en el CSV: así también las listas sin
+            # expandir ([] en customDimensions, hits_N_experiment...) cuentan como constantes
+            valores = df[columna][presentes_df[columna]].astype(str)
+            valor = self.valores_constantes.get(columna, valores.iloc[0])
+            constante = bool((valores == valor).all())
+            if constante:
+                self.valores_constantes[columna] = valor
+            else:
+                self.no_constantes.add(columna)
+                self.valores_constantes.pop(columna, None)
+
+    def registrar_columnas(self, columnas):
+        """Añade columnas de la salida que ningún lote trajo (cuentan como vacías)"""
+        for columna in columnas:
+            self.no_nulos.setdefault(columna, 0)
+
+    def fusionar(self, otro):
+        """Incorpora el seguimiento de otros lotes (p. ej. de otro proceso)"""
+        self.filas += otro.filas
+        for columna, presentes in otro.no_nulos.items():
+            self.no_nulos[columna] = self.no_nulos.get(columna, 0) + presentes
+        self.no_constantes |= otro.no_constantes
+        for columna, valor in otro.valores_constantes.items():
+            if columna in self.no_constantes:
+                continue
+            if columna in self.valores_constantes and self.valores_constantes[columna] != valor:
+                self.no_constantes.add(columna)
+                del self.valores_constantes[columna]
+            else:
+                self.valores_constantes[columna] = valor
+        for columna in list(self.valores_constantes):
+            if columna in self.no_constantes:
+                del self.valores_constantes[columna]
+        return self
+
+    def columnas_podables(self, proporcion_minima_valores=0.0, podar_constantes=True,
+                          columnas_conservadas=COLUMNAS_CONSERVADAS):
+        """
+        Columnas que no aportan información: {columna: motivo}.
+
+        Args:
+            proporcion_minima_valores: las columnas con una proporción de valores no
+                                       nulos menor que esta también se podan (0: solo
+                                       las siempre vacías)
+            podar_constantes: podar las columnas con el mismo valor en todas las filas
+                              (sin nulos; una columna con un valor o nulo sí informa)
+            columnas_conservadas: columnas que nunca se podan por ser constantes
+        """
+        podables = {}
+        for columna, presentes in self.no_nulos.items():
+            if columna in columnas_conservadas and presentes > 0:
+                continue
+            if presentes == 0:
+                podables[columna] = MOTIVO_VACIA
+            elif self.filas and presentes / self.filas < proporcion_minima_valores:
+                podables[columna] = MOTIVO_CASI_VACIA
+            elif podar_constantes and presentes == self.filas and columna in self.valores_constantes:
+                podables[columna] = MOTIVO_CONSTANTE
+        return podables
+
+    def guardar(self, archivo_csv, podables):
+        """Escribe <archivo_csv>.columnas.json con el resumen y las columnas a podar"""
+        resumen = {
+            "archivo": os.path.abspath(archivo_csv),
+            "tamano_archivo": os.path.getsize(archivo_csv),
+            "filas": self.filas,
+            "podadas": podables,
+            "valores_constantes": {col: str(valor) for col, valor in self.valores_constantes.items()
+                                   if podables.get(col) == MOTIVO_CONSTANTE},
+            "no_nulos": self.no_nulos,
+        }
+        temporal = ruta_columnas(archivo_csv) + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(resumen, f, ensure_ascii=False, indent=2)
+        os.replace(temporal, ruta_columnas(archivo_csv))
+        return resumen
+
+
+def cargar_columnas_podadas(archivo_csv):
+    """
+    Columnas a podar ({columna: motivo}) registradas por la etapa anterior para este
+    CSV; vacío si no hay registro o el archivo cambió desde que se escribió.
+    """
+    ruta = ruta_columnas(archivo_csv)
+    if not os.path.exists(ruta):
+        return {}
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            resumen = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if resumen.get("tamano_archivo") != os.path.getsize(archivo_csv):
+        return {}
+    return resumen.get("podadas", {})
+
+
+def reescribir_sin_columnas(archivo_csv, columnas, encoding="utf-8"):
+    """
+    Reescribe un CSV sin las columnas indicadas (los demás campos se copian tal
+    cual, sin volver a interpretarlos). Devuelve el número de filas escritas.
+    """
+    columnas = set(columnas)
+    temporal = archivo_csv + ".poda.tmp"
+    filas = 0
+    with open(archivo_csv, "r", encoding=encoding, newline="") as entrada, \
+            open(temporal, "w", encoding=encoding, newline="") as salida:
+        lector = csv.reader(entrada)
+        escritor = csv.writer(salida, lineterminator="\n")
+        cabecera = next(lector, [])
+        conservadas = [i for i, columna in enumerate(cabecera) if columna not in columnas]
+        if cabecera:
+            escritor.writerow([cabecera[i] for i in conservadas])
+        for fila in lector:
+            escritor.writerow([fila[i] if i < len(fila) else "" for i in conservadas])
+            filas += 1
+    os.replace(temporal, archivo_csv)
+    return filas
+
+
+def esquema_sin_columnas(esquema, columnas):
+    """Copia del esquema de lectura de la etapa 2 que además excluye estas columnas"""
+    columnas = set(columnas)
+    esquema = dict(esquema)
+    esquema["excluidas"] = list(esquema["excluidas"]) + [col for col in esquema["columnas"]
+                                                         if col in columnas and col not in esquema["excluidas"]]
+    esquema["usecols"] = [col for col in esquema["usecols"] if col not in columnas]
+    esquema["dtype"] = {col: tipo for col, tipo in esquema["dtype"].items() if col not in columnas}
+    return esquema
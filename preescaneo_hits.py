@@ -0,0 +1,67 @@
+from collections import Counter
+
+from registros_csv import iterar_registros
+
+
+# Preescaneo del número de hits de cada visita sin interpretar el JSON: cada hit
+# de GA tiene exactamente una clave `hitNumber` (y ningún otro campo de la visita
+# la contiene), así que basta con contar sus apariciones en los bytes del
+# registro. Es varios órdenes de magnitud más rápido que ast.literal_eval y da el
+# máximo exacto, la distribución y las filas outlier antes de expandir.
+
+# La clave aparece con comillas simples (repr de Python) o dobles (JSON; dentro
+# del CSV va como ""hitNumber"", que contiene el patrón una sola vez)
+PATRONES_HIT = (b"'hitNumber'", b'"hitNumber"')
+TAMANO_BUFFER_LECTURA = 8 * 1024 * 1024
+
+
+def contar_hits(registro):
+    """Número de hits de un registro CSV en bytes"""
+    return sum(registro.count(patron) for patron in PATRONES_HIT)
+
+
+def preescanear_hits(archivo, umbral_hits=250, formato="csv"):
+    """
+    Recorre el archivo crudo y cuenta los hits de cada visita.
+
+    Args:
+        archivo: CSV de visitas con la columna `hits` sin expandir
+        umbral_hits: filas con más hits que este umbral se consideran outliers
+        formato: 'csv' o 'ndjson' (JSON Lines: una visita por línea y sin cabecera)
+
+    Returns:
+        Diccionario con:
+            filas: número de visitas (registros no vacíos)
+            max_hits: máximo global de hits por visita
+            max_hits_normales: máximo entre las visitas que no superan el umbral
+                               (ancho de hits del archivo principal)
+            distribucion: {hits: número de visitas}
+            outliers: {fila: hits} de las visitas que superan el umbral, con la fila
+                      numerada desde 1 como en la expansión
+    """
+    distribucion = Counter()
+    outliers = {}
+    fila = 0
+    with open(archivo, 'rb', buffering=TAMANO_BUFFER_LECTURA) as f:
+        if formato == "ndjson":
+            registros = f
+        else:
+            registros = iterar_registros(f)
+            next(registros, None)  # Cabecera
+        for registro in registros:
+            if not registro.strip():
+                continue  # pandas omite las líneas vacías
+            fila += 1
+            hits = contar_hits(registro)
+            distribucion[hits] += 1
+            if hits > umbral_hits:
+                outliers[fila] = hits
+
+    normales = [hits for hits in distribucion if hits <= umbral_hits]
+    return {
+        "filas": fila,
+        "max_hits": max(distribucion, default=0),
+        "max_hits_normales": max(normales, default=0),
+        "distribucion": dict(sorted(distribucion.items())),
+        "outliers": outliers,
+    }
@@ -0,0 +1,108 @@
+import atexit
+import logging
+import logging.handlers
+import multiprocessing.util
+import queue
+
+
+# Logging sin bloqueos: el logger raíz solo encola los registros (put_nowait) y un
+# hilo (QueueListener) los escribe en el archivo y la consola. Si la escritura no
+# da abasto y la cola se llena, los registros nuevos se descartan y se cuentan en
+# lugar de frenar la limpieza. Los procesos trabajadores creados con fork
+# arrancan su propia cola y su propio hilo (la cola heredada podría quedar con el
+# candado tomado por el hilo del padre).
+
+CAPACIDAD_COLA_REGISTRO = 10000  # Registros pendientes de escribir antes de empezar a descartar
+
+
+class ManejadorColaSinBloqueo(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (y cuenta) los registros cuando la cola está llena"""
+
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+class _EstadoRegistro:
+    def __init__(self):
+        self.manejadores = []
+        self.capacidad = CAPACIDAD_COLA_REGISTRO
+        self.manejador = None
+        self.oyente = None
+
+
+_estado = _EstadoRegistro()
+
+
+def _iniciar(nivel=None):
+    cola = queue.Queue(_estado.capacidad)
+    _estado.manejador = ManejadorColaSinBloqueo(cola)
+    raiz = logging.getLogger()
+    for manejador in raiz.handlers[:]:
+        raiz.removeHandler(manejador)
+    raiz.addHandler(_estado.manejador)
+    if nivel is not None:
+        raiz.setLevel(nivel)
+    _estado.oyente = logging.handlers.QueueListener(cola, *_estado.manejadores, respect_handler_level=True)
+    _estado.oyente.start()
+
+
+def configurar_registro_en_cola(manejadores, nivel=logging.INFO, formato=None,
+                                capacidad=CAPACIDAD_COLA_REGISTRO):
+    """
+    Sustituye los manejadores del logger raíz por uno que solo encola; los
+    manejadores indicados (archivo, consola...) se escriben desde un hilo aparte.
+    Se puede llamar varias veces (p. ej. una por lote en el modo vigilancia): la
+    configuración anterior se vacía y se cierra primero.
+    """
+    detener_registro_en_cola()
+    formateador = logging.Formatter(formato)
+    for manejador in manejadores:
+        manejador.setFormatter(formateador)
+    _estado.manejadores = list(manejadores)
+    _estado.capacidad = capacidad
+    _iniciar(nivel)
+
+
+def detener_registro_en_cola():
+    """Escribe los registros pendientes, avisa de los descartados y cierra los manejadores"""
+    if _estado.oyente is None:
+        return 0
+    _estado.oyente.stop()
+    descartados = _estado.manejador.descartados
+    if descartados:
+        _estado.oyente.handle(logging.makeLogRecord({
+            "levelno": logging.WARNING, "levelname": "WARNING",
+            "msg": f"{descartados} mensajes de log descartados: la cola de escritura estaba llena",
+        }))
+    logging.getLogger().removeHandler(_estado.manejador)
+    for manejador in _estado.manejadores:
+        manejador.close()
+    _estado.oyente = _estado.manejador = None
+    _estado.manejadores = []
+    return descartados
+
+
+def _reiniciar_en_hijo(estado):
+    """Tras un fork de multiprocessing: cola e hilo propios, vaciados al terminar el proceso"""
+    if estado.oyente is None:
+        return
+    _iniciar()
+    multiprocessing.util.Finalize(None, _detener_en_hijo, exitpriority=100)
+
+
+def _detener_en_hijo():
+    # Los manejadores son compartidos con el padre: solo se vacía la cola, sin cerrarlos
+    if _estado.oyente is not None:
+        _estado.oyente.stop()
+        _estado.oyente = None
+
+
+multiprocessing.util.register_after_fork(_estado, _reiniciar_en_hijo)
+atexit.register(detener_registro_en_cola)
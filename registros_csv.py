@@ -0,0 +1,77 @@
+import csv
+import io
+
+
+# Utilidades para separar un CSV en registros completos sin depender de las
+# líneas físicas: un campo entre comillas (por ejemplo, un JSON) puede contener
+# saltos de línea, así que un registro termina solo cuando el número de
+# comillas acumulado es par.
+
+def contar_comillas(texto):
+    """
+    Cuenta las comillas de una línea (str o bytes). Las dobles ("") suman dos y
+    no alteran la paridad; como en pandas y el módulo csv no hay carácter de
+    escape, una barra invertida antes de una comilla es un carácter más y la
+    comilla cuenta.
+    """
+    if isinstance(texto, bytes):
+        return texto.count(b'"')
+    return texto.count('"')
+
+def iterar_registros(lineas):
+    """
+    Agrupa líneas físicas (str o bytes, con su salto de línea) en registros CSV
+    completos. Si el archivo termina con comillas sin cerrar, el último registro
+    se devuelve tal cual.
+    """
+    pendiente = []
+    comillas = 0
+    for linea in lineas:
+        pendiente.append(linea)
+        comillas += contar_comillas(linea)
+        if comillas % 2 == 0:
+            yield linea if len(pendiente) == 1 else linea[:0].join(pendiente)
+            pendiente = []
+            comillas = 0
+    if pendiente:
+        yield pendiente[0][:0].join(pendiente)
+
+def formatear_cabecera(columnas):
+    """Devuelve la línea de cabecera CSV (con comillas donde haga falta)"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(columnas)
+    return buffer.getvalue()
+
+def iterar_bloques(archivo_binario, registros_por_bloque, posicion_inicial=0):
+    """
+    Lee un archivo abierto en modo binario (ya posicionado después de la cabecera)
+    y genera bloques de registros completos con su rango de bytes.
+
+    Args:
+        archivo_binario: archivo o flujo binario; no necesita admitir seek
+        registros_por_bloque: número de registros por bloque
+        posicion_inicial: posición en bytes del primer registro dentro del archivo
+
+    Yields:
+        Tuplas (inicio, fin, datos, num_registros) con posiciones absolutas en bytes
+    """
+    inicio = posicion = posicion_inicial
+    bloque = []
+    for registro in iterar_registros(archivo_binario):
+        bloque.append(registro)
+        posicion += len(registro)
+        if len(bloque) >= registros_por_bloque:
+            yield inicio, posicion, b''.join(bloque), len(bloque)
+            inicio = posicion
+            bloque = []
+    if bloque:
+        yield inicio, posicion, b''.join(bloque), len(bloque)
+
+def separar_registros(datos, posicion_inicial=0):
+    """Divide un bloque de bytes en registros completos: lista de (posición, registro)"""
+    registros = []
+    posicion = posicion_inicial
+    for registro in iterar_registros(datos.splitlines(keepends=True)):
+        registros.append((posicion, registro))
+        posicion += len(registro)
+    return registros
@@ -0,0 +1,135 @@
+import sqlite3
+
+import pandas as pd
+
+
+# Salida a una base SQLite embebida para análisis ad hoc. El esquema se crea a
+# partir de las columnas del primer lote (y se amplía si aparecen columnas nuevas),
+# las filas se insertan con executemany en transacciones grandes y los índices
+# se construyen al final de la carga, que es mucho más rápido que mantenerlos
+# durante las inserciones.
+
+COLUMNAS_INDICE = ("fullVisitorId", "visitId", "date")
+
+
+def _tipo_sqlite(serie):
+    """Afinidad de tipo SQLite para una columna de pandas"""
+    if pd.api.types.is_bool_dtype(serie.dtype) or pd.api.types.is_integer_dtype(serie.dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(serie.dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def _citar(nombre):
+    return '"' + str(nombre).replace('"', '""') + '"'
+
+
+class EscritorSQLite:
+    """
+    Carga lotes de un DataFrame en una tabla SQLite.
+
+    Args:
+        ruta: archivo de la base de datos
+        tabla: nombre de la tabla
+        filas_por_transaccion: filas insertadas antes de cada commit
+        columnas_indice: columnas a indexar al terminar la carga (las que existan)
+        reemplazar: si es True, la tabla se borra al empezar
+        prefijos_excluidos: columnas que no se cargan (p. ej. ("hits_",)); el coste de
+                            inserción crece con el ancho de la fila
+    """
+
+    def __init__(self, ruta, tabla="visitas", filas_por_transaccion=500_000, columnas_indice=COLUMNAS_INDICE,
+                 reemplazar=True, prefijos_excluidos=()):
+        self.ruta = ruta
+        self.tabla = tabla
+        self.prefijos_excluidos = tuple(prefijos_excluidos)
+        self.filas_por_transaccion = filas_por_transaccion
+        self.columnas_indice = columnas_indice
+        self.filas_insertadas = 0
+        self._filas_transaccion = 0
+        self._columnas = None  # Columnas de la tabla, en orden
+        self._sentencias = {}  # {tupla de columnas: INSERT preparado}
+
+        # isolation_level=None: las transacciones se controlan con BEGIN/COMMIT explícitos
+        self.conexion = sqlite3.connect(ruta, isolation_level=None)
+        self.conexion.execute("PRAGMA page_size=65536")  # Solo tiene efecto en una base nueva
+        self.conexion.execute("PRAGMA journal_mode=OFF")
+        self.conexion.execute("PRAGMA synchronous=OFF")
+        self.conexion.execute("PRAGMA locking_mode=EXCLUSIVE")
+        self.conexion.execute("PRAGMA temp_store=MEMORY")
+        self.conexion.execute("PRAGMA cache_size=-262144")  # 256 MB
+        if reemplazar:
+            self.conexion.execute(f"DROP TABLE IF EXISTS {_citar(tabla)}")
+        else:
+            existentes = [fila[1] for fila in self.conexion.execute(f"PRAGMA table_info({_citar(tabla)})")]
+            self._columnas = existentes or None
+        self.conexion.execute("BEGIN")
+
+    def _preparar_tabla(self, df):
+        """Crea la tabla o añade las columnas que falten; devuelve el INSERT para estas columnas"""
+        if self._columnas is None:
+            definiciones = ", ".join(f"{_citar(col)} {_tipo_sqlite(df[col])}" for col in df.columns)
+            self.conexion.execute(f"CREATE TABLE IF NOT EXISTS {_citar(self.tabla)} ({definiciones})")
+            self._columnas = list(df.columns)
+        else:
+            conocidas = set(self._columnas)
+            for col in df.columns:
+                if col not in conocidas:
+                    self.conexion.execute(
+                        f"ALTER TABLE {_citar(self.tabla)} ADD COLUMN {_citar(col)} {_tipo_sqlite(df[col])}")
+                    self._columnas.append(col)
+                    conocidas.add(col)
+        clave = tuple(df.columns)
+        sentencia = self._sentencias.get(clave)
+        if sentencia is None:
+            columnas = ", ".join(_citar(col) for col in df.columns)
+            marcadores = ", ".join("?" * len(df.columns))
+            sentencia = f"INSERT INTO {_citar(self.tabla)} ({columnas}) VALUES ({marcadores})"
+            self._sentencias[clave] = sentencia
+        return sentencia
+
+    @staticmethod
+    def _filas(df):
+        """Filas como tuplas de tipos nativos de Python, con None en los nulos"""
+        columnas = []
+        for col in df.columns:
+            serie = df[col]
+            if pd.api.types.is_datetime64_any_dtype(serie.dtype):
+                valores = serie.dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy(dtype=object)
+            else:
+                valores = serie.astype(object).to_numpy()
+            nulos = pd.isna(valores)
+            if nulos.any():
+                valores = valores.copy()
+                valores[nulos] = None
+            columnas.append(valores)
+        return zip(*columnas)
+
+    def escribir(self, df):
+        """Inserta un lote"""
+        if df is None or df.empty:
+            return
+        if self.prefijos_excluidos:
+            df = df[[col for col in df.columns if not str(col).startswith(self.prefijos_excluidos)]]
+        sentencia = self._preparar_tabla(df)
+        self.conexion.executemany(sentencia, self._filas(df))
+        self.filas_insertadas += len(df)
+        self._filas_transaccion += len(df)
+        if self._filas_transaccion >= self.filas_por_transaccion:
+            self.conexion.execute("COMMIT")
+            self.conexion.execute("BEGIN")
+            self._filas_transaccion = 0
+
+    def cerrar(self, crear_indices=True):
+        """Confirma la carga, construye los índices y cierra la conexión"""
+        self.conexion.execute("COMMIT")
+        if crear_indices and self._columnas:
+            for col in self.columnas_indice:
+                if col in self._columnas:
+                    nombre_indice = _citar(f"idx_{self.tabla}_{col}")
+                    self.conexion.execute(
+                        f"CREATE INDEX IF NOT EXISTS {nombre_indice} ON {_citar(self.tabla)} ({_citar(col)})")
+            self.conexion.execute("ANALYZE")
+        self.conexion.close()
+        return self.filas_insertadas
@@ -0,0 +1,243 @@
+import csv
+import gc
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import psutil
+
+try:
+    import resource  # Pico de memoria del sistema operativo (no disponible en Windows)
+except ImportError:
+    resource = None
+
+
+# Muestreo de recursos en segundo plano para las dos etapas del pipeline.
+# Un hilo toma muestras a intervalo fijo (RSS, CPU, bytes leídos/escritos) y las
+# pausas del recolector de basura se miden con gc.callbacks. Se escribe una serie
+# temporal en CSV y una instantánea en formato textfile de Prometheus.
+
+_proceso_actual = None
+
+def proceso_actual():
+    """
+    Devuelve el psutil.Process del proceso actual, creado una sola vez
+    (se renueva si el proceso es un hijo creado con fork)
+    """
+    global _proceso_actual
+    if _proceso_actual is None or _proceso_actual.pid != os.getpid():
+        _proceso_actual = psutil.Process(os.getpid())
+    return _proceso_actual
+
+def pico_memoria_so_bytes():
+    """Pico de RSS del proceso según el sistema operativo (incluye picos entre muestras), o None"""
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo expresa en KB, macOS en bytes
+    return pico if sys.platform == "darwin" else pico * 1024
+
+
+class MuestreadorRecursos:
+    """
+    Hilo en segundo plano que muestrea el uso de recursos del proceso (y de sus
+    procesos hijos, p. ej. los trabajadores del modo paralelo).
+
+    Uso:
+        with MuestreadorRecursos(1.0, "telemetria.csv", "telemetria.prom", etapa="limpieza") as m:
+            ...
+        print(m.resumen())
+    """
+    COLUMNAS = ["marca_tiempo", "segundos", "rss_mb", "rss_pico_mb", "cpu_porcentaje",
+                "bytes_leidos", "bytes_escritos", "gc_pausas", "gc_pausa_total_ms", "gc_pausa_max_ms"]
+
+    def __init__(self, intervalo=1.0, archivo_serie=None, archivo_prometheus=None, etapa="pipeline",
+                 incluir_hijos=True):
+        self.intervalo = intervalo
+        self.archivo_serie = archivo_serie
+        self.archivo_prometheus = archivo_prometheus
+        self.etapa = etapa
+        self.incluir_hijos = incluir_hijos
+
+        self.muestras = 0
+        self.rss_actual = 0
+        self.rss_pico = 0
+        self.cpu_actual = 0.0
+        self._cpu_acumulada = 0.0
+        self.bytes_leidos = 0
+        self.bytes_escritos = 0
+        self.gc_pausas = 0
+        self.gc_pausa_total = 0.0
+        self.gc_pausa_max = 0.0
+
+        self._proceso = proceso_actual()
+        self._hijos = {}  # {pid: psutil.Process}, se reutilizan para que cpu_percent tenga referencia
+        self._io_inicial = None
+        self._inicio_gc = None
+        self._tiempo_inicio = None
+        self._parar = threading.Event()
+        self._hilo = None
+        self._f_serie = None
+        self._writer = None
+
+    # Pausas del recolector de basura
+    def _callback_gc(self, fase, info):
+        if fase == "start":
+            self._inicio_gc = time.perf_counter()
+        elif fase == "stop" and self._inicio_gc is not None:
+            pausa = time.perf_counter() - self._inicio_gc
+            self._inicio_gc = None
+            self.gc_pausas += 1
+            self.gc_pausa_total += pausa
+            if pausa > self.gc_pausa_max:
+                self.gc_pausa_max = pausa
+
+    def iniciar(self):
+        """Arranca el hilo de muestreo"""
+        if self._hilo is not None:
+            return self
+        self._tiempo_inicio = time.time()
+        self._proceso.cpu_percent(None)  # La primera llamada solo fija la referencia
+        self._io_inicial = self._leer_io()
+        gc.callbacks.append(self._callback_gc)
+        if self.archivo_serie:
+            self._f_serie = open(self.archivo_serie, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._f_serie)
+            self._writer.writerow(self.COLUMNAS)
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="muestreador-recursos", daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        """Detiene el hilo, toma una última muestra y cierra los archivos"""
+        if self._hilo is None:
+            return self
+        self._parar.set()
+        self._hilo.join()
+        self._hilo = None
+        if self._callback_gc in gc.callbacks:
+            gc.callbacks.remove(self._callback_gc)
+        self.muestrear()
+        if self._f_serie is not None:
+            self._f_serie.close()
+            self._f_serie = None
+            self._writer = None
+        return self
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *exc):
+        self.detener()
+        return False
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.muestrear()
+            except Exception:
+                pass  # La telemetría nunca debe interrumpir el procesamiento
+
+    def _leer_io(self):
+        try:
+            io_proceso = self._proceso.io_counters()
+            return io_proceso.read_bytes, io_proceso.write_bytes
+        except (AttributeError, psutil.Error):  # No disponible en todas las plataformas
+            return None
+
+    def _procesos_hijos(self):
+        if not self.incluir_hijos:
+            return []
+        try:
+            actuales = self._proceso.children(recursive=True)
+        except psutil.Error:
+            return []
+        vigentes = {}
+        for hijo in actuales:
+            vigentes[hijo.pid] = self._hijos.get(hijo.pid, hijo)
+        self._hijos = vigentes
+        return list(vigentes.values())
+
+    def muestrear(self):
+        """Toma una muestra, la añade a la serie y actualiza la instantánea de Prometheus"""
+        rss = self._proceso.memory_info().rss
+        cpu = self._proceso.cpu_percent(None)
+        for hijo in self._procesos_hijos():
+            try:
+                rss += hijo.memory_info().rss
+                cpu += hijo.cpu_percent(None)
+            except psutil.Error:
+                pass  # El hijo terminó entre la consulta y la lectura
+        self.rss_actual = rss
+        self.rss_pico = max(self.rss_pico, rss)
+        self.cpu_actual = cpu
+        self._cpu_acumulada += cpu
+        io_actual = self._leer_io()
+        if io_actual is not None and self._io_inicial is not None:
+            self.bytes_leidos = io_actual[0] - self._io_inicial[0]
+            self.bytes_escritos = io_actual[1] - self._io_inicial[1]
+        self.muestras += 1
+
+        if self._writer is not None:
+            self._writer.writerow([
+                datetime.now().isoformat(timespec="milliseconds"),
+                round(time.time() - self._tiempo_inicio, 3),
+                round(rss / 1024 ** 2, 1),
+                round(self.pico_rss_bytes() / 1024 ** 2, 1),
+                round(cpu, 1),
+                self.bytes_leidos,
+                self.bytes_escritos,
+                self.gc_pausas,
+                round(self.gc_pausa_total * 1000, 3),
+                round(self.gc_pausa_max * 1000, 3),
+            ])
+            self._f_serie.flush()
+        if self.archivo_prometheus:
+            self.escribir_prometheus()
+
+    def pico_rss_bytes(self):
+        """Pico de memoria real: el mayor entre las muestras y el pico del sistema operativo"""
+        pico_so = pico_memoria_so_bytes()
+        return max(self.rss_pico, pico_so or 0)
+
+    def escribir_prometheus(self):
+        """Escribe la instantánea en formato textfile de Prometheus (reemplazo atómico)"""
+        etiqueta = f'{{etapa="{self.etapa}"}}'
+        metricas = [
+            ("rss_bytes", "gauge", "Memoria residente actual (proceso e hijos)", self.rss_actual),
+            ("rss_pico_bytes", "gauge", "Pico de memoria residente", self.pico_rss_bytes()),
+            ("cpu_porcentaje", "gauge", "Uso de CPU en la última muestra", round(self.cpu_actual, 1)),
+            ("lectura_bytes_total", "counter", "Bytes leídos desde el inicio", self.bytes_leidos),
+            ("escritura_bytes_total", "counter", "Bytes escritos desde el inicio", self.bytes_escritos),
+            ("gc_pausas_total", "counter", "Recolecciones de basura", self.gc_pausas),
+            ("gc_pausa_segundos_total", "counter", "Tiempo total en pausas del GC", round(self.gc_pausa_total, 6)),
+            ("gc_pausa_max_segundos", "gauge", "Pausa del GC más larga", round(self.gc_pausa_max, 6)),
+            ("ultima_muestra_timestamp_segundos", "gauge", "Momento de la última muestra", round(time.time(), 3)),
+        ]
+        lineas = []
+        for nombre, tipo, ayuda, valor in metricas:
+            nombre = f"pipeline_{nombre}"
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            lineas.append(f"{nombre}{etiqueta} {valor}")
+        temporal = self.archivo_prometheus + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write("\n".join(lineas) + "\n")
+        os.replace(temporal, self.archivo_prometheus)
+
+    def resumen(self):
+        """Resumen de la telemetría para los reportes"""
+        return {
+            "muestras": self.muestras,
+            "intervalo_segundos": self.intervalo,
+            "memoria_pico_gb": round(self.pico_rss_bytes() / 1024 ** 3, 3),
+            "cpu_promedio_porcentaje": round(self._cpu_acumulada / self.muestras, 1) if self.muestras else 0,
+            "bytes_leidos": self.bytes_leidos,
+            "bytes_escritos": self.bytes_escritos,
+            "gc_pausas": self.gc_pausas,
+            "gc_pausa_total_ms": round(self.gc_pausa_total * 1000, 3),
+            "gc_pausa_max_ms": round(self.gc_pausa_max * 1000, 3),
+        }
@@ -0,0 +1,28 @@
+import io
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from columnas_salida import EscritorCSVAlineado  # noqa: E402
+
+
+def test_flujo_con_columna_tardia_falla():
+    escritor = EscritorCSVAlineado(io.StringIO())
+    escritor.escribir(pd.DataFrame({"a": [1]}))
+
+    with pytest.raises(ValueError, match="b"):
+        escritor.escribir(pd.DataFrame({"a": [2], "b": [3]}))
+
+
+def test_flujo_con_lista_fija_descarta_el_resto():
+    flujo = io.StringIO()
+    escritor = EscritorCSVAlineado(flujo, columnas=["a", "c"])
+    escritor.escribir(pd.DataFrame({"a": [1], "b": [2]}))
+    escritor.escribir(pd.DataFrame({"c": [3], "d": [4]}))
+
+    assert flujo.getvalue() == "a,c\n1,\n,3\n"
+    assert escritor.omitidas == ["b", "d"]
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filtros_filas import compilar_filtros, extraer_campo, mascara_filtros, tabla_filtros  # noqa: E402
+
+
+def test_null_y_none_sin_comillas_son_nulos():
+    totals = pd.Series(['{"visits": "1", "bounces": null}', "{'visits': '1', 'bounces': None}",
+                        '{"visits": "1"}', '{"visits": "1", "bounces": "1"}', '{"bounces": "null"}'])
+
+    valores = extraer_campo(totals, "bounces")
+
+    assert valores.isna().tolist() == [True, True, True, False, False]
+
+
+def test_filtro_sin_rebote_conserva_bounces_nulos():
+    lote = pd.DataFrame({"totals": ['{"bounces": null}', "{'bounces': None}", '{"visits": "1"}',
+                                    '{"bounces": "1"}']})
+    filtros = compilar_filtros([{"columna": "totals_bounces", "tipo": "nulo"}])
+
+    mascara = mascara_filtros(tabla_filtros(lote, filtros), filtros)
+
+    assert mascara.tolist() == [True, True, True, False]
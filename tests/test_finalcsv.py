@@ -0,0 +1,80 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLUMNAS = ["channelGrouping", "date", "device", "fullVisitorId", "hits", "totals", "visitId"]
+
+
+def _visita(numero, hits, titulo="Home"):
+    """Visita al estilo de la exportación de GA (objetos como repr de Python)"""
+    lista_hits = [{"hitNumber": str(n), "isInteraction": True, "page": {"pagePath": "/home", "pageTitle": titulo}}
+                  for n in range(1, hits + 1)]
+    return {"channelGrouping": "Direct", "date": "20170801", "device": repr({"browser": "Chrome", "isMobile": False}),
+            "fullVisitorId": str(9000 + numero), "hits": repr(lista_hits),
+            "totals": json.dumps({"visits": "1", "hits": str(hits)}), "visitId": str(numero)}
+
+
+def _escribir_visitas(ruta, visitas):
+    with open(ruta, "w", encoding="utf-8", newline="") as f:
+        escritor = csv.DictWriter(f, COLUMNAS, lineterminator="\n")
+        escritor.writeheader()
+        escritor.writerows(visitas)
+
+
+def _ejecutar_finalcsv(directorio, *argumentos, entrada=None):
+    entorno = dict(os.environ, PYTHONPATH=RAIZ, MPLBACKEND="Agg")
+    return subprocess.run([sys.executable, os.path.join(RAIZ, "finalcsv.py"), *argumentos], cwd=directorio,
+                          env=entorno, input=entrada, capture_output=True, check=True)
+
+
+def test_outliers_por_hits_de_cada_fila(tmp_path):
+    # El título 10\" (comilla escapada al estilo JSON) no debe desplazar las filas
+    visitas = [_visita(1, 1, titulo='Monitor 10\\"'), _visita(2, 2), _visita(3, 300), _visita(4, 3), _visita(5, 1)]
+    _escribir_visitas(tmp_path / "visitas.csv", visitas)
+
+    _ejecutar_finalcsv(tmp_path, "--entrada", "visitas.csv", "--salida", "expandidas.csv")
+
+    principal = pd.read_csv(tmp_path / "expandidas.csv", dtype=str)
+    outliers = pd.read_csv(tmp_path / "visitas_muchos_hits.csv", dtype=str)
+    assert outliers["visitId"].tolist() == ["3"]
+    assert principal["visitId"].tolist() == ["1", "2", "4", "5"]
+    assert principal.loc[0, "hits_1_page_pageTitle"] == 'Monitor 10\\"'
+
+
+def _visitas_flujo(ruta, totales_tardios=False):
+    # 2.500 visitas: las de después de la fila 2000 (segundo lote y siguientes) traen 4 hits
+    visitas = [_visita(numero, 1 if numero <= 2000 else 4) for numero in range(1, 2501)]
+    if totales_tardios:
+        for visita in visitas[2000:]:
+            visita["totals"] = json.dumps({"visits": "1", "hits": "4", "transactions": "1"})
+    _escribir_visitas(ruta, visitas)
+    with open(ruta, "rb") as f:
+        return f.read()
+
+
+def test_flujo_reserva_hits_hasta_el_umbral(tmp_path):
+    entrada = _visitas_flujo(tmp_path / "visitas.csv")
+
+    resultado = _ejecutar_finalcsv(tmp_path, "--entrada", "-", "--salida", "-", entrada=entrada)
+
+    salida = tmp_path / "expandidas.csv"
+    salida.write_bytes(resultado.stdout)
+    df = pd.read_csv(salida, dtype=str)
+    assert len(df) == 2500
+    assert "hits_250_page_pagePath" in df.columns
+    assert (df.loc[2000:, "hits_4_hitNumber"] == "4").all()
+
+
+def test_flujo_falla_con_columnas_tardias(tmp_path):
+    entrada = _visitas_flujo(tmp_path / "visitas.csv", totales_tardios=True)
+
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        _ejecutar_finalcsv(tmp_path, "--entrada", "-", "--salida", "-", entrada=entrada)
+
+    assert b"totals_transactions" in error.value.stderr
@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import fragmentos  # noqa: E402
+
+
+@pytest.fixture
+def entrada_con_duplicados(tmp_path):
+    """sample_data.csv seguido de sus mismas visitas: los fragmentos finales no aportan filas nuevas"""
+    with open(os.path.join(RAIZ, "sample_data.csv"), encoding="utf-8") as f:
+        cabecera, *registros = f.read().splitlines(keepends=True)
+    ruta = tmp_path / "visitas.csv"
+    ruta.write_text(cabecera + "".join(registros) * 2, encoding="utf-8")
+    return str(ruta), len(registros)
+
+
+def _trabajar(directorio):
+    return fragmentos.TrabajadorFragmentos(directorio, id_trabajador="prueba").ejecutar()
+
+
+def test_fragmentos_vacios_cuentan_como_hechos(entrada_con_duplicados, tmp_path, monkeypatch):
+    archivo, visitas = entrada_con_duplicados
+    directorio = str(tmp_path / "trabajo")
+    monkeypatch.chdir(tmp_path)
+    manifiesto = fragmentos.planificar_fragmentos(archivo, directorio, tamano_fragmento_mb=0.02)
+
+    resumen = _trabajar(directorio)
+
+    assert resumen == {"procesados": len(manifiesto["fragmentos"]), "fallidos": 0, "perdidos": 0}
+    hechos = [fragmentos._leer_json(os.path.join(directorio, "fragmentos", f["id"], fragmentos.NOMBRE_HECHO))
+              for f in manifiesto["fragmentos"]]
+    vacios = [hecho for hecho in hechos if hecho.get("vacio")]
+    assert vacios and all(hecho["filas_limpias"] == 0 for hecho in vacios)
+    resultado = fragmentos.unir_fragmentos(directorio)
+    assert resultado["filas_salida_limpia"] == visitas
+
+
+def test_intento_con_bloqueo_perdido_se_descarta(entrada_con_duplicados, tmp_path, monkeypatch):
+    archivo, _ = entrada_con_duplicados
+    directorio = str(tmp_path / "trabajo")
+    monkeypatch.chdir(tmp_path)
+    manifiesto = fragmentos.planificar_fragmentos(archivo, directorio, tamano_fragmento_mb=1)
+    fragmento = manifiesto["fragmentos"][0]
+    trabajador = fragmentos.TrabajadorFragmentos(directorio, id_trabajador="lento")
+    assert trabajador.reclamar(fragmento)
+    ruta_bloqueo = trabajador._ruta_bloqueo(fragmento["id"])
+    procesar_lote = fragmentos.procesar_lote
+
+    def procesar_y_perder_bloqueo(*argumentos, **opciones):
+        # Mientras tanto el bloqueo caduca y otro trabajador lo toma
+        with open(ruta_bloqueo, "w", encoding="utf-8") as f:
+            json.dump({"token": "otro", "trabajador": "rapido"}, f)
+        return procesar_lote(*argumentos, **opciones)
+
+    monkeypatch.setattr(fragmentos, "procesar_lote", procesar_y_perder_bloqueo)
+
+    assert trabajador.procesar(fragmento) is None
+    directorio_fragmento = os.path.join(directorio, "fragmentos", fragmento["id"])
+    assert not os.path.exists(os.path.join(directorio_fragmento, fragmentos.NOMBRE_HECHO))
+    assert not os.path.exists(os.path.join(directorio_fragmento, fragmentos.NOMBRE_ERROR))
+    assert fragmentos._leer_json(ruta_bloqueo)["token"] == "otro"
+
+
+def test_bloqueo_retomado_no_se_retoma_con_el_token_viejo(entrada_con_duplicados, tmp_path, monkeypatch):
+    archivo, _ = entrada_con_duplicados
+    directorio = str(tmp_path / "trabajo")
+    fragmentos.planificar_fragmentos(archivo, directorio, tamano_fragmento_mb=1)
+    primero = fragmentos.TrabajadorFragmentos(directorio, id_trabajador="a", expiracion_bloqueo=1)
+    segundo = fragmentos.TrabajadorFragmentos(directorio, id_trabajador="b", expiracion_bloqueo=1)
+    ruta_bloqueo = primero._ruta_bloqueo("00000")
+    fragmentos._escribir_json(ruta_bloqueo, {"token": "viejo", "trabajador": "caido"})
+    os.utime(ruta_bloqueo, (0, 0))
+
+    token = primero._tomar_bloqueo_caducado(ruta_bloqueo)
+    assert token is not None
+    # El segundo trabajador leyó el token caducado antes de que el primero lo retomara
+    os.utime(ruta_bloqueo, (0, 0))
+    leer_json = fragmentos._leer_json
+    lecturas = iter([{"token": "viejo"}])
+    monkeypatch.setattr(fragmentos, "_leer_json", lambda ruta: next(lecturas, None) or leer_json(ruta))
+
+    assert segundo._tomar_bloqueo_caducado(ruta_bloqueo) is None  # La marca de toma sigue ahí
+    os.remove(f"{ruta_bloqueo}.viejo.toma")
+    lecturas = iter([{"token": "viejo"}])
+    assert segundo._tomar_bloqueo_caducado(ruta_bloqueo) is None  # El bloqueo ya no tiene el token viejo
+    assert leer_json(ruta_bloqueo)["token"] == token
+    assert not os.path.exists(f"{ruta_bloqueo}.viejo.toma")
@@ -0,0 +1,34 @@
+import io
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registros_csv import contar_comillas, iterar_registros, separar_registros  # noqa: E402
+
+# Un título con una comilla escapada al estilo JSON (10\") dentro de un campo CSV:
+# en el archivo la comilla va doblada (10\"") y la barra invertida es un carácter más
+CSV_BARRA_COMILLA = (
+    'id,titulo,notas\n'
+    '1,"Monitor 10\\"" negro",\n'
+    '2,"Normal","linea 1\nlinea 2"\n'
+)
+
+
+def test_barra_invertida_antes_de_comilla_no_escapa():
+    assert contar_comillas('"Monitor 10\\"" negro"') % 2 == 0
+    assert contar_comillas(b'"Monitor 10\\"" negro"') % 2 == 0
+
+
+def test_registros_coinciden_con_pandas():
+    lineas = io.StringIO(CSV_BARRA_COMILLA).readlines()
+    registros = list(iterar_registros(lineas))[1:]  # Sin la cabecera
+    df = pd.read_csv(io.StringIO(CSV_BARRA_COMILLA), dtype=str)
+
+    assert len(registros) == len(df) == 2
+    assert registros[0].startswith("1,") and registros[1].startswith("2,")
+    assert df.loc[0, "titulo"] == 'Monitor 10\\" negro'
+    separados = separar_registros(CSV_BARRA_COMILLA.encode("utf-8"))
+    assert [registro for _, registro in separados][1:] == [r.encode("utf-8") for r in registros]
@@ -0,0 +1,340 @@
+import argparse
+import gc
+import importlib
+import json
+import multiprocessing
+import os
+import runpy
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+
+
+# Modo vigilancia: un proceso de larga duración observa un directorio de entrada
+# y pasa cada lote nuevo por las dos etapas (finalcsv.py y limpiezaFinal.py) en
+# cuanto termina de escribirse. Los lotes se procesan en un pool de procesos que
+# vive entre lotes, así que pandas, matplotlib y el resto de módulos se importan
+# una sola vez; cada etapa se ejecuta como su script (runpy) dentro del
+# directorio de salida del lote, con sus propios reportes, log y telemetría. El
+# estado y los tiempos de cada lote se guardan en estado_lotes.json.
+
+DIRECTORIO_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_EXPANSION = os.path.join(DIRECTORIO_SCRIPTS, "finalcsv.py")
+SCRIPT_LIMPIEZA = os.path.join(DIRECTORIO_SCRIPTS, "limpiezaFinal.py")
+
+EXTENSIONES_LOTE = (".csv", ".json", ".jsonl", ".ndjson")
+SUFIJOS_TEMPORALES = (".tmp", ".part", ".crdownload")  # Archivos aún en copia
+NOMBRE_ESTADO = "estado_lotes.json"
+NOMBRE_ESTADO_LOTE = "estado.json"
+NOMBRE_LOG_LOTE = "lote.log"  # Salida de las dos etapas (print, tqdm y log de la limpieza)
+NOMBRE_EXPANDIDO = "visitas_expandidas_completo.csv"
+NOMBRE_LIMPIO = "visitas_expandidas_completo_limpio.csv"
+
+# Módulos pesados que se importan antes de crear el pool (los trabajadores los heredan con fork)
+MODULOS_PRECARGADOS = ("pandas", "numpy", "matplotlib.pyplot", "seaborn", "psutil", "tqdm", "IPython.display",
+                       "agregados", "columnas_salida", "deduplicacion", "estadisticas_streaming", "indice_visitantes",
+                       "muestreo", "particionado", "preescaneo_hits", "registros_csv", "salida_sqlite", "telemetria")
+
+
+def _ahora():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _escribir_json(ruta, datos):
+    """Escritura atómica (archivo temporal + os.replace)"""
+    temporal = ruta + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False, indent=2)
+    os.replace(temporal, ruta)
+
+
+def precargar_modulos():
+    """Importa los módulos pesados del pipeline; devuelve los segundos empleados"""
+    inicio = time.perf_counter()
+    if DIRECTORIO_SCRIPTS not in sys.path:
+        sys.path.insert(0, DIRECTORIO_SCRIPTS)
+    for nombre in MODULOS_PRECARGADOS:
+        try:
+            importlib.import_module(nombre)
+        except ImportError:
+            pass  # El script correspondiente fallará con un error claro si lo necesita
+    return time.perf_counter() - inicio
+
+
+def _lote_sin_registros(ruta_entrada):
+    """Indica si el lote no tiene ningún registro (vacío o, en CSV, solo la cabecera)"""
+    lineas_cabecera = 0 if ruta_entrada.lower().endswith(EXTENSIONES_LOTE[1:]) else 1
+    lineas = 0
+    with open(ruta_entrada, "rb") as f:
+        for linea in f:
+            if linea.strip():
+                lineas += 1
+                if lineas > lineas_cabecera:
+                    return False
+    return True
+
+
+def _ejecutar_script(script, argumentos, como_main=False):
+    """Ejecuta un script del pipeline con los argumentos dados; devuelve sus variables globales"""
+    argv_original = sys.argv
+    sys.argv = [script] + argumentos
+    try:
+        return runpy.run_path(script, run_name="__main__" if como_main else "<vigilancia>")
+    except SystemExit as e:
+        # sys.exit() no debe terminar el proceso trabajador del pool
+        raise RuntimeError(f"{os.path.basename(script)} terminó con código {e.code} (ver {NOMBRE_LOG_LOTE})") from None
+    finally:
+        sys.argv = argv_original
+
+
+def procesar_lote(ruta_entrada, directorio_lote, argumentos_limpieza=()):
+    """
+    Expande y limpia un lote dentro de su directorio de salida. Se ejecuta en un
+    proceso trabajador del pool; argumentos_limpieza se añaden a la línea de
+    comandos de limpiezaFinal.py. Si la expansión no deja ninguna fila (todas
+    duplicadas, filtradas u outliers, o un lote sin registros), el lote termina
+    con 0 filas limpias, sin limpieza, y el resultado lleva "vacio": True.
+
+    Returns:
+        Diccionario con los tiempos de cada etapa y las filas procesadas
+    """
+    os.makedirs(directorio_lote, exist_ok=True)
+    directorio_original = os.getcwd()
+    resultado = {"pid": os.getpid()}
+    os.chdir(directorio_lote)
+    try:
+        with open(NOMBRE_LOG_LOTE, "a", encoding="utf-8") as log, redirect_stdout(log), redirect_stderr(log):
+            inicio = time.perf_counter()
+            variables = _ejecutar_script(SCRIPT_EXPANSION, ["--entrada", ruta_entrada, "--salida", NOMBRE_EXPANDIDO])
+            resultado["segundos_expansion"] = round(time.perf_counter() - inicio, 3)
+            resultado["filas_expandidas"] = variables.get("total_filas")
+            resultado["max_hits"] = variables.get("max_hits")
+            del variables
+            gc.collect()
+            if not os.path.exists(NOMBRE_EXPANDIDO):
+                # Sin filas que escribir no hay archivo expandido; solo es un error si
+                # el lote tenía registros y la expansión no llegó a leer ninguno
+                if not resultado["filas_expandidas"] and not _lote_sin_registros(ruta_entrada):
+                    raise RuntimeError(f"La expansión no generó {NOMBRE_EXPANDIDO} (ver {NOMBRE_LOG_LOTE})")
+                resultado["filas_limpias"] = 0
+                resultado["vacio"] = True
+                return resultado
+
+            inicio = time.perf_counter()
+            variables = _ejecutar_script(SCRIPT_LIMPIEZA, ["--entrada", NOMBRE_EXPANDIDO, "--salida", NOMBRE_LIMPIO,
+                                                           *argumentos_limpieza], como_main=True)
+            resultado["segundos_limpieza"] = round(time.perf_counter() - inicio, 3)
+            # La limpieza captura sus errores y solo los registra: sin método usado, falló
+            if "metodo_usado" not in variables:
+                raise RuntimeError(f"La limpieza falló (ver {variables.get('log_filename')})")
+            resumen = variables.get("resultado")
+            if isinstance(resumen, dict) and "resumen" in resumen:
+                resultado["filas_limpias"] = resumen["resumen"].get("filas_procesadas")
+            resultado["log_limpieza"] = variables.get("log_filename")
+            del variables
+            gc.collect()
+    finally:
+        os.chdir(directorio_original)
+    return resultado
+
+
+class VigilanteLotes:
+    """
+    Observa un directorio y procesa cada lote nuevo cuando deja de crecer.
+
+    Args:
+        directorio_entrada: directorio donde aparecen los lotes (.csv, .json, .jsonl, .ndjson)
+        directorio_salida: un subdirectorio por lote más estado_lotes.json
+        max_lotes_concurrentes: lotes procesados a la vez (procesos del pool)
+        segundos_estabilidad: tiempo sin cambios de tamaño ni fecha para dar un lote por escrito
+        intervalo: segundos entre exploraciones del directorio
+    """
+
+    def __init__(self, directorio_entrada, directorio_salida, max_lotes_concurrentes=2, segundos_estabilidad=5.0,
+                 intervalo=2.0):
+        self.directorio_entrada = os.path.abspath(directorio_entrada)
+        self.directorio_salida = os.path.abspath(directorio_salida)
+        self.max_lotes_concurrentes = max(1, max_lotes_concurrentes)
+        self.segundos_estabilidad = segundos_estabilidad
+        self.intervalo = intervalo
+        os.makedirs(self.directorio_salida, exist_ok=True)
+
+        self.ruta_estado = os.path.join(self.directorio_salida, NOMBRE_ESTADO)
+        self.estado = self._cargar_estado()
+        self._observados = {}  # {ruta: (tamaño, mtime, visto_desde)}
+        self._en_curso = {}  # {futuro: nombre del lote}
+        self._pool = None
+        self._pool_roto = False  # Un trabajador murió (p. ej. por falta de memoria): hay que recrear el pool
+
+    def _cargar_estado(self):
+        if os.path.exists(self.ruta_estado):
+            try:
+                with open(self.ruta_estado, encoding="utf-8") as f:
+                    estado = json.load(f)
+                for lote in estado.get("lotes", {}).values():
+                    if lote.get("estado") == "procesando":
+                        lote["estado"] = "interrumpido"  # Ejecución anterior cortada: se reprocesa
+                return estado
+            except (OSError, ValueError):
+                pass
+        return {"directorio_entrada": self.directorio_entrada, "lotes": {}}
+
+    def _guardar_estado(self, nombre=None):
+        self.estado["actualizado"] = _ahora()
+        _escribir_json(self.ruta_estado, self.estado)
+        if nombre is not None:
+            lote = self.estado["lotes"][nombre]
+            _escribir_json(os.path.join(lote["directorio"], NOMBRE_ESTADO_LOTE), lote)
+
+    def _crear_pool(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.max_lotes_concurrentes,
+                                         mp_context=multiprocessing.get_context("fork"),
+                                         initializer=precargar_modulos)
+
+    @staticmethod
+    def nombre_lote(ruta):
+        return os.path.splitext(os.path.basename(ruta))[0]
+
+    def _lotes_listos(self):
+        """Lotes nuevos o modificados cuyo tamaño y fecha llevan segundos_estabilidad sin cambiar"""
+        listos = []
+        ahora = time.time()
+        vistos = set()
+        for entrada in os.scandir(self.directorio_entrada):
+            nombre_archivo = entrada.name
+            if (not entrada.is_file() or nombre_archivo.startswith(".")
+                    or nombre_archivo.lower().endswith(SUFIJOS_TEMPORALES)
+                    or not nombre_archivo.lower().endswith(EXTENSIONES_LOTE)):
+                continue
+            ruta = entrada.path
+            vistos.add(ruta)
+            info = entrada.stat()
+            if info.st_size == 0:
+                continue
+            firma = (info.st_size, info.st_mtime)
+            lote = self.estado["lotes"].get(self.nombre_lote(ruta))
+            if lote is not None and (lote["tamano"], lote["mtime"]) == firma and lote["estado"] in (
+                    "completado", "error", "procesando"):
+                continue  # Ya procesado (o fallido) con este mismo contenido
+            anterior = self._observados.get(ruta)
+            if anterior is None or anterior[:2] != firma:
+                self._observados[ruta] = (*firma, ahora)
+            elif ahora - anterior[2] >= self.segundos_estabilidad:
+                listos.append((info.st_mtime, ruta))
+        for ruta in list(self._observados):
+            if ruta not in vistos:
+                del self._observados[ruta]  # Borrado o renombrado antes de terminar
+        return [ruta for _, ruta in sorted(listos)]
+
+    def _lanzar(self, ruta):
+        nombre = self.nombre_lote(ruta)
+        if nombre in self._en_curso.values():
+            return  # Reescrito mientras se procesa: se retoma al terminar
+        info = os.stat(ruta)
+        directorio_lote = os.path.join(self.directorio_salida, nombre)
+        self.estado["lotes"][nombre] = {
+            "archivo": ruta,
+            "directorio": directorio_lote,
+            "tamano": info.st_size,
+            "mtime": info.st_mtime,
+            "estado": "procesando",
+            "detectado": datetime.fromtimestamp(self._observados.pop(ruta)[2]).isoformat(timespec="seconds"),
+            "inicio": _ahora(),
+        }
+        os.makedirs(directorio_lote, exist_ok=True)
+        self._guardar_estado(nombre)
+        futuro = self._pool.submit(procesar_lote, ruta, directorio_lote)
+        self._en_curso[futuro] = nombre
+        print(f"[{_ahora()}] Lote {nombre}: procesando ({len(self._en_curso)} en curso)", flush=True)
+
+    def _recoger(self, futuros):
+        for futuro in futuros:
+            nombre = self._en_curso.pop(futuro)
+            lote = self.estado["lotes"][nombre]
+            lote["fin"] = _ahora()
+            lote["segundos_total"] = round(
+                (datetime.fromisoformat(lote["fin"]) - datetime.fromisoformat(lote["inicio"])).total_seconds(), 3)
+            try:
+                lote.update(futuro.result())
+                lote["estado"] = "completado"
+                lote.pop("error", None)
+                print(f"[{_ahora()}] Lote {nombre}: completado en {lote['segundos_total']:.1f} s "
+                      f"(expansión {lote['segundos_expansion']:.1f} s, limpieza {lote['segundos_limpieza']:.1f} s)",
+                      flush=True)
+            except BrokenProcessPool as e:
+                self._pool_roto = True
+                lote["estado"] = "error"
+                lote["error"] = f"El proceso trabajador terminó de forma abrupta: {e}"
+                print(f"[{_ahora()}] Lote {nombre}: error ({lote['error']})", flush=True)
+            except Exception as e:
+                lote["estado"] = "error"
+                lote["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+                print(f"[{_ahora()}] Lote {nombre}: error ({lote['error']})", flush=True)
+            self._guardar_estado(nombre)
+
+    def ejecutar(self, una_pasada=False):
+        """
+        Bucle principal. Con una_pasada=True procesa los lotes presentes y termina
+        cuando no queda ninguno pendiente (sin esperar a lotes nuevos).
+        """
+        print(f"[{_ahora()}] Vigilando {self.directorio_entrada} -> {self.directorio_salida} "
+              f"(hasta {self.max_lotes_concurrentes} lotes a la vez)", flush=True)
+        print(f"[{_ahora()}] Módulos precargados en {precargar_modulos():.1f} s", flush=True)
+        self._crear_pool()
+        try:
+            while True:
+                listos = self._lotes_listos()
+                for ruta in listos:
+                    if len(self._en_curso) >= self.max_lotes_concurrentes:
+                        break
+                    self._lanzar(ruta)
+
+                if self._en_curso:
+                    terminados, _ = wait(list(self._en_curso), timeout=self.intervalo, return_when=FIRST_COMPLETED)
+                    self._recoger(terminados)
+                    if self._pool_roto:
+                        # Los demás lotes del pool roto también fallan; se recoge su error y se recrea
+                        self._recoger(wait(list(self._en_curso))[0])
+                        self._pool.shutdown(wait=True)
+                        self._crear_pool()
+                        self._pool_roto = False
+                elif una_pasada and not self._observados:
+                    break
+                else:
+                    time.sleep(self.intervalo)
+        except KeyboardInterrupt:
+            print(f"[{_ahora()}] Interrumpido; esperando a los lotes en curso...", flush=True)
+            self._recoger(wait(list(self._en_curso))[0])
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        return self.estado
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description="Procesa (expansión + limpieza) cada lote nuevo que aparece en un directorio")
+    parser.add_argument("directorio_entrada", help="directorio donde se depositan los lotes")
+    parser.add_argument("--salida", default="lotes_procesados",
+                        help="directorio de salida (un subdirectorio por lote y estado_lotes.json)")
+    parser.add_argument("--lotes-concurrentes", type=int, default=2, help="lotes procesados a la vez")
+    parser.add_argument("--estabilidad", type=float, default=5.0,
+                        help="segundos sin cambios para considerar un lote completamente escrito")
+    parser.add_argument("--intervalo", type=float, default=2.0, help="segundos entre exploraciones del directorio")
+    parser.add_argument("--una-pasada", action="store_true",
+                        help="procesa los lotes presentes y termina en lugar de seguir vigilando")
+    args = parser.parse_args(argumentos)
+
+    vigilante = VigilanteLotes(args.directorio_entrada, args.salida, args.lotes_concurrentes, args.estabilidad,
+                               args.intervalo)
+    estado = vigilante.ejecutar(una_pasada=args.una_pasada)
+    errores = [nombre for nombre, lote in estado["lotes"].items() if lote["estado"] == "error"]
+    if errores:
+        print(f"Lotes con error: {', '.join(errores)}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()